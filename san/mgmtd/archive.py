@@ -0,0 +1,527 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import bisect
+import threading
+import subprocess
+import collections
+import multiprocessing.pool
+
+from .async_file_reader import AsynchronousFileLogger
+from .backup import Dataset, backup_conf, send_cmd, send_flags, receive_flags, \
+    replication_priority
+from .compress import AdaptiveCompressor, get_codec, to_bytes
+from .framing import checksums, codec_ids, codec_names
+from .pipeline import OrderedStage
+from .priority import spawn
+from .progress import SendProgress
+
+
+"""
+Send stream archives.
+
+zfs send output kept in files as a backup tier of its own, rather than
+received anywhere. The stream is cut into chunks of a fixed raw size, each
+optionally compressed (in the same worker pool and with the same adaptive
+compressor as the wire) and hashed:
+
+    header      magic, version, raw chunk size
+    chunks      stored length, raw length, codec id, then the stored bytes
+    metadata    JSON: dataset, snapshot, base, send command, ...
+    index       for each chunk: stream offset, file offset, stored length,
+                raw length, codec id, sha256 of the raw bytes
+    footer      metadata offset and length, index offset, chunk count,
+                crc32 of the index, magic
+
+With the index at a fixed distance from the end, any chunk can be found,
+read and checked on its own: verification runs over chunks in parallel, a
+copy elsewhere can be compared chunk by chunk and only what differs sent
+again, and the stream can be read out from any chunk boundary without
+decompressing what comes before.
+
+zfs receive only takes a stream from its start, though; reading from the
+middle is for whatever copes with that downstream, ie picking up an
+interrupted copy of a restore stream. An interrupted zfs receive -s wants a
+fresh zfs send -t of its resume token, which no archive can stand in for.
+Archives are written under a .partial name and only renamed into place once
+the index is down and the send succeeded.
+"""
+
+
+MAGIC = 'SANARC01'
+FOOTER_MAGIC = 'SANAIDX1'
+VERSION = 1
+
+_header = struct.Struct('!8sII')
+_chunk_header = struct.Struct('!IIB')
+_index_entry = struct.Struct('!QQIIB32s')
+_footer = struct.Struct('!QIQII8s')
+
+
+class ArchiveError(Exception):
+    """ Archive is damaged, or not one. """
+
+
+Chunk = collections.namedtuple('Chunk', 'stream_offset file_offset stored raw codec checksum')
+
+
+def _pack_checksum(checksum):
+    return ('%064x' % checksum).decode('hex')
+
+
+def _unpack_checksum(buf):
+    return int(buf.encode('hex'), 16)
+
+
+class ArchiveWriter(object):
+    """ Writes an archive to @path, taking the stream through write().
+
+    Chunks are @chunk_size raw bytes, compressed with @codec_name (None for
+    none) where that pays off, by @workers pool workers. @meta goes into the
+    archive's metadata. @stream_offset is where in the stream the first byte
+    written falls, for archives holding only part of one (see seed).
+    """
+
+    checksum_name = 'sha256'
+
+    def __init__(self, path, chunk_size=4 * 1024 * 1024, codec_name=None, workers=0,
+                 meta=None, stream_offset=0):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.meta = dict(meta or {})
+        self.stream_offset = stream_offset
+        self.chunks = []
+        self.size = 0
+
+        self._compressor = None
+        codec = get_codec(codec_name)
+        if codec:
+            self._compressor = AdaptiveCompressor(
+                codec,
+                sample_every=backup_conf['compress_sample_every'],
+                min_ratio=backup_conf['compress_min_ratio'])
+        self._stage = OrderedStage(workers=workers, kind=backup_conf['pipeline_kind'])
+        self._buf = bytearray()
+        self._next_offset = stream_offset
+        self._partial = path + '.partial'
+        self._f = io.open(self._partial, 'wb')
+        self._write(_header.pack(MAGIC, VERSION, chunk_size))
+
+    def __repr__(self):
+        return '<%s %s chunks=%d size=%d>' % (self.__class__.__name__, self.path,
+                                             len(self.chunks), self.size)
+
+    @property
+    def bytes_in(self):
+        """ Stream bytes taken so far. """
+        return self._next_offset + len(self._buf) - self.stream_offset
+
+    def _write(self, data):
+        self._f.write(data)
+        self.size += len(data)
+
+    def write(self, data):
+        """ Takes the next @data of the stream. """
+        data = memoryview(data)
+        while len(data):
+            take = min(self.chunk_size - len(self._buf), len(data))
+            self._buf += data[:take]
+            data = data[take:]
+            if len(self._buf) == self.chunk_size:
+                self._submit()
+
+    def _submit(self):
+        buf, self._buf = bytes(self._buf), bytearray()
+        codec_name = None
+        if self._compressor and self._compressor.should_compress():
+            codec_name = self._compressor.codec.name
+        self._stage.submit(buf, (self._next_offset, buf), codec_name=codec_name,
+                           checksum_name=self.checksum_name)
+        self._next_offset += len(buf)
+        while self._stage.ready() or self._stage.full():
+            self._store(*self._stage.get())
+
+    def _store(self, result, context):
+        packed, seconds, checksum = result
+        stream_offset, buf = context
+        payload, codec_name = buf, None
+        if self._compressor:
+            payload, codec_name = self._compressor.account(buf, packed, seconds)
+        payload = to_bytes(payload)
+
+        chunk = Chunk(stream_offset, self.size, len(payload), len(buf),
+                      codec_ids[codec_name], checksum)
+        self._write(_chunk_header.pack(chunk.stored, chunk.raw, chunk.codec))
+        self._write(payload)
+        self.chunks.append(chunk)
+
+    def close(self):
+        """ Writes out what's left, the index and footer, and moves the
+        archive into place. Returns its size. """
+        if self._buf:
+            self._submit()
+        while self._stage.pending:
+            self._store(*self._stage.get())
+        self._stage.close()
+
+        self.meta.update(chunk_size=self.chunk_size, checksum=self.checksum_name,
+                         stream_offset=self.stream_offset, stream_size=self.bytes_in,
+                         closed=time.time())
+        meta = json.dumps(self.meta, sort_keys=True)
+        meta_offset = self.size
+        self._write(meta)
+
+        index = ''.join(_index_entry.pack(x.stream_offset, x.file_offset, x.stored, x.raw,
+                                          x.codec, _pack_checksum(x.checksum))
+                        for x in self.chunks)
+        index_offset = self.size
+        self._write(index)
+        self._write(_footer.pack(meta_offset, len(meta), index_offset, len(self.chunks),
+                                 zlib.crc32(index) & 0xffffffff, FOOTER_MAGIC))
+
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.rename(self._partial, self.path)
+        if self._compressor:
+            log.info('%s: Compression: %s', self, self._compressor)
+        return self.size
+
+    def abort(self):
+        """ Throws away what was written. """
+        self._stage.close()
+        try:
+            self._f.close()
+        except IOError:
+            # Likely what we're aborting over in the first place
+            pass
+        os.unlink(self._partial)
+
+
+class ArchiveReader(object):
+    """ Reads the archive at @path, checking its footer and index. """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        f = self._file()
+
+        magic, version, self.chunk_size = _header.unpack(f.read(_header.size))
+        if magic != MAGIC:
+            raise ArchiveError('%s is not an archive' % path)
+        if version > VERSION:
+            raise ArchiveError('%s is archive version %d, we only know %d' % (
+                path, version, VERSION))
+
+        f.seek(-_footer.size, os.SEEK_END)
+        footer = f.read(_footer.size)
+        if len(footer) < _footer.size:
+            raise ArchiveError('%s is truncated' % path)
+        meta_offset, meta_size, index_offset, count, index_crc, magic = _footer.unpack(footer)
+        if magic != FOOTER_MAGIC:
+            raise ArchiveError('%s has no index, the writer did not finish' % path)
+
+        f.seek(meta_offset)
+        self.meta = json.loads(f.read(meta_size))
+        f.seek(index_offset)
+        index = f.read(count * _index_entry.size)
+        if zlib.crc32(index) & 0xffffffff != index_crc:
+            raise ArchiveError('%s has a damaged index' % path)
+
+        self.chunks = []
+        for i in xrange(count):
+            entry = _index_entry.unpack_from(index, i * _index_entry.size)
+            self.chunks.append(Chunk(*(entry[:5] + (_unpack_checksum(entry[5]),))))
+        self._offsets = [x.stream_offset for x in self.chunks]
+
+    def __repr__(self):
+        return '<%s %s chunks=%d>' % (self.__class__.__name__, self.path, len(self.chunks))
+
+    @property
+    def stream_offset(self):
+        return self.meta['stream_offset']
+
+    @property
+    def stream_size(self):
+        return self.meta['stream_size']
+
+    def _file(self):
+        # A file each for the threads reading chunks in parallel
+        f = getattr(self._local, 'f', None)
+        if f is None:
+            f = self._local.f = io.open(self.path, 'rb')
+        return f
+
+    def _codec(self, name):
+        # Likewise codecs, whose contexts can't be shared
+        cache = getattr(self._local, 'codecs', None)
+        if cache is None:
+            cache = self._local.codecs = {}
+        if name not in cache:
+            cache[name] = get_codec(name)
+            if not cache[name]:
+                raise ArchiveError('Archive is compressed with %s, which is not available' % name)
+        return cache[name]
+
+    def file_range(self, i):
+        """ Returns (offset, length) in the file of chunk @i, header and all;
+        what to send again of a chunk that's bad in a copy. """
+        chunk = self.chunks[i]
+        return chunk.file_offset, _chunk_header.size + chunk.stored
+
+    def read_chunk(self, i):
+        """ Returns the raw data of chunk @i, checked against the index.
+        Raises ArchiveError if it's bad. """
+        chunk = self.chunks[i]
+        f = self._file()
+        f.seek(chunk.file_offset)
+        header = f.read(_chunk_header.size)
+        if len(header) < _chunk_header.size or \
+                _chunk_header.unpack(header) != (chunk.stored, chunk.raw, chunk.codec):
+            raise ArchiveError('Chunk %d has a bad header' % i)
+        data = f.read(chunk.stored)
+        codec_name = codec_names.get(chunk.codec)
+        try:
+            if codec_name:
+                data = self._codec(codec_name).decompress(data)
+        except Exception as e:
+            raise ArchiveError('Chunk %d does not decompress: %s' % (i, e))
+        if len(data) != chunk.raw or \
+                checksums[self.meta['checksum']](data) != chunk.checksum:
+            raise ArchiveError('Chunk %d fails its checksum' % i)
+        return data
+
+    def _check_chunk(self, i):
+        try:
+            self.read_chunk(i)
+        except ArchiveError as e:
+            return e
+
+    def verify(self, workers=4):
+        """ Checks every chunk, @workers at a time. Returns the indexes of
+        bad ones. """
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            errors = pool.map(self._check_chunk, xrange(len(self.chunks)))
+        finally:
+            pool.close()
+            pool.join()
+        bad = []
+        for i, error in enumerate(errors):
+            if error:
+                log.error('%s: %s', self, error)
+                bad.append(i)
+        return bad
+
+    def chunk_at(self, offset):
+        """ Returns the index of the chunk holding stream byte @offset. """
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        if i < 0 or offset >= self.stream_offset + self.stream_size:
+            raise ValueError('Byte %d is not in %s' % (offset, self))
+        return i
+
+    def read_from(self, offset=None, workers=2):
+        """ Yields the stream from byte @offset (the start) on, only
+        reading chunks from the one it's in. Up to @workers * 2 chunks are
+        read and decompressed ahead, by @workers threads; no more, whatever
+        the pace of the consumer. """
+        if offset is None:
+            offset = self.stream_offset
+        if offset == self.stream_offset + self.stream_size:
+            return
+        first = self.chunk_at(offset)
+        skip = offset - self.chunks[first].stream_offset
+        pool = multiprocessing.pool.ThreadPool(workers)
+        pending = collections.deque()
+        next_chunk = first
+        try:
+            while True:
+                while next_chunk < len(self.chunks) and len(pending) < workers * 2:
+                    pending.append(pool.apply_async(self.read_chunk, (next_chunk,)))
+                    next_chunk += 1
+                if not pending:
+                    break
+                data = pending.popleft().get()
+                if skip:
+                    data, skip = data[skip:], 0
+                yield data
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def copy_to(self, fd, offset=None):
+        """ Writes the stream from byte @offset on to file object @fd.
+        Returns bytes written. """
+        total = 0
+        for data in self.read_from(offset):
+            fd.write(data)
+            total += len(data)
+        fd.flush()
+        return total
+
+
+def archive_stream(cmd_send, path, meta=None, name=None):
+    """ Runs @cmd_send into an archive at @path, with @meta added to its
+    metadata. @name is what progress is published as. Returns the archive's
+    size, or None if the send failed and nothing was kept. """
+    meta = dict(meta or {}, cmd=cmd_send, created=time.time())
+    writer = ArchiveWriter(path,
+                           chunk_size=backup_conf['archive_chunk_size'],
+                           codec_name=backup_conf['archive_compression'],
+                           workers=backup_conf['pipeline_workers'],
+                           meta=meta)
+    return send_to(cmd_send, writer, name or path)
+
+
+def send_to(cmd_send, writer, name):
+    """ Runs @cmd_send into @writer (an ArchiveWriter, or anything with its
+    write(), close(), abort() and bytes_in), publishing progress as @name.
+    Returns what close() did, or None if the send failed and @writer was
+    aborted. """
+    log.info('Spawning send: %s', cmd_send)
+    psend = spawn(cmd_send, replication_priority(),
+                  stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE,
+                  )
+    progress = SendProgress(name)
+    psend_stderr_reader = AsynchronousFileLogger(psend.stderr, log, 'send_stderr',
+                                                 callback=progress.feed)
+    psend_stderr_reader.start()
+
+    reader = io.FileIO(psend.stdout.fileno(), 'rb', closefd=False)
+    buf = bytearray(backup_conf['bufsize'])
+    view = memoryview(buf)
+    start = time.time()
+    failed = False
+    try:
+        while True:
+            got = reader.readinto(buf)
+            if not got:
+                break
+            writer.write(view[:got])
+    except (IOError, OSError) as e:
+        log.error('Could not write to %s: %s', writer, e)
+        failed = True
+        psend.kill()
+
+    log.info('Closing send stdout')
+    psend.stdout.close()
+    psend_stderr_reader.join()
+    psend.wait()
+
+    ok = psend.returncode == 0 and not failed
+    progress.finish(ok, bytes=writer.bytes_in)
+    if not ok:
+        log.error('Send exited with %s, not keeping %s', psend.returncode, writer)
+        writer.abort()
+        return None
+
+    ret = writer.close()
+    elapsed = max(time.time() - start, 0.001)
+    log.info('Archived %d bytes to %s in %.2fs (%.1f MB/s)',
+             writer.bytes_in, writer, elapsed,
+             writer.bytes_in / elapsed / 1024 / 1024)
+    return ret
+
+
+def archive_snapshot(source, snapshot_name, path, base=None):
+    """ Archives snapshot @snapshot_name of Dataset @source to @path, as a
+    full stream or incremental from snap (or #bookmark) @base. """
+    if snapshot_name not in source.snaps:
+        raise ValueError('No snapshot %s@%s' % (source.name, snapshot_name))
+    flags = send_flags(source.name, backup_conf['archive_capabilities'])
+    cmd_send = send_cmd(source.name, flags, base, snapshot_name)
+    return archive_stream(cmd_send, path, name=source.name,
+                          meta=dict(dataset=source.name, snapshot=snapshot_name, base=base))
+
+
+def restore(path, dest_name):
+    """ Feeds the archive at @path to zfs receive into @dest_name. Returns
+    whether it took it. """
+    return receive_archives([ArchiveReader(path)], dest_name)
+
+
+def receive_archives(archives, dest_name, discard_pool=False):
+    """ Feeds ArchiveReaders @archives, which have to make up a whole stream
+    between them in order, to zfs receive into @dest_name. With
+    @discard_pool it's received as zfs receive -d does, under @dest_name by
+    its name less the pool, with missing parents created. Returns whether it
+    took it. """
+    offset = 0
+    for archive in archives:
+        if archive.stream_offset != offset:
+            raise ArchiveError('%s starts at byte %d of the stream, not %d' % (
+                archive, archive.stream_offset, offset))
+        offset += archive.stream_size
+
+    flags = receive_flags() + ('d' if discard_pool else '')
+    cmd_recv = ['/sbin/zfs', 'receive', flags, dest_name]
+    log.info('Spawning recv: %s', cmd_recv)
+    precv = spawn(cmd_recv, replication_priority(),
+                  stdin=subprocess.PIPE,
+                  stdout=subprocess.PIPE,
+                  stderr=subprocess.STDOUT,
+                  )
+    precv_stdout_reader = AsynchronousFileLogger(precv.stdout, log, 'recv_stdout')
+    precv_stdout_reader.start()
+    try:
+        for archive in archives:
+            log.info('Receiving %s', archive)
+            archive.copy_to(precv.stdin)
+    except ArchiveError as e:
+        # zfs receive -s keeps what it got; the same archive can't
+        # finish it though
+        log.error('%s: %s', archive, e)
+    except IOError as e:
+        log.error('Broken pipe on recv: %s', e)
+    finally:
+        precv.stdin.close()
+        precv_stdout_reader.join()
+        precv.wait()
+    if precv.returncode:
+        log.error('Receive exited with %s', precv.returncode)
+        return False
+    return True
+
+
+def main():
+    usage = ('Usage: %s send dataset snapshot path [base]\n'
+             '       %s verify path\n'
+             '       %s restore path dest_dataset') % ((sys.argv[0],) * 3)
+    args = sys.argv[1:]
+    if not args or args[0] not in ('send', 'verify', 'restore'):
+        print >> sys.stderr, usage
+        return 2
+
+    try:
+        if args[0] == 'send' and len(args) in (4, 5):
+            source = Dataset.from_local(args[1])
+            base = args[4] if len(args) == 5 else None
+            return 0 if archive_snapshot(source, args[2], args[3], base) else 1
+        if args[0] == 'verify' and len(args) == 2:
+            archive = ArchiveReader(args[1])
+            log.info('%s: %s', archive, archive.meta)
+            bad = archive.verify()
+            for i in bad:
+                print '%d\t%d\t%d' % ((i,) + archive.file_range(i))
+            return 1 if bad else 0
+        if args[0] == 'restore' and len(args) == 3:
+            return 0 if restore(args[1], args[2]) else 1
+    except (ValueError, ArchiveError) as e:
+        log.error('%s', e)
+        return 1
+    print >> sys.stderr, usage
+    return 2
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -35,12 +35,13 @@ class AsynchronousFileLogger(threading.Thread):
     in a separate thread. Logs read lines.
     '''
 
-    def __init__(self, fd, logger, log_prefix):
+    def __init__(self, fd, logger, log_prefix, callback=None):
         assert callable(fd.readline)
         threading.Thread.__init__(self)
         self._fd = fd
         self._logger = logger
         self._log_prefix = log_prefix
+        self._callback = callback
 
     def run(self):
         '''The body of the tread: read lines and put them on the queue.'''
@@ -50,6 +51,14 @@ class AsynchronousFileLogger(threading.Thread):
                               #repr(line),
                               line,
                               )
+            if self._callback:
+                # Keep draining whatever happens, or the process blocks on
+                # a full pipe
+                try:
+                    self._callback(line)
+                except Exception:
+                    self._logger.exception('%s: Callback failed on %s',
+                                           self._log_prefix, repr(line))
 
     def eof(self):
         '''Check whether there is no more content to expect.'''
@@ -0,0 +1,180 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import time
+import collections
+import zmq
+
+from .flow import recv_reply
+
+
+"""
+Link autotuning.
+
+What's in flight is capped by the credit window (see flow), so on a high
+latency link a window sized for the LAN caps throughput at
+window * chunk_size / RTT however fat the pipe is. To keep the pipe full the
+window has to cover the link's bandwidth-delay product (BDP).
+
+A sender probes the link when a session opens: a few empty pings for RTT,
+then a short burst of chunk sized ones for throughput. That gives the
+initial chunk size and window. While streaming, RTT is sampled from chunk
+acknowledgements and throughput from acknowledged bytes, and the window is
+re-sized every so often. Acknowledged throughput can't go above what the
+window allows, so whenever the sender ran out of credit since the last look
+the window is grown past the estimate to find out whether the link would
+take more.
+"""
+
+
+def configure_socket(sock, buffer_size=None, hwm=None):
+    """ Sets kernel buffer sizes and high water marks on zmq socket @sock,
+    where given. Only applies to connections made after. """
+    for opt, value in ((zmq.SNDBUF, buffer_size), (zmq.RCVBUF, buffer_size),
+                       (zmq.SNDHWM, hwm), (zmq.RCVHWM, hwm)):
+        if value:
+            sock.setsockopt(opt, value)
+
+
+def probe(sock, session_id, window, chunk_size, size, timeout=None, pings=3):
+    """ Measures the link behind @sock with pings in session @session_id:
+    @pings empty ones, then @size bytes worth of @chunk_size ones back to
+    back. Control messages showing up meanwhile are applied to @window.
+    Returns (RTT in seconds, bytes per second). """
+    def ping(token, payload=''):
+        sock.send_multipart(['srv', 'receive_ping', session_id, str(token), payload],
+                            copy=False)
+
+    rtt = None
+    for i in xrange(pings):
+        start = time.time()
+        ping(i)
+        recv_reply(sock, 'pong', window, timeout=timeout)
+        elapsed = time.time() - start
+        rtt = elapsed if rtt is None else min(rtt, elapsed)
+
+    # Random so nothing along the way can compress it
+    payload = os.urandom(chunk_size)
+    count = max(1, size // chunk_size)
+    start = time.time()
+    for i in xrange(count):
+        ping(i, payload)
+    for i in xrange(count):
+        recv_reply(sock, 'pong', window, timeout=timeout)
+    elapsed = time.time() - start
+
+    # The last pong takes a round trip on top of moving the bytes
+    rate = count * chunk_size / max(elapsed - rtt, rtt / 2, 1e-6)
+    return rtt, rate
+
+
+def _clamp(value, low, high):
+    return max(low, min(value, high))
+
+
+def _round_pow2(value):
+    """ Returns the power of two nearest @value. """
+    ret = 1
+    while ret * 2 <= value:
+        ret *= 2
+    if value - ret > ret * 2 - value:
+        ret *= 2
+    return ret
+
+
+class Autotuner(object):
+    """ Picks a chunk size and credit window covering @headroom times the
+    link's BDP.
+
+    Chunks stay between @min_chunk and @max_chunk bytes, sized to have about
+    @ideal_window of them in flight; the window stays between @min_window and
+    @max_window chunks and @min_bytes to @max_bytes bytes. The window is only changed when
+    it's off by more than @slack (a fraction), so tuning isn't chattering at
+    the receiver.
+    """
+
+    def __init__(self, chunk_size, window, min_chunk=64 * 1024, max_chunk=1024 * 1024,
+                 min_window=16, max_window=4096, min_bytes=0, max_bytes=None,
+                 ideal_window=256,
+                 headroom=2.0, growth=1.5, slack=0.25, samples=8):
+        self.chunk_size = chunk_size
+        self.window = window
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.min_window = min_window
+        self.max_window = max_window
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.ideal_window = ideal_window
+        self.headroom = headroom
+        self.growth = growth
+        self.slack = slack
+
+        self.rtt = None
+        # Best of the last few intervals, so one slow one doesn't shrink the
+        # window right away
+        self.rates = collections.deque(maxlen=samples)
+
+    def __repr__(self):
+        return '<%s rtt=%s rate=%s bdp=%s chunk_size=%d window=%d>' % (
+            self.__class__.__name__,
+            '%.1fms' % (self.rtt * 1000) if self.rtt is not None else None,
+            '%.1fMB/s' % (self.rate / 1024 / 1024) if self.rate is not None else None,
+            '%dKB' % (self.bdp / 1024) if self.bdp is not None else None,
+            self.chunk_size, self.window)
+
+    @property
+    def rate(self):
+        if not self.rates:
+            return None
+        return max(self.rates)
+
+    @property
+    def bdp(self):
+        if self.rtt is None or self.rate is None:
+            return None
+        return self.rtt * self.rate
+
+    def probed(self, rtt, rate):
+        self.sample_rtt(rtt)
+        self.rates.append(rate)
+
+    def sample_rtt(self, rtt):
+        # Queueing only ever adds to it, the smallest seen is the link's
+        if self.rtt is None or rtt < self.rtt:
+            self.rtt = rtt
+
+    def sample_rate(self, acked, elapsed):
+        """ @acked bytes were acknowledged in the last @elapsed seconds. """
+        if elapsed > 0 and acked:
+            self.rates.append(acked / elapsed)
+
+    def tune(self, window_limited=False):
+        """ Re-sizes chunks and window to the current estimate; grows them
+        past it if @window_limited, ie we ran out of credit. Returns whether
+        anything changed. """
+        if self.bdp is None:
+            return False
+        target = self.bdp * self.headroom
+        if window_limited:
+            target = max(target, self.window * self.chunk_size * self.growth)
+        target = max(target, self.min_bytes)
+        if self.max_bytes:
+            target = min(target, self.max_bytes)
+
+        # Chunk size only moves once it's a factor of two off, so it doesn't
+        # flip back and forth on a boundary
+        chunk_size = self.chunk_size
+        ideal = target / self.ideal_window
+        if not chunk_size / 2 <= ideal <= chunk_size * 2:
+            chunk_size = _clamp(_round_pow2(ideal), self.min_chunk, self.max_chunk)
+        window = int(_clamp(-(-target // chunk_size), self.min_window, self.max_window))
+
+        if chunk_size == self.chunk_size and \
+                abs(window - self.window) <= self.window * self.slack:
+            return False
+        self.chunk_size = int(chunk_size)
+        self.window = window
+        return True
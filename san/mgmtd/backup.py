@@ -8,13 +8,405 @@ log = logging.getLogger(__name__)
 from san.storage import ZPool, ZDataset, ZFilesystem, ZVolume, ZSnapshot
 
 #from datetime import datetime, timedelta
-#import time
+import time
 import re
 import collections
 import subprocess
 #import zmq
 
 from .async_file_reader import AsynchronousFileLogger
+from .metrics import metrics
+from .capabilities import negotiate, receive_capabilities
+from .shaping import Shaper
+from .priority import Priority, spawn
+from .progress import SendProgress
+from . import pipes
+from . import syscalls
+
+
+backup_conf = dict(
+    # How local sends move data from zfs send to zfs receive; 'splice' keeps
+    # the payload in the kernel, 'copy' goes through a userspace buffer and
+    # 'buffer' goes through a threaded ring buffer (see below).
+    transfer='splice',
+    bufsize=1024 * 1024,
+
+    # Payload size of each receive_data message on the wire. Chunks are sent
+    # zero-copy straight out of the ring buffer.
+    chunk_size=128 * 1024,
+
+    # Chunks the receiver lets a sender have in flight, how many it re-grants
+    # at once, and how long a sender waits on a silent receiver; see flow.
+    credit_window=256,
+    credit_batch=64,
+    credit_timeout=300,
+
+    # Size chunks and the credit window to each link's bandwidth-delay
+    # product (see autotune), so high latency links get filled without hand
+    # tuning. chunk_size and credit_window are then only where a session
+    # starts: a probe of autotune_probe_bytes when it opens sizes them, and
+    # they're re-sized every autotune_interval seconds after that. In flight
+    # is kept within credit_window_max chunks and half of buffer_size.
+    autotune=True,
+    autotune_probe_bytes=4 * 1024 * 1024,
+    autotune_interval=2,
+    chunk_size_min=64 * 1024,
+    chunk_size_max=1024 * 1024,
+    credit_window_max=4096,
+
+    # Receive side gathers chunks into a single writev to zfs receive until
+    # it has this many bytes or the oldest has waited this many seconds.
+    coalesce_bytes=4 * 1024 * 1024,
+    coalesce_delay=0.05,
+
+    # Optional wire compression (lz4, zstd or zlib). Every
+    # compress_sample_every chunks it's checked whether compression still
+    # gets chunks below compress_min_ratio of their size; if not it is
+    # switched off until a sample says otherwise.
+    compression=None,
+    compress_sample_every=64,
+    compress_min_ratio=0.9,
+
+    # Workers compressing/checksumming chunks off the sender's main thread,
+    # as 'thread's (fine for codecs that drop the GIL) or 'process'es.
+    pipeline_workers=4,
+    pipeline_kind='thread',
+
+    # Ring buffer between zfs send and the consumer (zfs receive or the wire),
+    # watermarks are fractions of buffer_size; see RingBuffer.
+    buffer_size=256 * 1024 * 1024,
+    buffer_high_watermark=0.9,
+    buffer_low_watermark=0.1,
+
+    # Received datasets land under here, named like zfs receive -d would.
+    dest_root='dpool/dest',
+
+    # Receive sessions that hear nothing from their sender for this many
+    # seconds are torn down.
+    session_timeout=300,
+
+    # Where the receive server listens. With receive_workers set, sessions
+    # are spread over that many worker processes behind a broker, which
+    # talks to them over receive_backend.
+    receive_bind='tcp://0.0.0.0:4243',
+    receive_workers=0,
+    receive_backend='ipc:///tmp/solarsan-receive-backend',
+
+    # The receive server also takes plain byte streams (see transport) on
+    # these addresses, each spliced straight into a zfs receive, eg
+    # 'raw+tcp://0.0.0.0:4245' or 'unix:///var/run/solarsan-receive.sock'.
+    stream_bind=[],
+
+    # Kernel send/receive buffer size for replication sockets, zmq or not.
+    # None leaves it to the kernel's TCP autotuning, which setting it
+    # switches off.
+    socket_buffer=None,
+
+    # ZMQ high water marks (in messages) on replication sockets. Has to stay
+    # above credit_window_max, so credit is all that limits what's in flight.
+    socket_hwm=2 * 4096,
+
+    # Where backup_cli replicates to, as (BackupRPC address, receive_bind
+    # address) pairs. The receive address picks the transport: zmq ones
+    # (tcp://) go through receive_bind, raw+tcp:// and unix:// ones through
+    # stream_bind. Destinations needing the same stream share a single
+    # zfs send, each with its own buffer and flow control; one that stays
+    # more than half a buffer behind the fastest for fanout_stall_timeout
+    # seconds, ie one holding the others back, is dropped and caught up on
+    # its own afterwards.
+    destinations=[('tcp://localhost:4242', 'tcp://localhost:4243')],
+    fanout_stall_timeout=30,
+
+    # Receive sessions are also passed on to the receive server here as they
+    # come in (A -> B -> C), None to not relay. The sender gets no more
+    # credit while the next hop is relay_max_backlog chunks behind (default
+    # credit_window).
+    relay_to=None,
+    relay_max_backlog=None,
+
+    # Receive with -s, so an interrupted stream leaves a resume token on the
+    # destination and the next send picks up where it left off instead of
+    # starting over.
+    resumable=True,
+
+    # Optional send stream features (compressed, large_blocks, embedded, raw;
+    # see capabilities) datasets may use when both ends support them, None
+    # for all of them. dataset_send_capabilities overrides this per source
+    # dataset name.
+    send_capabilities=None,
+    dataset_send_capabilities={},
+
+    # Destinations that are behind get every snapshot they need, in batches
+    # of zfs send -I streams spanning at most catchup_max_chain source
+    # snapshots each. Without catchup only the newest one needed is sent.
+    catchup=True,
+    catchup_max_chain=64,
+
+    # Bookmark every snapshot sent, so it can still be sent incrementally from
+    # after snapper has pruned the snapshot itself from the source. Only the
+    # newest bookmarks_keep of a dataset are kept, the rest destroyed as new
+    # ones are made; enough to cover the furthest a destination may fall
+    # behind, a seed in transit included (see seed). None keeps them all.
+    bookmarks=True,
+    bookmarks_keep=64,
+
+    # Send bandwidth limits in bytes a second, None for unlimited; for all
+    # sends of a process put together and for each on its own. Windows in
+    # shaping_schedule override them by time of day, as (days, start, end,
+    # global limit, session limit), ie
+    #   ('mon-fri', '08:00', '18:00', 200 * 1024 * 1024, None)
+    # backup_cli takes runtime overrides over RPC on shaping_bind, None to
+    # not listen; see shaping.
+    shaping_global=None,
+    shaping_session=None,
+    shaping_schedule=[],
+    shaping_bind='tcp://127.0.0.1:4246',
+
+    # Have backup_cli walk the zfs send stream as it goes out (see drr):
+    # per record type and per object stats, and a stream that's malformed
+    # or, with verify_stream_checksums, fails its checksums is aborted
+    # before the bad part reaches the receiver. Costs the splice fast path
+    # of raw+tcp:// and unix:// destinations.
+    parse_stream=False,
+    verify_stream_checksums=True,
+
+    # zfs send streams archived to files (see archive) are cut into chunks of
+    # archive_chunk_size bytes, compressed with archive_compression (None for
+    # not at all) where it pays off. Archives are sent with the optional
+    # stream features (see capabilities) in archive_capabilities only, as
+    # whatever they're restored into has to take them.
+    archive_chunk_size=4 * 1024 * 1024,
+    archive_compression=None,
+    archive_capabilities=[],
+
+    # Seeds (see seed), full sends carried to the destination on a disk, are
+    # split into archives of seed_part_size stream bytes each; kept under
+    # 4GB for FAT formatted disks.
+    seed_part_size=2 * 1024 * 1024 * 1024,
+
+    # backup_cli logs progress of its sends, and publishes it as JSON on a
+    # zmq PUB socket here unless None; see progress.
+    progress_bind=None,
+
+    # How the zfs send and receive processes we spawn are scheduled, so
+    # replication doesn't starve the LUNs we export; see priority.Priority
+    # for the keys (ionice, ionice_level, nice, cgroup, io_weight, io_max),
+    # None to leave them be. cgroup is relative to cgroup_root.
+    replication_priority=dict(
+        ionice='best_effort',
+        ionice_level=7,
+        nice=10,
+    ),
+    cgroup_root='/sys/fs/cgroup',
+)
+
+
+shaper = Shaper(backup_conf)
+
+
+def replication_priority():
+    """ Returns the Priority to spawn zfs send/receive with, or None. """
+    return Priority.from_conf(backup_conf['replication_priority'],
+                              cgroup_root=backup_conf['cgroup_root'])
+
+
+def dest_name_for(name, dest_root=None):
+    """ Returns the dataset @name from a source box is received into, under
+    @dest_root (dest_root). """
+    return '%s/%s' % (dest_root or backup_conf['dest_root'], name.split('/', 1)[-1])
+
+
+def receive_flags():
+    """ Flags common to every zfs receive we spawn. """
+    flags = '-vFu'
+    if backup_conf['resumable']:
+        flags += 's'
+    return flags
+
+
+def send_flags(name, receiver_capabilities):
+    """ Returns the flags to zfs send source dataset @name with, to a
+    receiver taking @receiver_capabilities. """
+    allowed = backup_conf['dataset_send_capabilities'].get(
+        name, backup_conf['send_capabilities'])
+    return '-pPv' + negotiate(name, receiver_capabilities or (), allowed)
+
+
+def send_cmd(name, flags, from_snap, to_snap, intermediates=False):
+    """ Returns the zfs send command for snapshot @to_snap of @name,
+    incremental from @from_snap (a snap, or #bookmark) if given. With
+    @intermediates every snapshot in between goes along (-I). """
+    cmd = ['/sbin/zfs', 'send', flags]
+    if from_snap:
+        if from_snap.startswith('#'):
+            # -I can't start from a bookmark
+            cmd.extend(['-i', from_snap])
+        else:
+            cmd.extend(['-I' if intermediates else '-i', '@%s' % from_snap])
+    cmd.append('%s@%s' % (name, to_snap))
+    return cmd
+
+
+def plan_catchup(source, needed, base):
+    """ Plans bringing a destination that has @base (the latest snapshot it
+    has in common with Dataset @source, or #name if the source only has a
+    bookmark of it left; None for nothing in common) up to date with the
+    @needed snapshots of @source.
+    Returns the steps as a list of (from snap/#bookmark or None, to snap). """
+    if base:
+        base_pos = source.position(base)
+        needed = [x for x in needed if source.position(x) > base_pos]
+    needed = source.order_snaps(needed)
+    if not needed:
+        return []
+    if not backup_conf['catchup']:
+        return [(base, needed[-1])]
+
+    max_chain = backup_conf['catchup_max_chain']
+    steps = []
+    if not base or base.startswith('#'):
+        # Need a snapshot to build on first
+        steps.append((base, needed[0]))
+        base = needed.pop(0)
+    while needed:
+        base_idx = source.snaps.index(base)
+        # Furthest needed snap within reach, or the next one if none are
+        batch = [x for x in needed
+                 if source.snaps.index(x) - base_idx <= max_chain] or needed[:1]
+        steps.append((base, batch[-1]))
+        needed = needed[len(batch):]
+        base = batch[-1]
+
+    log.info('Catching up %s to %s in %d streams', source.name, base, len(steps))
+    return steps
+
+
+def create_bookmark(snapshot):
+    """ Bookmarks local @snapshot (pool/fs@snap) as pool/fs#snap. """
+    name, snap = snapshot.split('@', 1)
+    cmd = ['/sbin/zfs', 'bookmark', snapshot, '%s#%s' % (name, snap)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode and 'exists' not in out:
+        log.warning('Could not bookmark %s: %s', snapshot, out.strip())
+        return False
+    return True
+
+
+def prune_bookmarks(name, keep):
+    """ Destroys all but the newest @keep bookmarks of local dataset @name. """
+    history = list_history(name)
+    bookmarks = sorted((x for x in history if x.startswith('#')), key=history.get)
+    for bookmark in bookmarks[:max(0, len(bookmarks) - keep)]:
+        cmd = ['/sbin/zfs', 'destroy', name + bookmark]
+        log.info('Pruning bookmark: %s', cmd)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+        if proc.returncode:
+            log.warning('Could not destroy %s%s: %s', name, bookmark, out.strip())
+
+
+def bookmark_sent(cmd_send):
+    """ Bookmarks the snapshot zfs send command @cmd_send sent, then prunes
+    the old ones. """
+    if not backup_conf['bookmarks']:
+        return
+    snapshot = cmd_send[-1]
+    if '@' not in snapshot:
+        # Resumed from a token; the next stream sent gets bookmarked instead
+        return
+    if create_bookmark(snapshot) and backup_conf['bookmarks_keep'] is not None:
+        prune_bookmarks(snapshot.split('@', 1)[0], backup_conf['bookmarks_keep'])
+
+
+def list_history(name):
+    """ Returns {snap: createtxg, '#bookmark': createtxg} for local dataset
+    @name. """
+    cmd = ['/sbin/zfs', 'list', '-H', '-p', '-o', 'name,createtxg',
+           '-t', 'snapshot,bookmark', '-d', '1', name]
+    try:
+        out = subprocess.check_output(cmd)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.error('Could not list snapshots and bookmarks of %s: %s', name, e)
+        return {}
+    ret = {}
+    for line in out.splitlines():
+        full_name, _, txg = line.partition('\t')
+        if '#' in full_name:
+            key = '#' + full_name.split('#', 1)[1]
+        else:
+            key = full_name.split('@', 1)[1]
+        ret[key] = int(txg)
+    return ret
+
+
+def get_resume_token(name):
+    """ Returns the receive_resume_token an interrupted zfs receive -s left
+    on local dataset @name, or None. """
+    cmd = ['/sbin/zfs', 'get', '-H', '-o', 'value', 'receive_resume_token', name]
+    try:
+        token = subprocess.check_output(cmd, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        # Most likely the dataset isn't there (yet)
+        return None
+    if not token or token == '-':
+        return None
+    return token
+
+
+def abort_resumable_receive(name):
+    """ Throws away the partially received state on local dataset @name. """
+    cmd = ['/sbin/zfs', 'receive', '-A', name]
+    log.info('Aborting partial receive: %s', cmd)
+    return subprocess.call(cmd) == 0
+
+
+_resume_field = re.compile(r'^\s*(\w+) = (.*)$')
+
+
+def describe_resume_token(token):
+    """ Decodes @token with zfs send -nvPt. Returns a dict of its contents,
+    with bytes (already received) and toname (snapshot being sent) as ints and
+    strs, plus size (estimated bytes left), or None if @token is no good here;
+    ie the snapshot it was for has since been destroyed. """
+    cmd = ['/sbin/zfs', 'send', '-nvPt', token]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode:
+        log.warning('Resume token is not usable: %s', out.strip())
+        return None
+
+    ret = dict(bytes=0, size=None)
+    for line in out.splitlines():
+        m = _resume_field.match(line)
+        if m:
+            key, value = m.groups()
+            if value.startswith('0x'):
+                value = int(value, 16)
+            ret[key] = value
+        elif line.startswith('size\t'):
+            ret['size'] = int(line.split('\t')[1])
+    return ret
+
+
+def resume_send_cmd(token, metric_prefix):
+    """ Returns a zfs send command that picks up the stream @token was left
+    by, or None if it can't be resumed. """
+    info = describe_resume_token(token)
+    if not info:
+        return None
+    log.info('Resuming send of %s at byte %d, %s bytes left',
+             info.get('toname'), info['bytes'], info['size'])
+    metrics.incr('%s.resumes' % metric_prefix)
+    metrics.set('%s.resumed_bytes' % metric_prefix, info['bytes'])
+    return ['/sbin/zfs', 'send', '-Pv', '-t', token]
+
+
+def ring_buffer_kwargs(name):
+    return dict(size=backup_conf['buffer_size'],
+                high_watermark=backup_conf['buffer_high_watermark'],
+                low_watermark=backup_conf['buffer_low_watermark'],
+                name=name)
 
 
 class Dataset(object):
@@ -22,6 +414,8 @@ class Dataset(object):
     def __init__(self):
         self.name = None
         self.snaps = list()
+        self.bookmarks = list()
+        self.txgs = dict()
 
     @classmethod
     def from_local(cls, name):
@@ -32,6 +426,9 @@ class Dataset(object):
         if self.exists:
             snaps = self.zdataset.iter_snapshots_sorted(objectify=False)
             self.snaps = [x.split('@')[1] for x in snaps]
+            self.txgs = list_history(name)
+            self.bookmarks = sorted((x[1:] for x in self.txgs if x.startswith('#')),
+                                    key=lambda x: self.txgs['#' + x])
         return self
 
     @classmethod
@@ -57,6 +454,21 @@ class Dataset(object):
         if top:
             return top[0][0]
 
+    def position(self, name):
+        """ Where snap or #bookmark @name falls in the dataset's history. """
+        if self.txgs:
+            return self.txgs[name]
+        return self.snaps.index(name)
+
+    def find_latest_base_in(self, snaps):
+        """ Returns the latest of @snaps we can send incrementally from; the
+        snap, or #snap if only its bookmark is left. """
+        bases = [x for x in snaps if x in self.snaps]
+        bases.extend('#' + x for x in snaps
+                     if x in self.bookmarks and x not in self.snaps)
+        if bases:
+            return max(bases, key=self.position)
+
 
 class DatasetSet(object):
 
@@ -97,14 +509,50 @@ class DatasetSet(object):
         return snaps
 
     def send_latest_snap_needed_by_dest(self):
-        snaps = self.snaps_needed_by_dest()
-        latest_snap = self.source.find_latest_snap_in(snaps)
-        if latest_snap:
-            return self.send(latest_snap)
-        else:
+        cmd_send = self.resume_send_cmd()
+        if cmd_send:
+            if self.run_send(cmd_send) is None:
+                return
+            # Have more snaps now
+            self.dest = Dataset.from_local(self.dest.name)
+
+        cmds = self.plan_catchup()
+        if not cmds:
             log.info('Up to date! =)')
+            return
 
-    def send(self, snapshot_name):
+        sent = 0
+        for cmd_send in cmds:
+            ret = self.run_send(cmd_send)
+            if ret is None:
+                break
+            bookmark_sent(cmd_send)
+            sent += ret
+        return sent
+
+    def plan_catchup(self):
+        """ Returns the zfs send commands bringing dest up to date, in order. """
+        common = set(self.source.snaps + self.source.bookmarks) & set(self.dest.snaps)
+        base = self.source.find_latest_base_in(common)
+        steps = plan_catchup(self.source, self.snaps_needed_by_dest(), base)
+        flags = send_flags(self.source.name, receive_capabilities(self.dest.name))
+        return [send_cmd(self.source.name, flags, from_snap, to_snap,
+                         intermediates=backup_conf['catchup'])
+                for from_snap, to_snap in steps]
+
+    def resume_send_cmd(self):
+        """ Returns a command resuming an interrupted send into dest, if any. """
+        token = get_resume_token(self.dest.name)
+        if not token:
+            return None
+        cmd_send = resume_send_cmd(token, 'send.%s' % self.source.name)
+        if not cmd_send:
+            # Won't get any further with it, start over
+            abort_resumable_receive(self.dest.name)
+        return cmd_send
+
+    def plan_send(self, snapshot_name):
+        """ Returns the zfs send command bringing dest up to @snapshot_name. """
         log.info('Preparing for send of snapshot %s', snapshot_name)
         source_snapshot = self.source.zdataset.open_child_snapshot(snapshot_name)
         source_snapshot_index = self.source.snaps.index(snapshot_name)
@@ -124,55 +572,69 @@ class DatasetSet(object):
                 log.info('Source snapshot is previous to latest common snapshot')
                 return
 
-        bufsize = pbufsize = 4096
-
+        flags = send_flags(self.source.name, receive_capabilities(self.dest.name))
         if incremental:
-            cmd_send = ['/sbin/zfs', 'send', '-pPv', '-i', latest_common_snapshot_name, source_snapshot.name]
+            return ['/sbin/zfs', 'send', flags, '-i', latest_common_snapshot_name, source_snapshot.name]
         else:
-            cmd_send = ['/sbin/zfs', 'send', '-pPv', source_snapshot.name]
+            return ['/sbin/zfs', 'send', flags, source_snapshot.name]
+
+    def send(self, snapshot_name):
+        cmd_send = self.resume_send_cmd() or self.plan_send(snapshot_name)
+        if not cmd_send:
+            return
+        sent = self.run_send(cmd_send)
+        if sent is not None:
+            bookmark_sent(cmd_send)
+        return sent
+
+    def run_send(self, cmd_send):
+        """ Pipes @cmd_send into zfs receive on dest. Returns bytes sent, or
+        None if the receive failed. """
+        priority = replication_priority()
+
         log.info('Spawning send: %s', cmd_send)
-        psend = subprocess.Popen(cmd_send,
-                                 bufsize=pbufsize,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 )
-        psend_stderr_reader = AsynchronousFileLogger(psend.stderr, log, 'send_stderr')
+        psend = spawn(cmd_send, priority,
+                      stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE,
+                      )
+        progress = SendProgress(self.source.name)
+        psend_stderr_reader = AsynchronousFileLogger(psend.stderr, log, 'send_stderr',
+                                                     callback=progress.feed)
         psend_stderr_reader.start()
 
-        cmd_recv = ['/sbin/zfs', 'receive', '-vFu', self.dest.name]
+        cmd_recv = ['/sbin/zfs', 'receive', receive_flags(), self.dest.name]
         #cmd_recv = ['/sbin/zfs', 'receive', '-vFdu', self.dest.name]
         log.info('Spawning recv: %s', cmd_recv)
-        precv = subprocess.Popen(cmd_recv,
-                                 bufsize=pbufsize,
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 )
+        precv = spawn(cmd_recv, priority,
+                      stdin=subprocess.PIPE,
+                      stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE,
+                      )
+        # The stream moves between the two by fd, up to bufsize at a time;
+        # let either side get that far ahead
+        syscalls.set_pipe_size(psend.stdout.fileno(), backup_conf['bufsize'])
+        syscalls.set_pipe_size(precv.stdin.fileno(), backup_conf['bufsize'])
         precv_stdout_reader = AsynchronousFileLogger(precv.stdout, log, 'recv_stdout')
         precv_stdout_reader.start()
         precv_stderr_reader = AsynchronousFileLogger(precv.stderr, log, 'recv_stderr')
         precv_stderr_reader.start()
 
-        while True:
-            try:
-                buf = psend.stdout.read(bufsize)
-            except IOError:
-                log.error('Broken pipe on send')
-                break
-
-            if not buf:
-                log.info('Got NULL buf, breaking')
-                break
-
-            try:
-                precv.stdin.write(buf)
-                precv.stdin.flush()
-            except IOError:
-                log.error('Broken pipe on recv')
-                break
-
-            #log.info('Sleeping')
-            #time.sleep(1)
+        start = time.time()
+        ring_kwargs = {}
+        if backup_conf['transfer'] == 'buffer':
+            ring_kwargs = ring_buffer_kwargs('send.%s' % self.source.name)
+        shaping_name = 'send.%s.local' % self.source.name
+        try:
+            sent, mode = pipes.transfer(psend.stdout, precv.stdin,
+                                        mode=backup_conf['transfer'],
+                                        bufsize=backup_conf['bufsize'],
+                                        throttle=shaper.open(shaping_name),
+                                        **ring_kwargs)
+        finally:
+            shaper.close(shaping_name)
+        elapsed = max(time.time() - start, 0.001)
+        log.info('Moved %d bytes in %.2fs (%.1f MB/s) via %s',
+                 sent, elapsed, sent / elapsed / 1024 / 1024, mode)
 
         log.info('Closing send stdout')
         psend.stdout.close()
@@ -193,6 +655,12 @@ class DatasetSet(object):
         log.info('Waiting for procs to end')
         precv.wait()
         psend.wait()
+        progress.finish(not (psend.returncode or precv.returncode), bytes=sent)
+
+        if precv.returncode:
+            log.error('Receive exited with %s', precv.returncode)
+            return None
+        return sent
 
 
 def main():
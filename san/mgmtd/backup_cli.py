@@ -4,7 +4,14 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
+import os
+import socket
+import struct
 import subprocess
+import collections
+import itertools
+import threading
+import uuid
 import zerorpc
 import zmq
 import time
@@ -13,116 +20,570 @@ import time
 from san.storage import ZPool, ZDataset, ZFilesystem, ZVolume, ZSnapshot
 
 from .async_file_reader import AsynchronousFileLogger
-from .backup import Dataset, DatasetSet
+from .backup import Dataset, DatasetSet, backup_conf, ring_buffer_kwargs, \
+    resume_send_cmd, send_flags, send_cmd, plan_catchup, bookmark_sent, shaper, \
+    replication_priority
+from .ringbuffer import RingBuffer, RingBufferReader, RingBufferTee, RingBufferAborted
+from .flow import CreditWindow, FlowError, recv_reply, wait_for_credit, pump
+from .framing import pack_header, checksum_preference
+from .compress import AdaptiveCompressor, get_codec
+from .pipeline import OrderedStage
+from .metrics import metrics
+from .autotune import Autotuner, configure_socket, probe
+from .shaping import ShapingRPC
+from .priority import spawn
+from .progress import SendProgress, ProgressPublisher, bus, format_event
+from .drr import StreamParser
+from . import syscalls
+from .transport import TransportError, SocketWriter, get_transport, recv_line, send_line
+from . import pipes
 
 
-c = zerorpc.Client('tcp://localhost:4242')
-
 source = Dataset.from_local('dpool/tmp/omg')
 #ds = DatasetSet(source)
 
 
-def main():
-    log.info('Starting source dataset %s',
-             repr(source.name))
-
-    latest_snap_needed = c.find_latest_snap_needed(source.name, source.snaps)
-    if not latest_snap_needed:
-        log.info('No new snaps are needed, up to date. =)')
-        return
-
-    log.info('Latest snap needed by destination: %s',
-             repr(latest_snap_needed))
-
-    common_snaps = c.snaps_intersect(source.name, source.snaps)
-    latest_common_snap = source.find_latest_snap_in(common_snaps)
-    incremental = bool(latest_common_snap)
-
-    if incremental:
-        log.info('Incremental from %s to %s',
-                 repr(latest_common_snap),
-                 repr(latest_snap_needed))
-
-        # Check if we're trying to send a snapshot that's actually previous to
-        # the latest common snapshot.
-        latest_snap_needed_idx = source.snaps.index(latest_snap_needed)
-        latest_common_snap_idx = source.snaps.index(latest_common_snap)
-        if latest_common_snap_idx > latest_snap_needed_idx:
-            log.info('Source snapshot is previous to latest common snapshot')
+class Destination(object):
+    """ A box we replicate to, with its BackupRPC server at @rpc and its
+    receive server at @data. Streams go over zmq unless @data is a plain
+    stream transport address (see transport). """
+
+    def __init__(self, rpc, data):
+        self.rpc_address = rpc
+        self.data_address = data
+        self.name = data.split('://', 1)[-1]
+        self.c = zerorpc.Client(rpc)
+        self.rtr = None
+        self.transport = get_transport(data, buffer_size=backup_conf['socket_buffer'])
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+    @property
+    def metric_prefix(self):
+        return 'send.%s.%s' % (source.name, self.name)
+
+    @property
+    def session_class(self):
+        if self.transport:
+            return StreamSendSession
+        return SendSession
+
+    def connect(self):
+        """ Returns a ROUTER connected to the receiver. """
+        if self.rtr is not None:
+            return self.rtr
+
+        ctx = zmq.Context.instance()
+        rtr = ctx.socket(zmq.ROUTER)
+        # Receiver keys sessions on identity and session id, so both need to be
+        # unique for concurrent senders.
+        rtr.setsockopt(zmq.IDENTITY, '%s-%d' % (socket.gethostname(), os.getpid()))
+        # Error out instead of silently dropping if the receiver goes away
+        rtr.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        configure_socket(rtr, backup_conf['socket_buffer'], backup_conf['socket_hwm'])
+        rtr.connect(self.data_address)
+
+        # TODO Wait to ensure connectivity, temporary, really needs to be a loop
+        # around hello until timeout.
+        time.sleep(5)
+        self.rtr = rtr
+        return rtr
+
+    def close(self):
+        if self.rtr is not None:
+            self.rtr.close()
+            self.rtr = None
+
+    def resume_send(self):
+        """ Returns a zfs send command picking up an interrupted stream, if
+        this destination has one to resume. """
+        token = self.c.get_resume_token(source.name)
+        if not token:
+            return None
+        cmd_send = resume_send_cmd(token, self.metric_prefix)
+        if not cmd_send:
+            log.warning('%s: Could not resume receive of %s, starting over',
+                        self, source.name)
+            self.c.abort_resumable_receive(source.name)
+        return cmd_send
+
+    def plan_sends(self):
+        """ Returns the zfs send commands bringing this destination up to
+        date, in order; none if it already is. """
+        snaps_needed = self.c.find_snaps_needed(source.name, source.snaps)
+        if not snaps_needed:
+            log.info('%s: No new snaps are needed, up to date. =)', self)
+            return []
+
+        # Snaps pruned here may still have a bookmark to send from
+        common_snaps = self.c.snaps_intersect(source.name, source.snaps + source.bookmarks)
+        base = source.find_latest_base_in(common_snaps)
+        if base:
+            log.info('%s: Incremental from %s, %d snaps needed',
+                     self, repr(base), len(snaps_needed))
+        else:
+            log.info('%s: Full, %d snaps needed', self, len(snaps_needed))
+
+        steps = plan_catchup(source, snaps_needed, base)
+        flags = send_flags(source.name, self.c.receive_capabilities(source.name))
+        return [send_cmd(source.name, flags, from_snap, to_snap,
+                         intermediates=backup_conf['catchup'])
+                for from_snap, to_snap in steps]
+
+
+class Chunk(object):
+    __slots__ = ('seq', 'frames', 'tracker', 'size', 'sent')
+
+
+class SendSession(object):
+    """ Streams one zfs send to @dest in a receive session of its own, out of
+    a ring buffer someone else fills. """
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.rtr = dest.connect()
+        self.session_id = uuid.uuid4().hex
+        self.metric_prefix = dest.metric_prefix
+        self.ring = None
+        self.window = None
+        self.compressor = None
+        self.checksum_name = None
+        self.chunk_size = backup_conf['chunk_size']
+        self.tuner = None
+        self.throttle = None
+        self.bytes_sent = 0
+        self.ok = False
+
+        # Frames are sent straight out of the ring without copying; each
+        # chunk's space is only handed back to the producer once zmq is done
+        # with it and the receiver has acknowledged it, so unacknowledged
+        # chunks can be replayed from where they are. The credit window
+        # bounds how many that is.
+        self.inflight = collections.deque()
+        self.seqs = itertools.count()
+
+    def __repr__(self):
+        return '<%s %s/%s>' % (self.__class__.__name__,
+                               self.dest.name, self.session_id)
+
+    def open(self):
+        """ Says hello. Returns whether the receiver is up for a stream. """
+        self.rtr.send_multipart(['srv', 'receive_open', self.session_id, source.name,
+                                 ','.join(checksum_preference)])
+
+        # Expect hello response, which carries our initial credit
+        try:
+            buf = recv_reply(self.rtr, 'ok')
+        except FlowError as e:
+            log.error('%s: Did not get OK reply: %s', self, e)
+            return False
+        self.window = CreditWindow(int(buf[3]), on_nack=self._replay)
+        self.checksum_name = buf[5] if len(buf) > 5 and buf[5] else None
+
+        # Only compress with something the receiver says it can undo
+        receiver_codecs = buf[4].split(',') if len(buf) > 4 else []
+        codec_name = backup_conf['compression']
+        if codec_name and codec_name not in receiver_codecs:
+            log.warning('%s: Receiver does not support %s compression', self, codec_name)
+        elif codec_name:
+            codec = get_codec(codec_name)
+            if codec:
+                compressor = self.compressor = AdaptiveCompressor(
+                    codec,
+                    sample_every=backup_conf['compress_sample_every'],
+                    min_ratio=backup_conf['compress_min_ratio'])
+                metrics.gauge('%s.compress_ratio' % self.metric_prefix,
+                              lambda: compressor.stats.ratio)
+                metrics.gauge('%s.compress_seconds' % self.metric_prefix,
+                              lambda: compressor.stats.seconds)
+
+        if backup_conf['autotune']:
+            self._probe()
+
+        # Decouple zfs send from the wire so a stall on either side gets
+        # soaked up by the ring instead of stalling the other.
+        self.ring = RingBuffer(**ring_buffer_kwargs(self.metric_prefix))
+        self.throttle = shaper.open(self.metric_prefix)
+        return True
+
+    def _probe(self):
+        tuner = Autotuner(self.chunk_size, self.window.credits,
+                          min_chunk=backup_conf['chunk_size_min'],
+                          max_chunk=backup_conf['chunk_size_max'],
+                          max_window=backup_conf['credit_window_max'],
+                          # Receiver sits on up to coalesce_bytes before it
+                          # hands out more credit
+                          min_bytes=2 * backup_conf['coalesce_bytes'],
+                          max_bytes=backup_conf['buffer_size'] // 2,
+                          ideal_window=backup_conf['credit_window'])
+        try:
+            rtt, rate = probe(self.rtr, self.session_id, self.window, self.chunk_size,
+                              backup_conf['autotune_probe_bytes'],
+                              timeout=backup_conf['credit_timeout'])
+        except FlowError as e:
+            log.warning('%s: Could not probe link, not autotuning: %s', self, e)
+            return
+        tuner.probed(rtt, rate)
+        self.tuner = tuner
+        self._acked_bytes = 0
+        self._exhausted = self.window.exhausted
+        self._last_tune = time.time()
+        self._retune()
+
+        prefix = self.metric_prefix
+        metrics.gauge('%s.rtt' % prefix, lambda: tuner.rtt)
+        metrics.gauge('%s.rate' % prefix, lambda: tuner.rate)
+        metrics.gauge('%s.chunk_size' % prefix, lambda: tuner.chunk_size)
+        metrics.gauge('%s.window' % prefix, lambda: tuner.window)
+
+    def _retune(self):
+        tuner = self.tuner
+        now = time.time()
+        tuner.sample_rate(self._acked_bytes, now - self._last_tune)
+        window_limited = self.window.exhausted > self._exhausted
+        self._acked_bytes = 0
+        self._exhausted = self.window.exhausted
+        self._last_tune = now
+
+        if tuner.tune(window_limited):
+            log.info('%s: Tuned to %s', self, tuner)
+            self.chunk_size = tuner.chunk_size
+            self.rtr.send_multipart(['srv', 'receive_window', self.session_id,
+                                     str(tuner.window)])
+
+    def run_from(self, fd, inspector=None):
+        """ Sends everything read off @fd, ie zfs send's stdout, shown to
+        @inspector first if given (see RingBufferReader). """
+        reader = RingBufferReader(fd, self.ring, inspector)
+        reader.start()
+        self.run()
+        reader.join()
+
+    def _recycle(self, block=False):
+        inflight = self.inflight
+        while inflight and (block or (inflight[0].tracker.done and
+                                      inflight[0].seq <= self.window.acked)):
+            chunk = inflight.popleft()
+            chunk.tracker.wait()
+            self.ring.release(chunk.size)
+            if self.tuner and not block:
+                self.tuner.sample_rtt(time.time() - chunk.sent)
+                self._acked_bytes += chunk.size
+
+    def _replay(self, first, last):
+        log.warning('%s: Receiver wants chunks %d-%d again', self, first, last)
+        inflight = self.inflight
+        for seq in xrange(first, last + 1):
+            idx = seq - inflight[0].seq if inflight else -1
+            if not 0 <= idx < len(inflight):
+                raise FlowError('Chunk %d is no longer in the replay window' % seq)
+            chunk = inflight[idx]
+            chunk.tracker = self.rtr.send_multipart(chunk.frames, copy=False, track=True)
+            metrics.incr('%s.retransmits' % self.metric_prefix)
+
+    def _send_chunk(self, result, buf):
+        packed, seconds, checksum = result
+        payload, payload_codec = buf, None
+        if self.compressor:
+            payload, payload_codec = self.compressor.account(buf, packed, seconds)
+
+        chunk = Chunk()
+        chunk.seq = next(self.seqs)
+        chunk.size = len(buf)
+        # Sent time goes along for the receiving end(s) to measure lag with
+        chunk.frames = ['srv', 'receive_data', self.session_id,
+                        pack_header(chunk.seq, payload_codec, checksum),
+                        payload, repr(time.time())]
+
+        wait_for_credit(self.rtr, self.window, timeout=backup_conf['credit_timeout'])
+        self.window.take()
+        chunk.sent = time.time()
+        chunk.tracker = self.rtr.send_multipart(chunk.frames, copy=False, track=True)
+        self.inflight.append(chunk)
+        self.throttle(len(payload))
+
+    def _goodbye(self):
+        window = self.window
+
+        ## Say Goodbye
+        last_seq = self.inflight[-1].seq if self.inflight else window.acked
+        self.rtr.send_multipart(['srv', 'receive_close', self.session_id, str(last_seq)])
+
+        ## Expect response from Goodbye, replaying anything the receiver is
+        ## still missing in the meantime
+        try:
+            recv_reply(self.rtr, 'ok', window)
+            log.info('%s: Got OK from receive', self)
+            self.ok = True
+        except FlowError as e:
+            log.error('%s: Receive failed: %s', self, e)
+
+    def run(self):
+        """ Sends everything put in the ring until it's closed, then says
+        goodbye. Sets ok to whether the receiver took it all. """
+        rtr, ring, window = self.rtr, self.ring, self.window
+        interval = backup_conf['autotune_interval']
+
+        # Compression and checksums run in a pool so they aren't capped at one
+        # core; chunks come back out of it in order.
+        stage = OrderedStage(workers=backup_conf['pipeline_workers'],
+                             kind=backup_conf['pipeline_kind'])
+
+        error = None
+        while True:
+            try:
+                pump(rtr, window)
+                self._recycle()
+                if self.tuner and time.time() - self._last_tune >= interval:
+                    self._retune()
+
+                if not ring.available and stage.pending:
+                    self._send_chunk(*stage.get())
+                    continue
+
+                try:
+                    buf = ring.acquire(self.chunk_size, timeout=0.1)
+                except RingBufferAborted:
+                    # Producer gave up on us, ie we were dropped from a fan-out
+                    error = 'sender gave up'
+                    break
+
+                if buf is None:
+                    # Nothing new yet, go around again to pick up acks; the
+                    # ring may be full of chunks waiting on them.
+                    continue
+
+                if not buf:
+                    log.info('%s: Got NULL buf, breaking', self)
+                    # Flush what's still in the pool
+                    while stage.pending:
+                        self._send_chunk(*stage.get())
+                    break
+
+                codec_name = None
+                if self.compressor and self.compressor.should_compress():
+                    codec_name = self.compressor.codec.name
+                stage.submit(buf, buf, codec_name=codec_name,
+                             checksum_name=self.checksum_name)
+
+                while stage.ready() or stage.full():
+                    self._send_chunk(*stage.get())
+
+            except FlowError as e:
+                log.error('%s: %s', self, e)
+                error = str(e)
+                ring.abort()
+                break
+            except (IOError, zmq.ZMQError):
+                log.error('%s: Broken pipe on recv', self)
+                error = 'broken pipe'
+                ring.abort()
+                break
+
+        stage.close()
+        shaper.close(self.metric_prefix)
+
+        if error:
+            # Don't have the whole stream, so don't let zfs receive think it
+            # does; with -s it leaves what it got to be resumed.
+            try:
+                rtr.send_multipart(['srv', 'receive_abort', self.session_id, error])
+                recv_reply(rtr, 'error', window, timeout=backup_conf['credit_timeout'])
+            except (FlowError, zmq.ZMQError) as e:
+                log.error('%s: Could not abort receive: %s', self, e)
+        else:
+            self._goodbye()
+
+        self._recycle(block=True)
+        self.bytes_sent = ring.bytes_out
+        log.info('%s: Sent %d bytes, buffer stalls: producer=%d consumer=%d, '
+                 'credit exhausted %d times',
+                 self, ring.bytes_out, ring.producer_stalls, ring.consumer_stalls,
+                 window.exhausted)
+        if self.compressor:
+            log.info('%s: Compression: %s', self, self.compressor)
+
+
+class StreamSendSession(object):
+    """ Streams one zfs send to @dest over a plain byte stream transport (see
+    transport) rather than zmq. On its own zfs send's output is spliced
+    straight onto the socket; in a fan-out it goes out of a ring buffer
+    someone else fills. """
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.session_id = uuid.uuid4().hex
+        self.metric_prefix = dest.metric_prefix
+        self.sock = None
+        self.throttle = None
+        self.bytes_sent = 0
+        self.ok = False
+        self._ring = None
+
+    def __repr__(self):
+        return '<%s %s/%s>' % (self.__class__.__name__,
+                               self.dest.name, self.session_id)
+
+    @property
+    def ring(self):
+        # Only wanted for fan-outs, so only allocated for them
+        if self._ring is None:
+            self._ring = RingBuffer(**ring_buffer_kwargs(self.metric_prefix))
+        return self._ring
+
+    def open(self):
+        """ Connects and says hello. Returns whether the receiver is up for a
+        stream. """
+        try:
+            self.sock = self.dest.transport.connect(timeout=backup_conf['credit_timeout'])
+            send_line(self.sock, 'receive_open', self.session_id, source.name)
+            reply = recv_line(self.sock)
+        except (socket.error, TransportError) as e:
+            log.error('%s: Could not open: %s', self, e)
+            self._close()
+            return False
+        if reply[0] != 'ok':
+            log.error('%s: Did not get OK reply: %s', self, ' '.join(reply))
+            self._close()
+            return False
+        self.throttle = shaper.open(self.metric_prefix)
+        return True
+
+    def run_from(self, fd, inspector=None):
+        """ Sends everything read off @fd, ie zfs send's stdout. With an
+        @inspector (see RingBufferReader) it has to go through userspace, so
+        through the ring rather than spliced. """
+        if inspector:
+            reader = RingBufferReader(fd, self.ring, inspector)
+            reader.start()
+            self.run()
+            reader.join()
             return
-    else:
-        log.info('Full to %s',
-                 repr(latest_snap_needed))
-
-    ## Connect to ZMQ ROUTER
-
-    ctx = zmq.Context()
-    rtr = ctx.socket(zmq.ROUTER)
-    rtr.setsockopt(zmq.IDENTITY, 'cli')
-    rtr.connect('tcp://localhost:4243')
-
-    # TODO Wait to ensure connectivity, temporary, really needs to be a loop
-    # around hello until timeout.
-    time.sleep(5)
-
-    # Say Hello
-    rtr.send_multipart(['srv', 'receive_open', source.name])
 
-    # Expect hello response
-    buf = rtr.recv_multipart()
-    if buf[1] != 'ok':
-        log.error('Did not get OK reply')
-        return
+        ring_kwargs = {}
+        if backup_conf['transfer'] == 'buffer':
+            ring_kwargs = ring_buffer_kwargs(self.metric_prefix)
+        start = time.time()
+        try:
+            total, mode = pipes.transfer(fd, self.sock, mode=backup_conf['transfer'],
+                                         bufsize=backup_conf['bufsize'],
+                                         throttle=self.throttle,
+                                         **ring_kwargs)
+        except (IOError, OSError) as e:
+            log.error('%s: Broken pipe on send: %s', self, e)
+            self._abort()
+            return
+        elapsed = max(time.time() - start, 1e-9)
+        self.bytes_sent = total
+        log.info('%s: Sent %d bytes in %.2fs (%.1f MB/s) via %s', self,
+                 total, elapsed, total / elapsed / 1024 / 1024, mode)
+        self._goodbye()
+
+    def run(self):
+        """ Sends everything put in the ring until it's closed. """
+        ring = self.ring
+        try:
+            ring.drain_to(SocketWriter(self.sock), max_size=backup_conf['bufsize'],
+                          throttle=self.throttle)
+        except RingBufferAborted:
+            # Producer gave up on us, ie we were dropped from a fan-out
+            self._abort()
+            return
+        except socket.error as e:
+            log.error('%s: Broken pipe on send: %s', self, e)
+            ring.abort()
+            self._abort()
+            return
+        self.bytes_sent = ring.bytes_out
+        log.info('%s: Sent %d bytes, buffer stalls: producer=%d consumer=%d',
+                 self, ring.bytes_out, ring.producer_stalls, ring.consumer_stalls)
+        self._goodbye()
+
+    def _goodbye(self):
+        # EOF tells the receiver that was all of it; zfs receive then
+        # has its say.
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            reply = recv_line(self.sock)
+        except (socket.error, TransportError) as e:
+            reply = ['error', str(e)]
+        self._close()
+        if reply[0] == 'ok':
+            log.info('%s: Got OK from receive', self)
+            self.ok = True
+        else:
+            log.error('%s: Receive failed: %s', self, ' '.join(reply[1:]))
+
+    def _abort(self):
+        """ Resets the connection, so the receiver can't take a cut short
+        stream for the end of it. """
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                 struct.pack('ii', 1, 0))
+        except socket.error:
+            pass
+        self._close()
+
+    def _close(self):
+        if self.throttle:
+            shaper.close(self.metric_prefix)
+            self.throttle = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def stream(dests, cmd_send):
+    """ Runs @cmd_send once and streams its output to every one of @dests,
+    each in a session of its own. Returns the destinations that took it all. """
+    sessions = []
+    for dest in dests:
+        session = dest.session_class(dest)
+        if session.open():
+            sessions.append(session)
+    if not sessions:
+        return []
 
     ## Spawn up ZFS send
 
-    bufsize = pbufsize = 4096
-
-    if incremental:
-        cmd_send = ['/sbin/zfs', 'send', '-pPv', '-i',
-                    latest_common_snap,
-                    '%s@%s' % (source.name, latest_snap_needed),
-                    ]
-    else:
-        cmd_send = ['/sbin/zfs', 'send', '-pPv',
-                    '%s@%s' % (source.name, latest_snap_needed),
-                    ]
     log.info('Spawning send: %s', cmd_send)
-    psend = subprocess.Popen(cmd_send,
-                             bufsize=pbufsize,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             )
-    psend_stderr_reader = AsynchronousFileLogger(psend.stderr, log, 'send_stderr')
+    psend = spawn(cmd_send, replication_priority(),
+                  stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE,
+                  )
+    # stdout is only ever read by fd, in bufsize reads; let zfs send get
+    # that far ahead
+    syscalls.set_pipe_size(psend.stdout.fileno(), backup_conf['bufsize'])
+    progress = SendProgress(source.name)
+    psend_stderr_reader = AsynchronousFileLogger(psend.stderr, log, 'send_stderr',
+                                                 callback=progress.feed)
     psend_stderr_reader.start()
 
-    while True:
-        try:
-            buf = psend.stdout.read(bufsize)
-        except IOError:
-            log.error('Broken pipe on send')
-            break
-
-        if not buf:
-            log.info('Got NULL buf, breaking')
-            break
-
-        try:
-            rtr.send_multipart(['srv', 'receive_data', buf])
-        except IOError:
-            log.error('Broken pipe on recv')
-            break
-
-        #log.info('Sleeping')
-        #time.sleep(1)
-
-    ## Say Goodbye
-    rtr.send_multipart(['srv', 'receive_close'])
+    parser = None
+    if backup_conf['parse_stream']:
+        parser = StreamParser(verify_checksums=backup_conf['verify_stream_checksums'])
 
-    ## Expect response from Goodbye
-    buf = rtr.recv_multipart()
-    if buf[1] == 'ok':
-        log.info('Got OK from receive')
+    if len(sessions) == 1:
+        sessions[0].run_from(psend.stdout, parser)
+    else:
+        # Fan out: each destination gets its own copy of the stream, buffer
+        # and flow control. One that falls a whole buffer behind is dropped
+        # rather than holding the others up.
+        ring_reader = RingBufferTee(psend.stdout, [x.ring for x in sessions],
+                                    stall_timeout=backup_conf['fanout_stall_timeout'],
+                                    inspector=parser)
+        ring_reader.start()
+        threads = [threading.Thread(target=x.run, name=repr(x)) for x in sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for session in sessions:
+            if session.ring in ring_reader.dropped:
+                log.warning('%s: Fell behind, dropped from fan-out', session)
+                metrics.incr('%s.fanout_drops' % session.metric_prefix)
+        ring_reader.join()
 
     ## Cleanup
 
@@ -138,6 +599,90 @@ def main():
     log.info('Waiting for procs to end')
     psend.wait()
 
+    if parser and not parser.error:
+        log.info('Stream of %s: %s', source.name, parser.summary())
+        for name, (count, size) in parser.type_stats().iteritems():
+            metrics.incr('send.%s.records.%s' % (source.name, name), count)
+            metrics.incr('send.%s.record_bytes.%s' % (source.name, name), size)
+
+    done = [x.dest for x in sessions if x.ok]
+    progress.finish(psend.returncode == 0 and bool(done),
+                    bytes=max(x.bytes_sent for x in sessions))
+    return done
+
+
+def replicate(dests):
+    """ Brings @dests up to date. Destinations needing the same streams share
+    a single zfs send for each. Returns those that didn't make it. """
+    failed = []
+    groups = collections.OrderedDict()
+    for dest in dests:
+        cmd_send = dest.resume_send()
+        if cmd_send and not stream([dest], cmd_send):
+            failed.append(dest)
+            continue
+        cmds = dest.plan_sends()
+        if cmds:
+            groups.setdefault(tuple(tuple(x) for x in cmds), []).append(dest)
+
+    for cmds, group in groups.iteritems():
+        # One stream per batch of snapshots; whoever fails one stops there,
+        # the rest build on it.
+        for cmd_send in cmds:
+            cmd_send = list(cmd_send)
+            done = stream(group, cmd_send)
+            failed.extend(x for x in group if x not in done)
+            group = done
+            if not group:
+                break
+            bookmark_sent(cmd_send)
+
+    return failed
+
+
+def serve_shaping(bind):
+    """ Serves ShapingRPC on @bind from a thread of its own, so send limits
+    can be changed while streams run. The server is made in that thread too;
+    its sockets belong to the gevent hub of the thread that makes them. """
+    def serve():
+        try:
+            server = zerorpc.Server(ShapingRPC(shaper))
+            server.bind(bind)
+        except Exception:
+            log.exception('Could not serve send limits on %s', bind)
+            return
+        server.run()
+
+    thread = threading.Thread(target=serve, name='shaping_rpc')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def main():
+    log.info('Starting source dataset %s',
+             repr(source.name))
+
+    if backup_conf['shaping_bind']:
+        serve_shaping(backup_conf['shaping_bind'])
+
+    bus.subscribe(lambda event: log.info('Progress: %s', format_event(event)))
+    if backup_conf['progress_bind']:
+        bus.subscribe(ProgressPublisher(backup_conf['progress_bind']))
+
+    dests = [Destination(*x) for x in backup_conf['destinations']]
+    try:
+        failed = replicate(dests)
+
+        # Destinations dropped from a fan-out (or that failed otherwise) get
+        # one more go on their own, resuming where they left off.
+        for dest in failed:
+            log.info('%s: Catching up on its own', dest)
+            if replicate([dest]):
+                log.error('%s: Could not catch up', dest)
+    finally:
+        for dest in dests:
+            dest.close()
 
 
 if __name__ == '__main__':
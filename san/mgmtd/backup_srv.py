@@ -13,7 +13,11 @@ import zerorpc
 import zmq
 
 from .async_file_reader import AsynchronousFileLogger
-from .backup import Dataset, DatasetSet
+from .backup import Dataset, DatasetSet, dest_name_for, receive_flags, \
+    get_resume_token, abort_resumable_receive, replication_priority
+from .capabilities import receive_capabilities
+from .metrics import metrics
+from .priority import spawn
 
 
 class BackupRPC(object):
@@ -21,10 +25,8 @@ class BackupRPC(object):
         return Dataset.from_remote(name, snaps)
 
     def _get_dest(self, name):
-        # TODO Select dataset, secure this
-        #dataset = 'dpool/dest/%s' % dataset
-        #return ZDataset.open('dpool/dest')
-        return Dataset.from_local('dpool/dest')
+        # TODO Secure this
+        return Dataset.from_local(dest_name_for(name))
 
     def _get_ds(self, name, source_snaps):
         source = self._get_source(name, source_snaps)
@@ -39,33 +41,56 @@ class BackupRPC(object):
         latest_snap = ds.source.find_latest_snap_in(snaps)
         return latest_snap
 
+    def find_snaps_needed(self, name, source_snaps):
+        """ Returns the snaps in @source_snaps we want for @name. """
+        log.info('Finding snaps needed for dataset %s',
+                 repr(name))
+        ds = self._get_ds(name, source_snaps)
+        return list(ds.snaps_needed_by_dest())
+
+    def receive_capabilities(self, name):
+        """ Returns the optional send stream features (see capabilities) we
+        can receive @name with. """
+        return receive_capabilities(dest_name_for(name))
+
+    def get_resume_token(self, name):
+        """ Returns the token to resume an interrupted receive of @name with,
+        or None. """
+        token = get_resume_token(dest_name_for(name))
+        if token:
+            log.info('Receive of %s can be resumed', repr(name))
+        return token
+
+    def abort_resumable_receive(self, name):
+        """ Drops the partial state of an interrupted receive of @name, for
+        when its resume token is no good to the sender. """
+        return abort_resumable_receive(dest_name_for(name))
+
     def receive(self, name, from_snap, to_snap):
         dest = self._get_dest(name)
 
         bufsize = pbufsize = 4096
 
-        cmd_recv = ['/sbin/zfs', 'receive', '-vFu', dest.name]
+        cmd_recv = ['/sbin/zfs', 'receive', receive_flags(), dest.name]
         #cmd_recv = ['/sbin/zfs', 'receive', '-vFdu', self.dest.name]
         log.info('Spawning recv: %s', cmd_recv)
-        precv = subprocess.Popen(cmd_recv,
-                                 bufsize=pbufsize,
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 )
+        precv = spawn(cmd_recv, replication_priority(),
+                      bufsize=pbufsize,
+                      stdin=subprocess.PIPE,
+                      stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE,
+                      )
         precv_stdout_reader = AsynchronousFileLogger(precv.stdout, log, 'recv_stdout')
         precv_stdout_reader.start()
         precv_stderr_reader = AsynchronousFileLogger(precv.stderr, log, 'recv_stderr')
         precv_stderr_reader.start()
 
 
-    """ Development/Testing """
+    def metrics(self, prefix=''):
+        """ Returns replication counters and gauges, ie buffer fill levels. """
+        return metrics.snapshot(prefix)
 
-    def find_snaps_needed(self, name, source_snaps):
-        log.info('Finding snaps needed for dataset %s',
-                 repr(name))
-        ds = self._get_ds(name, source_snaps)
-        return list(ds.snaps_needed_by_dest())
+    """ Development/Testing """
 
     def test(self, *args, **kwargs):
         log.info('test: args=%s kwargs=%s', args, kwargs)
@@ -7,13 +7,33 @@ log = logging.getLogger(__name__)
 from san.storage import ZPool, ZDataset, ZFilesystem, ZVolume, ZSnapshot
 
 #import zmq
+import os
+import errno
+import signal
 import subprocess
 import zerorpc
 import zmq
 import time
+import struct
+import socket
+import threading
+import multiprocessing
 
 from .async_file_reader import AsynchronousFileLogger
-from .backup import Dataset, DatasetSet
+from .backup import Dataset, DatasetSet, backup_conf, dest_name_for, receive_flags, \
+    replication_priority, ring_buffer_kwargs
+from .flow import CreditGranter
+from .coalesce import WriteCoalescer
+from .compress import Decompressor, codecs
+from .metrics import metrics
+from .relay import Relay
+from .transport import TransportError, get_transport, recv_line, send_line
+from .autotune import configure_socket
+from .priority import spawn
+from . import pipes
+from . import syscalls
+from .framing import (checksums, pick_checksum, unpack_header,
+                      Reassembler, ReassemblyError)
 
 
 def receive(self, name, from_snap, to_snap):
@@ -50,82 +70,673 @@ def test(*args, **kwargs):
     log.info('test: args=%s kwargs=%s', args, kwargs)
 
 
-def main():
-    ctx = zmq.Context()
-    rtr = ctx.socket(zmq.ROUTER)
-    rtr.setsockopt(zmq.IDENTITY, 'srv')
-    #rtr.setsockopt(zmq.PROBE_ROUTER, 1)
-    rtr.bind('tcp://0.0.0.0:4243')
-
-    #dispatch = Dispatcher()
-    #dispatch.add_sock(rtr, test)
-    #dispatch.run()
-
-    while True:
-        buf = rtr.recv_multipart()
-        #log.info('got %s', repr(buf))
-        peer_id = buf[0]
-
-        log.info('Peer %s sent %s',
-                 repr(peer_id),
-                 repr(buf[1]))
-
-        if peer_id != 'cli':
-            continue
-
-        if buf[1] == 'receive_open':
-            #name = buf[2]
-            name = 'dpool/dest'
-
-            ## Spawn receive process
-
-            bufsize = pbufsize = 4096
-
-            cmd_recv = ['/sbin/zfs', 'receive', '-nvFu', name]
-            log.info('Spawning recv: %s', cmd_recv)
-            precv = subprocess.Popen(cmd_recv,
-                                        bufsize=pbufsize,
-                                        stdin=subprocess.PIPE,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
-                                        )
-            precv_stdout_reader = AsynchronousFileLogger(precv.stdout, log, 'recv_stdout')
-            precv_stdout_reader.start()
-            precv_stderr_reader = AsynchronousFileLogger(precv.stderr, log, 'recv_stderr')
-            precv_stderr_reader.start()
-
-            rtr.send_multipart([peer_id, 'ok'])
-
-        if buf[1] == 'receive_data':
+def spawn_receive(session):
+    """ Spawns the zfs receive for @session, as its precv, along with the
+    threads logging its output. """
+    ## Spawn receive process
+
+    # -d so any missing parents under dest_root get created for us
+    cmd_recv = ['/sbin/zfs', 'receive', receive_flags() + 'd', backup_conf['dest_root']]
+    log.info('%s: Spawning recv: %s', session, cmd_recv)
+    session.precv = spawn(cmd_recv, replication_priority(),
+                          stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          )
+    # stdin is only ever written by fd, up to coalesce_bytes at a time
+    syscalls.set_pipe_size(session.precv.stdin.fileno(), backup_conf['bufsize'])
+    session.precv_stdout_reader = AsynchronousFileLogger(session.precv.stdout, log, 'recv_stdout')
+    session.precv_stdout_reader.start()
+    session.precv_stderr_reader = AsynchronousFileLogger(session.precv.stderr, log, 'recv_stderr')
+    session.precv_stderr_reader.start()
+
+
+class ReceiveSession(object):
+    """ One replication stream from a sender into its own zfs receive. """
+
+    def __init__(self, server, peer_id, session_id, name, checksum_names=(),
+                 timeout=None):
+        self.server = server
+        self.peer_id = peer_id
+        self.session_id = session_id
+        self.name = name
+        self.checksum_name = pick_checksum(checksum_names)
+        self.dest_name = dest_name_for(name)
+        self.timeout = timeout or backup_conf['session_timeout']
+        self.last_activity = time.time()
+        self.precv = None
+        self.closed = False
+        self.returncode = None
+        self._on_exit = None
+        self.closing_seq = None
+        self.relay = None
+        self.held_credit = 0
+        self.held_ack = -1
+        self.lag = None
+        self.max_lag = 0.0
+
+    def __repr__(self):
+        return '<%s %s/%s %s>' % (self.__class__.__name__,
+                                  self.peer_id, self.session_id, self.name)
+
+    def reply(self, *frames):
+        self.server.send(self.peer_id, frames[0], self.session_id, *frames[1:])
+
+    def open(self):
+        spawn_receive(self)
+
+        self.coalescer = WriteCoalescer(self.precv.stdin,
+                                        max_bytes=backup_conf['coalesce_bytes'],
+                                        max_delay=backup_conf['coalesce_delay'])
+        self.granter = CreditGranter(backup_conf['credit_window'],
+                                     backup_conf['credit_batch'])
+        self.decompressor = Decompressor()
+        metrics.gauge('recv.%s.compress_ratio' % self.session_id,
+                      lambda: self.decompressor.stats.ratio)
+        metrics.gauge('recv.%s.decompress_seconds' % self.session_id,
+                      lambda: self.decompressor.stats.seconds)
+        self.reassembler = Reassembler(max_held=backup_conf['credit_window'])
+        metrics.gauge('recv.%s.lag' % self.session_id, lambda: self.lag)
+
+        if backup_conf['relay_to']:
+            self.relay = Relay(self.server, backup_conf['relay_to'], self.name,
+                               timeout=self.timeout)
+            self.relay_max_backlog = backup_conf['relay_max_backlog'] or backup_conf['credit_window']
+
+        self.reply('ok', str(self.granter.initial()), ','.join(sorted(codecs)),
+                   self.checksum_name or '')
+
+    def _verify(self, seq, codec_name, checksum, payload):
+        """ Returns the chunk's data, or None if it didn't survive the trip. """
+        try:
+            data = self.decompressor.decompress(payload, codec_name)
+        except Exception as e:
+            log.error('%s: Could not decompress %s chunk %d: %s', self, codec_name, seq, e)
+            return None
+        if self.checksum_name and checksums[self.checksum_name](data) != checksum:
+            log.error('%s: Checksum mismatch on chunk %d', self, seq)
+            return None
+        return data
+
+    def data(self, header, payload, origin=None):
+        """ Takes a chunk, sent by the first hop at @origin (time.time() as
+        a str) if it says. """
+        if self.closed:
+            # Stragglers while zfs receive finishes up
+            return
+        self.last_activity = time.time()
+        seq, codec_name, checksum = unpack_header(header)
+        data = self._verify(seq, codec_name, checksum, payload)
+        if data is not None:
+            data = (data, origin)
+
+        try:
+            ready, nacks = self.reassembler.add(seq, data)
+        except ReassemblyError as e:
+            log.error('%s: %s', self, e)
+            self.abort(str(e))
+            return
+        for first, last in nacks:
+            self.reply('nack', str(first), str(last))
+
+        for buf, origin in ready:
+            self.coalescer.write(buf)
+            if self.relay:
+                self.relay.forward(buf, origin)
+            if origin:
+                self.lag = self.last_activity - float(origin)
+                self.max_lag = max(self.max_lag, self.lag)
+        if self.coalescer.ready():
+            self.flush()
+
+        if self.closing_seq is not None and self.reassembler.next_seq > self.closing_seq:
+            self.close(self.closing_seq)
+
+    def flush(self):
+        try:
+            count = self.coalescer.flush()
+        except (IOError, OSError):
+            log.error('%s: Broken pipe on recv', self)
+            self.abort('zfs receive went away')
+            return
+        # Chunks are zfs receive's problem now, let the sender have more
+        self.held_credit += self.granter.consumed(count)
+        self.held_ack = self.reassembler.next_seq - 1
+        self.grant()
+
+    def ping(self, token):
+        self.last_activity = time.time()
+        self.reply('pong', token)
+
+    def resize(self, window):
+        """ Sender's autotuning wants a @window chunk credit window. """
+        self.last_activity = time.time()
+        window = max(1, min(window, backup_conf['credit_window_max']))
+        log.debug('%s: Credit window now %d', self, window)
+        self.held_credit += self.granter.resize(window)
+        self.reassembler.max_held = window
+        self.grant()
+
+    def grant(self):
+        """ Hands the sender whatever credit we're holding, unless the next
+        hop is too far behind; then it waits on that instead. """
+        if not self.held_credit:
+            return
+        if self.relay and not self.relay.done and \
+                self.relay.backlog >= self.relay_max_backlog:
+            return
+        self.reply('credit', str(self.held_credit), str(self.held_ack))
+        self.held_credit = 0
+
+    def time_left(self):
+        """ Seconds until this session next needs attention. """
+        relay = self.relay and self.relay.time_left()
+        if self._on_exit:
+            # Waiting on zfs receive to exit, which doesn't wake us
+            return 0.1
+        if self.closed:
+            # Only still around waiting on the relay
+            return relay if relay is not None else 1
+        idle = max(0, self.last_activity + self.timeout - time.time())
+        pending = self.coalescer.time_left()
+        return min(x for x in (idle, pending, relay) if x is not None)
+
+    def tick(self):
+        """ Services timers; flushes held back chunks and reaps idle sessions. """
+        if self.relay:
+            self.relay.tick()
+        if self.closed:
+            self._reap()
+            return
+        if self.relay:
+            self.grant()
+        if self.coalescer.ready():
+            self.flush()
+        if time.time() - self.last_activity > self.timeout:
+            log.error('%s: No word from sender in %ss, giving up', self, self.timeout)
+            self.abort('session timed out')
+
+    def _finish(self, then=None):
+        """ Closes zfs receive's stdin and waits for it to exit, in a thread
+        so the other sessions don't wait along; tick() then calls @then with
+        its exit code. """
+        self.closed = True
+        self._on_exit = then
+        waiter = threading.Thread(target=self._wait_for_exit, name='%r exit' % self)
+        waiter.daemon = True
+        waiter.start()
+
+    def _wait_for_exit(self):
+        log.info('%s: Closing recv stdin', self)
+        try:
+            self.precv.stdin.close()
+        except IOError:
+            pass
+
+        log.info('%s: Waiting for async reader threads to join', self)
+        self.precv_stdout_reader.join()
+        self.precv_stderr_reader.join()
+
+        log.info('%s: Waiting for procs to end', self)
+        self.returncode = self.precv.wait()
+
+    def _reap(self):
+        """ Carries on with a closed session once zfs receive has exited,
+        then once the relay is done, if any. """
+        if self._on_exit:
+            if self.returncode is None:
+                return
+            on_exit, self._on_exit = self._on_exit, None
+            on_exit(self.returncode)
+        elif self.relay and self.relay.done:
+            self._relayed()
+
+    def _retire(self):
+        self.server.remove(self)
+        metrics.remove('recv.%s.' % self.session_id)
+
+    def _relayed(self):
+        """ Local receive is done and so is the relay; let the sender know. """
+        self._retire()
+        if self.relay.error:
+            # We have it anyway, the next hop can be caught up from here
+            log.error('%s: Next hop did not get it: %s', self, self.relay.error)
+        self.reply('ok')
+
+    def close(self, last_seq):
+        missing = self.reassembler.missing(last_seq)
+        if missing:
+            # Hold off until the sender has replayed what we're missing
+            log.warning('%s: Asked to close but missing chunks %s', self, missing)
+            self.closing_seq = last_seq
+            for first, last in missing:
+                self.reply('nack', str(first), str(last))
+            return
+
+        self.flush()
+        if self.closed:
+            return
+        log.info('%s: Wrote %d bytes to recv in %d writev calls, compression: %s, %s, '
+                 'max lag %.2fs',
+                 self, self.coalescer.bytes_written, self.coalescer.syscalls,
+                 self.decompressor.stats, self.reassembler, self.max_lag)
+        if self.relay:
+            self.relay.close()
+        self._finish(self._received)
+
+    def _received(self, ret):
+        """ zfs receive exited with @ret after a close. """
+        if ret != 0:
+            if self.relay:
+                self.relay.abort('upstream receive failed')
+            self._retire()
+            self.reply('error', 'zfs receive exited with %s' % ret)
+        elif not self.relay:
+            self._retire()
+            self.reply('ok')
+        elif self.relay.done:
+            self._relayed()
+        # Otherwise tick() replies once the relay is done
+
+    def abort(self, reason):
+        if not self.closed:
+            if self.precv.poll() is None:
+                self.precv.terminate()
+        elif self.returncode is None:
+            # The exit waiter is reaping it; polling here as well would race
+            # it, so only signal
             try:
-                precv.stdin.write(buf[2])
-                precv.stdin.flush()
-            except IOError:
-                log.error('Broken pipe on recv')
+                os.kill(self.precv.pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+        if self.relay:
+            self.relay.abort(reason)
+        if not self.closed:
+            self._finish()
+        # Nobody to tell how zfs receive took it
+        self._on_exit = None
+        self._retire()
+        self.reply('error', reason)
+
+
+class ReceiveServer(object):
+    """ Tracks many concurrent receive sessions, keyed by peer identity and
+    session id.
+
+    @rtr is either the front end ROUTER itself, or a DEALER to a
+    ReceiveBroker; both hand us [peer, cmd, session_id, ...].
+    """
+
+    session_class = ReceiveSession
+
+    def __init__(self, rtr):
+        self.rtr = rtr
+        self.sessions = {}
+        self.poller = zmq.Poller()
+        self.poller.register(rtr, zmq.POLLIN)
+
+    @classmethod
+    def bind(cls, bind):
+        ctx = zmq.Context()
+        rtr = ctx.socket(zmq.ROUTER)
+        rtr.setsockopt(zmq.IDENTITY, 'srv')
+        #rtr.setsockopt(zmq.PROBE_ROUTER, 1)
+        configure_socket(rtr, backup_conf['socket_buffer'], backup_conf['socket_hwm'])
+        rtr.bind(bind)
+        return cls(rtr)
+
+    def send(self, peer_id, *frames):
+        self.rtr.send_multipart([peer_id] + list(frames))
+
+    def remove(self, session):
+        self.sessions.pop((session.peer_id, session.session_id), None)
+
+    def watch(self, sock):
+        """ Wakes the loop up for @sock too, ie a relay to the next hop. """
+        self.poller.register(sock, zmq.POLLIN)
+
+    def unwatch(self, sock):
+        self.poller.unregister(sock)
+
+    # Frames each command needs, peer_id, cmd and session_id included
+    min_frames = dict(
+        receive_data=5,
+        receive_ping=4,
+        receive_open=4,
+        receive_close=4,
+        receive_window=4,
+        receive_abort=3,
+    )
+
+    def handle(self, buf):
+        """ Handles message @buf, replying error to whatever is malformed
+        rather than letting it take down every session. """
+        if len(buf) < 3:
+            log.error('Dropping malformed message: %s', repr(buf))
+            return
+        peer_id, cmd, session_id = buf[:3]
+        if len(buf) < self.min_frames.get(cmd, 3):
+            log.error('Peer %s sent %s with only %d frames', repr(peer_id), repr(cmd), len(buf))
+            self.send(peer_id, 'error', session_id, 'malformed %s' % cmd)
+            return
+        try:
+            self._handle(peer_id, cmd, session_id, buf)
+        except (ValueError, IndexError, TypeError, KeyError, struct.error) as e:
+            log.error('Peer %s sent malformed %s: %s', repr(peer_id), repr(cmd), e)
+            self.send(peer_id, 'error', session_id, 'malformed %s: %s' % (cmd, e))
+
+    def _handle(self, peer_id, cmd, session_id, buf):
+        key = (peer_id, session_id)
+        session = self.sessions.get(key)
+
+        if cmd == 'receive_data':
+            if session:
+                session.data(*buf[3:6])
+            return
+        if cmd == 'receive_ping':
+            if session:
+                session.ping(buf[3])
+            return
+
+        log.info('Peer %s sent %s for session %s',
+                 repr(peer_id), repr(cmd), repr(session_id))
+
+        if cmd == 'receive_open':
+            if session:
+                self.send(peer_id, 'error', session_id, 'session already open')
+                return
+            name = buf[3]
+            checksum_names = buf[4].split(',') if len(buf) > 4 else ()
+            session = self.session_class(self, peer_id, session_id, name,
+                                         checksum_names=checksum_names)
+            self.sessions[key] = session
+            session.open()
+            return
+
+        if not session:
+            self.send(peer_id, 'error', session_id, 'unknown session')
+            return
+
+        if cmd == 'receive_close':
+            session.close(int(buf[3]))
+        elif cmd == 'receive_abort':
+            session.abort(buf[3] if len(buf) > 3 else 'aborted by sender')
+        elif cmd == 'receive_window':
+            session.resize(int(buf[3]))
 
+    def run(self):
+        poller = self.poller
+
+        while True:
+            # Wake up in time for whichever session needs attention first
+            timeout = None
+            if self.sessions:
+                timeout = min(s.time_left() for s in self.sessions.values()) * 1000
+
+            if poller.poll(timeout):
+                # Take a batch of what's queued, then service timers so a
+                # busy stream can't starve the others
+                for i in xrange(1024):
+                    try:
+                        buf = self.rtr.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.handle(buf)
+
+            for session in self.sessions.values():
+                session.tick()
+
+
+class StreamReceiveSession(threading.Thread):
+    """ One replication stream over a plain byte stream transport (see
+    transport), spliced from connection @conn straight into its own zfs
+    receive. No chunks, credit or checksums of our own; TCP and the zfs
+    stream's checksums take care of that. """
+
+    def __init__(self, conn, peer):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        self.peer = peer
+        self.session_id = None
+        # Not name, that's the thread's
+        self.dataset = None
+        self.precv = None
+
+    def __repr__(self):
+        return '<%s %s/%s %s>' % (self.__class__.__name__,
+                                  self.peer, self.session_id, self.dataset)
 
+    def run(self):
+        try:
+            self._receive()
+        except (TransportError, socket.error) as e:
+            log.error('%s: %s', self, e)
+        finally:
+            self.conn.close()
+
+    def _receive(self):
+        hello = recv_line(self.conn)
+        if len(hello) != 3 or hello[0] != 'receive_open':
+            send_line(self.conn, 'error', 'expected receive_open')
+            return
+        self.session_id, self.dataset = hello[1:]
+
+        spawn_receive(self)
+        send_line(self.conn, 'ok')
+
+        ring_kwargs = {}
+        if backup_conf['transfer'] == 'buffer':
+            ring_kwargs = ring_buffer_kwargs('recv.%s' % self.session_id)
+        start = time.time()
+        error = None
+        try:
+            total, mode = pipes.transfer(self.conn, self.precv.stdin,
+                                         mode=backup_conf['transfer'],
+                                         bufsize=backup_conf['bufsize'],
+                                         **ring_kwargs)
+        except (IOError, OSError) as e:
+            # Sender went away; with -s zfs receive keeps what it got to be
+            # resumed, as long as it isn't left thinking it has it all.
+            error = 'broken pipe: %s' % e
+            if self.precv.poll() is None:
+                self.precv.terminate()
+        else:
+            elapsed = max(time.time() - start, 1e-9)
+            log.info('%s: Received %d bytes in %.2fs (%.1f MB/s) via %s', self,
+                     total, elapsed, total / elapsed / 1024 / 1024, mode)
+
+        log.info('%s: Closing recv stdin', self)
+        try:
+            self.precv.stdin.close()
+        except IOError:
+            pass
+
+        log.info('%s: Waiting for async reader threads to join', self)
+        self.precv_stdout_reader.join()
+        self.precv_stderr_reader.join()
+
+        log.info('%s: Waiting for procs to end', self)
+        ret = self.precv.wait()
+        if error:
+            log.error('%s: %s', self, error)
+            send_line(self.conn, 'error', error)
+        elif ret != 0:
+            send_line(self.conn, 'error', 'zfs receive exited with %s' % ret)
+        else:
+            send_line(self.conn, 'ok')
+
+
+class StreamReceiveServer(threading.Thread):
+    """ Accepts plain byte stream connections on @address, a receive session
+    (thread) each. """
+
+    session_class = StreamReceiveSession
+
+    def __init__(self, address):
+        threading.Thread.__init__(self, name=address)
+        self.daemon = True
+        self.transport = get_transport(address, buffer_size=backup_conf['socket_buffer'])
+        if not self.transport:
+            raise ValueError('Not a stream transport address: %s' % address)
 
-        if buf[1] == 'receive_close':
-            try:
-                precv.stdin.flush()
-            except IOError:
-                log.error('Broken pipe on recv')
+    def run(self):
+        sock = self.transport.listen()
+        log.info('Listening for streams on %s', self.transport)
+        while True:
+            conn, peer = sock.accept()
+            self.session_class(conn, peer or self.transport.address).start()
 
-            log.info('Closing recv stdin')
-            precv.stdin.close()
 
-            log.info('Waiting for async reader threads to join')
-            precv_stdout_reader.join()
-            precv_stderr_reader.join()
+class ReceiveWorker(multiprocessing.Process):
+    """ Worker process running a ReceiveServer behind a ReceiveBroker. """
 
-            #log.info('Closing async reader FDs')
-            #precv.stdout.close()
-            #precv.stderr.close()
+    def __init__(self, worker_id, backend):
+        multiprocessing.Process.__init__(self, name=worker_id)
+        self.daemon = True
+        self.worker_id = worker_id
+        self.backend = backend
 
-            log.info('Waiting for procs to end')
-            precv.wait()
+    def run(self):
+        ctx = zmq.Context()
+        dealer = ctx.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, self.worker_id)
+        configure_socket(dealer, hwm=backup_conf['socket_hwm'])
+        dealer.connect(self.backend)
+        # Let the broker know we're up
+        dealer.send_multipart(['', 'worker_ready', ''])
+        ReceiveServer(dealer).run()
+
+
+class ReceiveBroker(object):
+    """ Front end ROUTER that spreads receive sessions over a pool of
+    ReceiveWorker processes, so frame handling for concurrent streams isn't
+    all stuck behind one GIL. A session sticks to the worker it opened on.
+
+    A worker that dies takes its sessions with it; their senders are told.
+    It isn't replaced, as a worker forked then would inherit our context and
+    sockets; once they're all gone run() returns.
+    """
+
+    def __init__(self, bind, backend, workers):
+        # Fork first, so there's no context or sockets for workers to inherit
+        self._procs = dict()
+        for i in xrange(workers):
+            proc = ReceiveWorker('worker-%d' % i, backend)
+            proc.start()
+            self._procs[proc.worker_id] = proc
+
+        self.ctx = zmq.Context()
+        self.frontend = self.ctx.socket(zmq.ROUTER)
+        self.frontend.setsockopt(zmq.IDENTITY, 'srv')
+        configure_socket(self.frontend, backup_conf['socket_buffer'], backup_conf['socket_hwm'])
+        self.frontend.bind(bind)
+        self.backend = self.ctx.socket(zmq.ROUTER)
+        configure_socket(self.backend, hwm=backup_conf['socket_hwm'])
+        self.backend.bind(backend)
+
+        self.workers = dict()       # worker_id -> set of session keys
+        self.routes = dict()        # (peer_id, session_id) -> worker_id
+        self.closing = set()
+
+    def _pick_worker(self):
+        return min(self.workers, key=lambda w: len(self.workers[w]))
+
+    def _drop(self, key):
+        worker_id = self.routes.pop(key, None)
+        if worker_id in self.workers:
+            self.workers[worker_id].discard(key)
+        self.closing.discard(key)
+
+    def reap_workers(self):
+        """ Fails the sessions of workers that died. Returns how many are
+        left. """
+        for worker_id, proc in self._procs.items():
+            if proc.is_alive():
+                continue
+            log.error('Worker %s died with exit code %s', worker_id, proc.exitcode)
+            del self._procs[worker_id]
+            for key in self.workers.pop(worker_id, ()):
+                self.routes.pop(key, None)
+                self.closing.discard(key)
+                peer_id, session_id = key
+                self.frontend.send_multipart([peer_id, 'error', session_id,
+                                              'receive worker died'])
+        return len(self._procs)
+
+    def from_frontend(self, frames):
+        if len(frames) < 3:
+            log.error('Dropping malformed message of %d frames', len(frames))
+            return
+        peer_id, cmd, session_id = [f.bytes for f in frames[:3]]
+        key = (peer_id, session_id)
+        worker_id = self.routes.get(key)
+
+        if cmd == 'receive_open' and not worker_id:
+            if not self.workers:
+                self.frontend.send_multipart([peer_id, 'error', session_id, 'no workers'])
+                return
+            worker_id = self._pick_worker()
+            self.routes[key] = worker_id
+            self.workers[worker_id].add(key)
+            log.info('Session %s/%s -> %s', peer_id, session_id, worker_id)
+        elif not worker_id:
+            self.frontend.send_multipart([peer_id, 'error', session_id, 'unknown session'])
+            return
+        elif cmd == 'receive_close':
+            self.closing.add(key)
+
+        self.backend.send_multipart([worker_id] + frames, copy=False)
+
+    def from_backend(self, frames):
+        if len(frames) < 4:
+            log.error('Dropping malformed message of %d frames from worker', len(frames))
+            return
+        worker_id = frames[0].bytes
+        peer_id, cmd, session_id = [f.bytes for f in frames[1:4]]
+
+        if cmd == 'worker_ready':
+            log.info('Worker %s ready', worker_id)
+            self.workers.setdefault(worker_id, set())
+            return
+
+        key = (peer_id, session_id)
+        if cmd == 'error' or (cmd == 'ok' and key in self.closing):
+            self._drop(key)
+
+        self.frontend.send_multipart(frames[1:], copy=False)
 
-            rtr.send_multipart([peer_id, 'ok'])
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+
+        while True:
+            socks = dict(poller.poll(1000))
+            if not self.reap_workers():
+                log.error('No receive workers left')
+                return
+            if self.backend in socks:
+                self.from_backend(self.backend.recv_multipart(copy=False))
+            if self.frontend in socks:
+                self.from_frontend(self.frontend.recv_multipart(copy=False))
+
+
+def main():
+    # Workers are forked first, before there are stream server threads or
+    # sockets for them to inherit
+    workers = backup_conf['receive_workers']
+    if workers:
+        server = ReceiveBroker(backup_conf['receive_bind'],
+                               backup_conf['receive_backend'],
+                               workers)
+    else:
+        server = ReceiveServer.bind(backup_conf['receive_bind'])
+
+    for address in backup_conf['stream_bind']:
+        StreamReceiveServer(address).start()
+    server.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,315 @@
+
+"""
+Quick and dirty benchmarks for the replication data path.
+
+Uses plain coreutils in place of zfs send/receive so it can be run anywhere:
+
+    python -m san.mgmtd.bench transfer [megabytes]
+    python -m san.mgmtd.bench coalesce [megabytes]
+    python -m san.mgmtd.bench pipeline [megabytes]
+    python -m san.mgmtd.bench transport [megabytes]
+    python -m san.mgmtd.bench parse [megabytes]
+"""
+
+import logging
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+import io
+import os
+import sys
+import time
+import struct
+import random
+import tempfile
+import threading
+import subprocess
+import zmq
+
+from . import pipes
+from . import drr
+from .coalesce import WriteCoalescer
+from .pipeline import OrderedStage
+from .transport import get_transport
+
+
+def _spawn_pair(size):
+    src = subprocess.Popen(['head', '-c', str(size), '/dev/zero'],
+                           stdout=subprocess.PIPE)
+    dst = subprocess.Popen(['cat'],
+                           stdin=subprocess.PIPE,
+                           stdout=open('/dev/null', 'wb'))
+    return src, dst
+
+
+def _report(name, size, elapsed, extra=''):
+    log.info('%-24s %8.1f MB/s (%.2fs) %s', name,
+             size / max(elapsed, 0.001) / 1024 / 1024, elapsed, extra)
+
+
+def _write_syscalls():
+    """ Write syscalls made by this process so far, as counted by the kernel. """
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('syscw:'):
+                return int(line.split()[1])
+
+
+def bench_transfer(size):
+    """ Compares the legacy 4k read/write/flush loop against copy, splice and
+    the ring buffer. """
+    def legacy(src, dst):
+        while True:
+            buf = src.read(4096)
+            if not buf:
+                break
+            dst.write(buf)
+            dst.flush()
+
+    cases = [
+        ('legacy 4k loop', legacy),
+        ('copy 1M', lambda s, d: pipes.copy_pipe(s, d)),
+        ('splice 1M', lambda s, d: pipes.splice_pipe(s, d)),
+        ('ring buffer 64M', lambda s, d: pipes.buffered_pipe(s, d, size=64 * 1024 * 1024)),
+    ]
+    for name, func in cases:
+        src, dst = _spawn_pair(size)
+        start = time.time()
+        func(src.stdout, dst.stdin)
+        elapsed = time.time() - start
+        src.stdout.close()
+        dst.stdin.close()
+        src.wait()
+        dst.wait()
+        _report(name, size, elapsed)
+
+
+def bench_coalesce(size, frame_size=4096):
+    """ Feeds @frame_size frames into a reader process the way the receive
+    side does, one write+flush per frame versus the WriteCoalescer. """
+    frame = '\0' * frame_size
+    frames = size // frame_size
+
+    def per_frame(dst):
+        for i in xrange(frames):
+            dst.write(frame)
+            dst.flush()
+
+    def coalesced(dst):
+        coalescer = WriteCoalescer(dst)
+        for i in xrange(frames):
+            coalescer.write(frame)
+            if coalescer.ready():
+                coalescer.flush()
+        coalescer.flush()
+
+    for name, func in [('write+flush per frame', per_frame),
+                       ('coalesced writev', coalesced)]:
+        dst = subprocess.Popen(['cat'],
+                               stdin=subprocess.PIPE,
+                               stdout=open('/dev/null', 'wb'))
+        syscalls = _write_syscalls()
+        start = time.time()
+        func(dst.stdin)
+        elapsed = time.time() - start
+        syscalls = _write_syscalls() - syscalls
+        dst.stdin.close()
+        dst.wait()
+        _report(name, size, elapsed, '%d write syscalls for %d frames' % (syscalls, frames))
+
+
+def bench_pipeline(size, chunk_size=128 * 1024, codec_name='zlib'):
+    """ Compression + checksum throughput of the sender's pipeline stage
+    across 1-16 thread and process workers. """
+    # Somewhat compressible, so the codec actually has to work
+    rand = random.Random(0)
+    words = [''.join(chr(rand.randint(32, 126)) for _ in xrange(rand.randint(2, 12)))
+             for _ in xrange(4096)]
+    text = ' '.join(rand.choice(words) for _ in xrange(chunk_size))
+    chunk = text[:chunk_size]
+    chunks = size // chunk_size
+
+    for kind in ('thread', 'process'):
+        for workers in (1, 2, 4, 8, 16):
+            stage = OrderedStage(workers=workers, kind=kind)
+            start = time.time()
+            for i in xrange(chunks):
+                stage.submit(chunk, codec_name=codec_name, checksum_name='crc32')
+                while stage.full():
+                    stage.get()
+            while stage.pending:
+                stage.get()
+            elapsed = time.time() - start
+            stage.close()
+            _report('%s %s x%d' % (codec_name, kind, workers), size, elapsed)
+
+
+def bench_transport(size, chunk_size=128 * 1024, socket_buffer=4 * 1024 * 1024):
+    """ Moves a stream between two pipes over loopback the way replication
+    does, as @chunk_size zmq frames written out coalesced versus spliced
+    through raw TCP and Unix domain sockets. The zmq case leaves out credit
+    and checksums, so it's the best that path could do. """
+    def zmq_case(src, dst):
+        ctx = zmq.Context.instance()
+        rtr = ctx.socket(zmq.ROUTER)
+        port = rtr.bind_to_random_port('tcp://127.0.0.1')
+        dealer = ctx.socket(zmq.DEALER)
+        dealer.connect('tcp://127.0.0.1:%d' % port)
+
+        def send():
+            reader = io.FileIO(src.fileno(), 'rb', closefd=False)
+            while True:
+                buf = reader.read(chunk_size)
+                dealer.send(buf or '', copy=False)
+                if not buf:
+                    break
+        sender = threading.Thread(target=send)
+        sender.start()
+
+        coalescer = WriteCoalescer(dst)
+        while True:
+            peer, buf = rtr.recv_multipart()
+            if not buf:
+                break
+            coalescer.write(buf)
+            if coalescer.ready():
+                coalescer.flush()
+        coalescer.flush()
+        sender.join()
+        dealer.close()
+        rtr.close()
+
+    def stream_case(address):
+        def run(src, dst):
+            transport = get_transport(address, buffer_size=socket_buffer)
+            listener = transport.listen()
+
+            def send():
+                sock = transport.connect()
+                pipes.splice_pipe(src, sock)
+                sock.close()
+            sender = threading.Thread(target=send)
+            sender.start()
+
+            conn, peer = listener.accept()
+            pipes.splice_pipe(conn, dst)
+            sender.join()
+            conn.close()
+            listener.close()
+        return run
+
+    sock_path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    cases = [
+        ('zmq tcp frames', zmq_case),
+        ('raw tcp splice', stream_case('raw+tcp://127.0.0.1:%d' % random.randint(20000, 30000))),
+        ('unix splice', stream_case('unix://' + sock_path)),
+    ]
+    try:
+        for name, func in cases:
+            src, dst = _spawn_pair(size)
+            start = time.time()
+            func(src.stdout, dst.stdin)
+            dst.stdin.close()
+            dst.wait()
+            elapsed = time.time() - start
+            src.stdout.close()
+            src.wait()
+            _report(name, size, elapsed)
+    finally:
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+        os.rmdir(os.path.dirname(sock_path))
+
+
+def _drr_stream(size, block_size=128 * 1024, checksums=True, toguid=0x1234,
+                compound=False):
+    """ Returns a zfs send stream of about @size bytes: one object written
+    in @block_size blocks. Checksummed as zfs send does if @checksums.
+    With @compound it's wrapped in a compound stream's header and final END,
+    as -I and -p sends are. """
+    cksum = drr.Fletcher4() if checksums else None
+    block = os.urandom(block_size)
+    out = []
+
+    def record(rtype, fmt, fields, payload='', raw=False):
+        rec = bytearray(drr.record_size)
+        struct.pack_into('<II', rec, 0, rtype, len(payload) if rtype == drr.BEGIN else 0)
+        struct.pack_into('<' + fmt, rec, 8, *fields)
+        if rtype == drr.BEGIN:
+            rec[56:56 + 16] = 'pool/vol@bench'.ljust(16, '\0')
+            if cksum:
+                cksum.reset()
+        if cksum and not raw:
+            cksum.update(memoryview(rec)[:drr.checksum_offset])
+            if rtype != drr.BEGIN:
+                struct.pack_into('<4Q', rec, drr.checksum_offset, *cksum.digest())
+            cksum.update(memoryview(rec)[drr.checksum_offset:])
+            if payload:
+                cksum.update(memoryview(payload))
+        out.append(str(rec))
+        if payload:
+            out.append(payload)
+
+    if compound:
+        # Header: nvlist of the datasets sent, then an END checksumming it
+        # that libzfs writes as is, as it does the final END
+        record(drr.BEGIN, 'QQQIIQQ', (drr.DMU_BACKUP_MAGIC, drr.DMU_COMPOUNDSTREAM,
+                                      int(time.time()), 0, 0, 0, 0), '\0' * 1024)
+        record(drr.END, '4QQ', (cksum.digest() if cksum else (0, 0, 0, 0)) + (0,), raw=True)
+
+    record(drr.BEGIN, 'QQQIIQQ', (drr.DMU_BACKUP_MAGIC, drr.DMU_SUBSTREAM,
+                                  int(time.time()), 3, 0, toguid, 0))
+    record(drr.OBJECT, 'QIIIIBBBBI', (1, 23, 0, block_size, 0, 7, 2, 1, 0, 0))
+    blocks = max(1, size // block_size)
+    for i in xrange(blocks):
+        record(drr.WRITE, 'QIIQQQBBB5x40xQ',
+               (1, 23, 0, i * block_size, block_size, toguid, 7, 0, 0, 0), block)
+    record(drr.FREE, 'QQQQ', (1, blocks * block_size, drr.FREE_TO_END, toguid))
+    end = cksum.digest() if cksum else (0, 0, 0, 0)
+    record(drr.END, '4QQ', end + (toguid,))
+    if compound:
+        record(drr.END, '4QQ', (0, 0, 0, 0, 0), raw=True)
+    return ''.join(out)
+
+
+def bench_parse(size, piece_size=1024 * 1024, line_rate=10 * 1000 ** 3 / 8):
+    """ Stream parser throughput, and its cost as a share of the time
+    @line_rate bytes a second (10GbE) takes to move the stream. Streams are
+    compound, as our -p sends are. """
+    for block_size in (128 * 1024, 8 * 1024):
+        stream = _drr_stream(size, block_size, checksums=drr.Fletcher4.accelerated,
+                             compound=True)
+        view = memoryview(stream)
+        cases = [('no checksums', False)]
+        if drr.Fletcher4.accelerated:
+            cases.append(('checksums', True))
+        else:
+            log.info('No libzfs fletcher4, not timing checksum verification')
+        for name, verify in cases:
+            parser = drr.StreamParser(verify_checksums=verify)
+            start = time.time()
+            for pos in xrange(0, len(stream), piece_size):
+                parser.feed(view[pos:pos + piece_size])
+            parser.close()
+            elapsed = time.time() - start
+            _report('parse %dK %s' % (block_size // 1024, name), len(stream), elapsed,
+                    '%.1f%% of line rate' % (100.0 * elapsed * line_rate / len(stream)))
+
+
+benches = dict(
+    transfer=bench_transfer,
+    coalesce=bench_coalesce,
+    pipeline=bench_pipeline,
+    transport=bench_transport,
+    parse=bench_parse,
+)
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else 'transfer'
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    benches[name](size * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    main()
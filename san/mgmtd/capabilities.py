@@ -0,0 +1,107 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import re
+import subprocess
+
+
+"""
+Negotiates which optional zfs send stream features a replication uses.
+
+Both ends need to understand a feature for it to be used: the sender's zfs has
+to be able to produce it, and the receiver's zfs has to accept it with the
+destination pool having the matching feature enabled.
+"""
+
+
+# Capability name: (zfs send flag, pool feature the receiver needs)
+capabilities = dict(
+    # Send blocks as they are compressed on disk instead of inflating them
+    # only for the receiver to compress them again.
+    compressed=('c', 'lz4_compress'),
+    # Keep records over 128K as is.
+    large_blocks=('L', 'large_blocks'),
+    # Keep blocks embedded in their block pointers as is.
+    embedded=('e', 'embedded_data'),
+    # Encrypted datasets are sent still encrypted; no key needed on either end.
+    raw=('w', 'encryption'),
+)
+
+
+_usage_flags = re.compile(r'^\s*send \[-(\w+)\]', re.M)
+_send_flags = None
+
+
+def local_send_flags():
+    """ Returns the option letters the local zfs send takes, going by its usage. """
+    global _send_flags
+    if _send_flags is None:
+        try:
+            proc = subprocess.Popen(['/sbin/zfs', 'send'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            out = proc.communicate()[0]
+        except OSError as e:
+            log.error('Could not run zfs send for its usage: %s', e)
+            out = ''
+        _send_flags = ''.join(sorted(set(''.join(_usage_flags.findall(out)))))
+    return _send_flags
+
+
+def pool_features(pool):
+    """ Returns the names of the features enabled (or active) on @pool. """
+    cmd = ['/sbin/zpool', 'get', '-H', '-o', 'property,value', 'all', pool]
+    try:
+        out = subprocess.check_output(cmd)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.error('Could not get features of pool %s: %s', pool, e)
+        return set()
+    ret = set()
+    for line in out.splitlines():
+        prop, _, value = line.partition('\t')
+        if prop.startswith('feature@') and value in ('enabled', 'active'):
+            ret.add(prop[len('feature@'):])
+    return ret
+
+
+def is_encrypted(name):
+    """ Whether local dataset @name is encrypted. """
+    cmd = ['/sbin/zfs', 'get', '-H', '-o', 'value', 'encryption', name]
+    try:
+        value = subprocess.check_output(cmd, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        # Older zfs without encryption support at all
+        return False
+    return value not in ('', '-', 'off')
+
+
+def receive_capabilities(dest_name):
+    """ Receive side: capabilities this box can take a stream into
+    @dest_name with. """
+    # Same zfs on both ends of a pipe, so a flag we could send we can receive
+    flags = local_send_flags()
+    features = pool_features(dest_name.split('/', 1)[0])
+    return sorted(k for k, (flag, feature) in capabilities.iteritems()
+                  if flag in flags and feature in features)
+
+
+def negotiate(name, receiver_capabilities, allowed=None):
+    """ Send side: returns the zfs send flags to use for dataset @name given
+    what the receiver says it takes. @allowed optionally narrows down which
+    capabilities may be used for this dataset. """
+    flags = local_send_flags()
+    ret = []
+    for k in sorted(receiver_capabilities):
+        if k not in capabilities:
+            continue
+        if allowed is not None and k not in allowed:
+            continue
+        flag = capabilities[k][0]
+        if flag not in flags:
+            continue
+        if k == 'raw' and not is_encrypted(name):
+            continue
+        ret.append(flag)
+    log.info('Negotiated send flags for %s: %s', name, ''.join(ret) or 'none')
+    return ''.join(ret)
@@ -0,0 +1,238 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import io
+import re
+import sys
+import subprocess
+
+from .async_file_reader import AsynchronousFileLogger
+from .backup import Dataset, backup_conf, send_cmd, replication_priority
+from .capabilities import local_send_flags, is_encrypted
+from .priority import spawn
+from . import drr
+
+
+"""
+Changed blocks of zvols between snapshots.
+
+A zvol's data is object 1 of its objset, so an incremental zfs send between
+two of its snapshots says exactly what changed: WRITEs of object 1 (and their
+embedded and dedup'd kinds) for data written, FREEs of it for ranges that are
+now holes, ie discarded by the initiator. changed_blocks() runs the zfs send
+-i, walks it with a StreamParser as it comes and throws the data away, so
+nothing the size of the stream is ever kept; what's kept is a bitmap of
+volume blocks, one bit each.
+
+Pools without the hole_birth feature send FREEs for every hole, changed or
+not, so there freed covers more than it has to; written is exact either way.
+
+    python -m san.mgmtd.changed_blocks pool/vol from_snap to_snap [bitmap file]
+
+prints the changed extents as offset and length in bytes, a line each, and
+writes the bitmap to the file if given.
+"""
+
+
+ZVOL_OBJ = 1
+
+
+class ChangedBlocksError(Exception):
+    """ Couldn't get a stream to go by. """
+
+
+class ChangedBlocks(object):
+    """ Which @block_size byte blocks of a @volsize byte zvol a stream wrote
+    or freed. Add to a StreamParser with listen().
+
+    Bitmaps have a bit per block, block n being bit n % 8 of byte n / 8. A
+    partial block written or freed counts as all of it.
+    """
+
+    def __init__(self, volsize, block_size):
+        self.volsize = volsize
+        self.block_size = block_size
+        self.blocks = -(-volsize // block_size)
+        size = (self.blocks + 7) // 8
+        self.written = bytearray(size)
+        self.freed = bytearray(size)
+        self.changed = bytearray(size)
+
+    def __repr__(self):
+        return '<%s %d of %d blocks of %d bytes>' % (
+            self.__class__.__name__, self.count(), self.blocks, self.block_size)
+
+    def __call__(self, rtype, fields):
+        if fields[0] != ZVOL_OBJ:
+            return
+        if rtype == drr.WRITE:
+            bits, offset, length = self.written, fields[3], fields[4]
+        elif rtype in (drr.WRITE_EMBEDDED, drr.WRITE_BYREF):
+            bits, offset, length = self.written, fields[1], fields[2]
+        elif rtype == drr.FREE:
+            bits, offset, length = self.freed, fields[1], fields[2]
+        else:
+            return
+        # Frees run to the end of the object, or past the end of a volume
+        # that's since shrunk
+        end = min(offset + length, self.volsize)
+        if end <= offset:
+            return
+        first = offset // self.block_size
+        last = -(-end // self.block_size)
+        _set_bits(bits, first, last)
+        _set_bits(self.changed, first, last)
+
+    def count(self, bits=None):
+        """ Returns how many blocks are set in @bits (changed). """
+        return sum(last - first for first, last in _runs(self.changed if bits is None else bits))
+
+    def extents(self, bits=None):
+        """ Returns the runs of blocks set in @bits (changed) as (offset,
+        length) in bytes, in order. """
+        ret = []
+        for first, last in _runs(self.changed if bits is None else bits):
+            offset = first * self.block_size
+            ret.append((offset, min(last * self.block_size, self.volsize) - offset))
+        return ret
+
+
+# Whole bytes of set bits, or a byte with some set
+_set_bytes = re.compile(r'(\xff+)|[^\x00]')
+
+
+def _runs(bits):
+    """ Yields the runs of set bits in bytearray @bits as (first, last + 1).
+    Bytes all set or all clear are taken in one go, only the others bit by
+    bit. """
+    start = end = None
+    for match in _set_bytes.finditer(bits):
+        base = match.start() * 8
+        if match.group(1):
+            ranges = [(base, match.end() * 8)]
+        else:
+            byte = bits[match.start()]
+            ranges = []
+            for bit in xrange(8):
+                if byte & 1 << bit:
+                    if ranges and ranges[-1][1] == base + bit:
+                        ranges[-1] = (ranges[-1][0], base + bit + 1)
+                    else:
+                        ranges.append((base + bit, base + bit + 1))
+        for first, last in ranges:
+            if first == end:
+                end = last
+                continue
+            if start is not None:
+                yield start, end
+            start, end = first, last
+    if start is not None:
+        yield start, end
+
+
+def _set_bits(bits, first, last):
+    """ Sets bits @first up to @last of bytearray @bits. """
+    while first < last and first & 7:
+        bits[first >> 3] |= 1 << (first & 7)
+        first += 1
+    full = (last - first) >> 3
+    if full:
+        bits[first >> 3:(first >> 3) + full] = '\xff' * full
+        first += full << 3
+    while first < last:
+        bits[first >> 3] |= 1 << (first & 7)
+        first += 1
+
+
+def volume_geometry(snapshot):
+    """ Returns (volsize, volblocksize) of zvol @snapshot. """
+    cmd = ['/sbin/zfs', 'get', '-H', '-p', '-o', 'value', 'volsize,volblocksize', snapshot]
+    try:
+        out = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        volsize, block_size = [int(x) for x in out.split()]
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        raise ChangedBlocksError('Could not get size of %s: %s' % (snapshot, e))
+    return volsize, block_size
+
+
+def changed_blocks(name, from_snap, to_snap, bufsize=1024 * 1024):
+    """ Returns ChangedBlocks of local zvol @name from snapshot @from_snap to
+    @to_snap, at its volblocksize. """
+    source = Dataset.from_local(name)
+    for snap in (from_snap, to_snap):
+        if snap not in source.snaps:
+            raise ValueError('No snapshot %s@%s' % (name, snap))
+    if source.position(from_snap) >= source.position(to_snap):
+        raise ValueError('%s is not before %s' % (from_snap, to_snap))
+
+    volsize, block_size = volume_geometry('%s@%s' % (name, to_snap))
+    changes = ChangedBlocks(volsize, block_size)
+    parser = drr.StreamParser(verify_checksums=backup_conf['verify_stream_checksums'])
+    parser.listen(changes)
+
+    # Blocks as they are on disk, nothing decompressed or decrypted for
+    # data we don't look at
+    flags = set('L')
+    flags.update(x for x in 'ce' if x in local_send_flags())
+    if 'w' in local_send_flags() and is_encrypted(name):
+        flags.add('w')
+    cmd = send_cmd(name, '-' + ''.join(sorted(flags)), from_snap, to_snap)
+
+    log.info('Spawning send: %s', cmd)
+    psend = spawn(cmd, replication_priority(),
+                  stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE,
+                  )
+    stderr_reader = AsynchronousFileLogger(psend.stderr, log, 'send_stderr')
+    stderr_reader.start()
+
+    reader = io.FileIO(psend.stdout.fileno(), 'rb', closefd=False)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    try:
+        while True:
+            got = reader.readinto(buf)
+            if not got:
+                break
+            parser.feed(view[:got])
+        parser.close()
+    except drr.StreamError as e:
+        psend.kill()
+        raise ChangedBlocksError('Bad stream for %s: %s' % (name, e))
+    finally:
+        psend.stdout.close()
+        stderr_reader.join()
+        psend.wait()
+
+    if psend.returncode:
+        raise ChangedBlocksError('zfs send of %s failed with %d' % (name, psend.returncode))
+    if parser.substreams[0]['objset_type'] != drr.DMU_OST_ZVOL:
+        raise ValueError('%s is not a volume' % name)
+
+    log.info('%s@%s..%s: %d of %d blocks changed; %s', name, from_snap, to_snap,
+             changes.count(), changes.blocks, parser.summary())
+    return changes
+
+
+def main():
+    if len(sys.argv) not in (4, 5):
+        print >> sys.stderr, 'Usage: %s pool/vol from_snap to_snap [bitmap file]' % sys.argv[0]
+        return 2
+    name, from_snap, to_snap = sys.argv[1:4]
+    try:
+        changes = changed_blocks(name, from_snap, to_snap)
+    except (ValueError, ChangedBlocksError) as e:
+        log.error('%s', e)
+        return 1
+    for offset, length in changes.extents():
+        print '%d\t%d' % (offset, length)
+    if len(sys.argv) == 5:
+        with open(sys.argv[4], 'wb') as f:
+            f.write(changes.changed)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
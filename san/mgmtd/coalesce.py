@@ -0,0 +1,86 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import time
+
+from . import syscalls
+
+
+class WriteCoalescer(object):
+    """ Gathers small writes bound for @fd and hands them over in as few
+    writev(2) calls as possible.
+
+    Pending data should be flushed once it reaches @max_bytes or IOV_MAX
+    buffers, or once the oldest pending buffer is @max_delay seconds old. The
+    caller checks ready() after each write and flushes, and uses time_left()
+    as its poll timeout so a quiet stream still gets flushed.
+    """
+
+    def __init__(self, fd, max_bytes=4 * 1024 * 1024, max_delay=0.05):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        self.fd = fd
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self._pending = []
+        self._pending_bytes = 0
+        self._oldest = None
+
+        self.bytes_written = 0
+        self.syscalls = 0
+
+    def __repr__(self):
+        return '<%s fd=%s pending=%d/%d syscalls=%d>' % (
+            self.__class__.__name__, self.fd,
+            len(self._pending), self._pending_bytes, self.syscalls)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def write(self, buf):
+        """ Queues @buf. """
+        if not self._pending:
+            self._oldest = time.time()
+        self._pending.append(buf)
+        self._pending_bytes += len(buf)
+
+    def time_left(self):
+        """ Seconds until pending data is due to be flushed, None if there is
+        nothing pending. """
+        if not self._pending:
+            return None
+        return max(0, self._oldest + self.max_delay - time.time())
+
+    def ready(self):
+        """ Whether pending data has hit a size or latency threshold. """
+        if not self._pending:
+            return False
+        return self._pending_bytes >= self.max_bytes \
+            or len(self._pending) >= syscalls.IOV_MAX \
+            or self.time_left() == 0
+
+    def flush(self):
+        """ Writes out everything pending. Returns the number of buffers
+        flushed. Raises IOError/OSError if zfs receive went away. """
+        bufs = self._pending
+        count = len(bufs)
+        self._pending = []
+        self._pending_bytes = 0
+        self._oldest = None
+
+        while bufs:
+            written = syscalls.writev(self.fd, bufs)
+            self.syscalls += 1
+            self.bytes_written += written
+
+            # Drop whatever made it out, keep the tail of a short write
+            while bufs and written >= len(bufs[0]):
+                written -= len(bufs[0])
+                bufs.pop(0)
+            if written:
+                bufs[0] = bufs[0][written:]
+
+        return count
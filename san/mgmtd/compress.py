@@ -0,0 +1,224 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import zlib
+
+try:
+    import lz4.block as _lz4
+except ImportError:
+    try:
+        import lz4 as _lz4
+    except ImportError:
+        _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+
+"""
+Wire compression for the replication stream
+"""
+
+
+class Codec(object):
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+
+    def compress(self, data):
+        return _lz4.compress(data)
+
+    def decompress(self, data):
+        return _lz4.decompress(data)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        self._c = _zstd.ZstdCompressor(level=level)
+        self._d = _zstd.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._c.compress(data)
+
+    def decompress(self, data):
+        return self._d.decompress(data)
+
+
+def to_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+codecs = dict(zlib=ZlibCodec)
+if _lz4:
+    codecs['lz4'] = Lz4Codec
+if _zstd:
+    codecs['zstd'] = ZstdCodec
+
+
+def get_codec(name):
+    """ Returns a Codec for @name, or None if it's not available here. """
+    if not name:
+        return None
+    cls = codecs.get(name)
+    if not cls:
+        log.warning('Compression codec %s is not available, sending raw', name)
+        return None
+    return cls()
+
+
+class CompressionStats(object):
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.chunks = 0
+        self.compressed_chunks = 0
+
+    @property
+    def ratio(self):
+        if not self.bytes_out:
+            return 1.0
+        return float(self.bytes_in) / self.bytes_out
+
+    def __repr__(self):
+        return '<%s ratio=%.2f chunks=%d/%d %.2fs>' % (
+            self.__class__.__name__, self.ratio,
+            self.compressed_chunks, self.chunks, self.seconds)
+
+
+class AdaptiveCompressor(object):
+    """ Compresses chunks with @codec while it pays off.
+
+    A chunk is sent raw when compressing it didn't get it below @min_ratio of
+    its size. Once a whole window of @sample_every chunks fails to, the
+    compressor switches itself off and only samples one chunk in every
+    @sample_every to see whether the data has become compressible again.
+    """
+
+    def __init__(self, codec, sample_every=64, min_ratio=0.9):
+        self.codec = codec
+        self.sample_every = sample_every
+        self.min_ratio = min_ratio
+        self.enabled = True
+        self.stats = CompressionStats()
+
+        self._window = 0
+        self._window_wins = 0
+        self._skipped = 0
+
+    def __repr__(self):
+        return '<%s %s enabled=%s %s>' % (
+            self.__class__.__name__, self.codec.name, self.enabled, self.stats)
+
+    def compress(self, data):
+        """ Returns (payload, codec name or None if @data is sent raw). """
+        if not self.should_compress():
+            return self.account(data, None)
+        start = time.time()
+        packed = self.codec.compress(to_bytes(data))
+        return self.account(data, packed, time.time() - start)
+
+    def should_compress(self):
+        """ First half of compress(), for when the compressing itself happens
+        elsewhere (see pipeline): whether this chunk is worth trying. """
+        if self.enabled:
+            return True
+        self._skipped += 1
+        if self._skipped < self.sample_every:
+            return False
+        self._skipped = 0
+        return True
+
+    def account(self, data, packed, seconds=0):
+        """ Second half of compress(); @packed is what the codec made of
+        @data, or None if it wasn't tried. Must be called in chunk order. """
+        self.stats.chunks += 1
+        self.stats.seconds += seconds
+        size = len(data)
+        self.stats.bytes_in += size
+
+        if packed is None:
+            self.stats.bytes_out += size
+            return data, None
+
+        won = len(packed) < size * self.min_ratio
+        self._judge(won)
+
+        if won:
+            self.stats.bytes_out += len(packed)
+            self.stats.compressed_chunks += 1
+            return packed, self.codec.name
+        self.stats.bytes_out += size
+        return data, None
+
+    def _judge(self, won):
+        if not self.enabled:
+            if won:
+                log.info('%s: Data looks compressible again, enabling', self)
+                self.enabled = True
+                self._window = self._window_wins = 0
+            return
+
+        self._window += 1
+        self._window_wins += int(won)
+        if self._window < self.sample_every:
+            return
+        if not self._window_wins:
+            log.info('%s: Data looks incompressible, disabling', self)
+            self.enabled = False
+        self._window = self._window_wins = 0
+
+
+class Decompressor(object):
+    """ Receive side counterpart, handles whatever codec a chunk says. """
+
+    def __init__(self):
+        self._codecs = {}
+        self.stats = CompressionStats()
+
+    def decompress(self, data, codec_name):
+        self.stats.chunks += 1
+        self.stats.bytes_out += len(data)
+        if not codec_name:
+            self.stats.bytes_in += len(data)
+            return data
+
+        codec = self._codecs.get(codec_name)
+        if not codec:
+            codec = self._codecs[codec_name] = codecs[codec_name]()
+
+        start = time.time()
+        ret = codec.decompress(data)
+        self.stats.seconds += time.time() - start
+        self.stats.bytes_in += len(ret)
+        self.stats.compressed_chunks += 1
+        return ret
@@ -0,0 +1,549 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import struct
+import ctypes
+import ctypes.util
+
+
+"""
+ZFS send stream parsing.
+
+A zfs send stream is a sequence of dmu_replay_record_t: 312 byte records,
+each with a type and a per type union, some followed by a payload (the data
+of a WRITE, the bonus buffer of an OBJECT, ...). A stream of one snapshot is
+a substream, BEGIN ... END. Compound streams, which is what -I, -R and -p
+sends are, go:
+
+    BEGIN (compound, nvlist payload) END    the header
+    BEGIN ... END                           a substream per snapshot
+    END                                     all zero, concluding the lot
+
+    0     drr_type, drr_payloadlen (uint32 each)
+    8     per type fields
+    280   drr_checksum: fletcher4 of the stream so far (0 if not given)
+
+Every record's checksum slot has the running fletcher4 of the substream up to
+and including the record's first 280 bytes, and END carries that of
+everything before it; either is left zero by older zfs versions.
+
+StreamParser is fed the stream in whatever pieces it comes in and walks it in
+place; only a record header split across two pieces gets copied, payloads
+never do. It keeps counts and bytes per record type and per object, checks
+records come in a sensible order with sane sizes, and optionally verifies the
+checksums. Most records are WRITEs of a whole block, so on a stream of 128K
+blocks it's a few struct unpacks every 128K; verifying checksums costs what
+fletcher4 over the data costs, which is little with libzfs' SIMD version and a
+lot with the pure Python one used without it.
+"""
+
+
+DMU_BACKUP_MAGIC = 0x2F5bacbac
+
+# DMU_GET_STREAM_HDRTYPE of drr_versioninfo
+DMU_SUBSTREAM = 1
+DMU_COMPOUNDSTREAM = 2
+
+# drr_begin.drr_type, dmu_objset_type_t
+DMU_OST_ZFS = 2
+DMU_OST_ZVOL = 3
+
+record_size = 312
+checksum_offset = 280
+
+(BEGIN, OBJECT, FREEOBJECTS, WRITE, FREE, END, WRITE_BYREF, SPILL,
+ WRITE_EMBEDDED, OBJECT_RANGE, REDACT) = range(11)
+
+record_names = ('begin', 'object', 'freeobjects', 'write', 'free', 'end',
+                'write_byref', 'spill', 'write_embedded', 'object_range',
+                'redact')
+
+# FREE to the end of the object
+FREE_TO_END = 2 ** 64 - 1
+
+# SPA_MAXBLOCKSIZE, nothing but BEGIN's nvlist comes with more
+max_payload = 16 * 1024 * 1024
+max_begin_payload = 256 * 1024 * 1024
+
+# Per type fields at offset 8, object number first where there is one. The
+# byte order goes in front.
+_fields = {
+    # magic, versioninfo, creation_time, type, flags, toguid, fromguid
+    BEGIN: 'QQQIIQQ',
+    # object, type, bonustype, blksz, bonuslen, checksumtype, compress,
+    # dn_slots, flags, raw_bonuslen
+    OBJECT: 'QIIIIBBBBI',
+    # firstobj, numobjs, toguid
+    FREEOBJECTS: 'QQQ',
+    # object, type, pad, offset, logical_size, toguid, checksumtype, flags,
+    # compressiontype, (pad, ddt key), compressed_size
+    WRITE: 'QIIQQQBBB5x40xQ',
+    # object, offset, length, toguid
+    FREE: 'QQQQ',
+    # checksum, toguid
+    END: '4QQ',
+    # object, offset, length, toguid
+    WRITE_BYREF: 'QQQQ',
+    # object, length, toguid, flags, compressiontype, (pad), compressed_size
+    SPILL: 'QQQBB6xQ',
+    # object, offset, length, toguid, compression, etype, (pad), lsize, psize
+    WRITE_EMBEDDED: 'QQQQBB6xII',
+    # firstobj, numslots, toguid
+    OBJECT_RANGE: 'QQQ',
+    # object, offset, length, toguid
+    REDACT: 'QQQQ',
+}
+
+# Where the toguid is in each of the above, for checking records belong to
+# the substream they're in
+_toguid_field = {FREEOBJECTS: 2, WRITE: 5, FREE: 3, END: 4, WRITE_BYREF: 3,
+                 SPILL: 2, WRITE_EMBEDDED: 3, OBJECT_RANGE: 2, REDACT: 3}
+
+_name_offset = 56
+
+
+class _ByteOrder(object):
+    """ Structs for one byte order of the stream. """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.header = struct.Struct(prefix + 'II')
+        self.checksum = struct.Struct(prefix + '4Q')
+        self.fields = dict((k, struct.Struct(prefix + v)) for k, v in _fields.iteritems())
+
+
+_little = _ByteOrder('<')
+_big = _ByteOrder('>')
+_native = _little if struct.pack('=I', 1) == struct.pack('<I', 1) else _big
+
+
+class StreamError(ValueError):
+    """ Stream isn't a well formed zfs send stream. """
+
+
+"""
+Fletcher4, as zfs has it: four 64 bit sums over the stream as 32 bit words.
+"""
+
+
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [('buf', ctypes.c_void_p),
+                ('obj', ctypes.c_void_p),
+                ('len', ctypes.c_ssize_t),
+                ('itemsize', ctypes.c_ssize_t),
+                ('readonly', ctypes.c_int),
+                ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p),
+                ('shape', ctypes.c_void_p),
+                ('strides', ctypes.c_void_p),
+                ('suboffsets', ctypes.c_void_p),
+                ('smalltable', ctypes.c_ssize_t * 2),
+                ('internal', ctypes.c_void_p)]
+
+
+_get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer), ctypes.c_int]
+_get_buffer.restype = ctypes.c_int
+_release_buffer = ctypes.pythonapi.PyBuffer_Release
+_release_buffer.argtypes = [ctypes.POINTER(_Py_buffer)]
+_release_buffer.restype = None
+
+
+def _load_fletcher():
+    """ Returns libzfs' (native, byteswap) incremental fletcher4, or None if
+    there's no libzfs to be had. """
+    for name in ('zfs', 'zpool'):
+        path = ctypes.util.find_library(name)
+        if not path:
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+            funcs = (lib.fletcher_4_incremental_native,
+                     lib.fletcher_4_incremental_byteswap)
+        except (OSError, AttributeError):
+            continue
+        for func in funcs:
+            func.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+        # Picks the fastest implementation for this CPU
+        init = getattr(lib, 'fletcher_4_init', None)
+        if init:
+            init()
+        return funcs
+
+
+_fletcher = _load_fletcher()
+
+
+class Fletcher4(object):
+    """ Incremental fletcher4 of the words of a stream in byte order
+    @prefix ('<' or '>'). Uses libzfs' when it can, which is SIMD and
+    copes with line rate; the pure Python one doesn't. """
+
+    accelerated = _fletcher is not None
+
+    def __init__(self, prefix='<'):
+        self.prefix = prefix
+        self._state = (ctypes.c_uint64 * 4)()
+        self._tail = ''
+        if _fletcher:
+            self._func = _fletcher[0] if prefix == _native.prefix else _fletcher[1]
+
+    def reset(self):
+        ctypes.memset(self._state, 0, ctypes.sizeof(self._state))
+        self._tail = ''
+
+    def digest(self):
+        """ Returns the four sums. """
+        return tuple(self._state)
+
+    def update(self, view):
+        if self._tail:
+            # Finish the word left over from last time
+            take = 4 - len(self._tail)
+            word, view = self._tail + view[:take].tobytes(), view[take:]
+            if len(word) < 4:
+                self._tail = word
+                return
+            self._tail = ''
+            self._update(memoryview(word))
+        aligned = len(view) & ~3
+        if aligned < len(view):
+            self._tail = view[aligned:].tobytes()
+        if aligned:
+            self._update(view[:aligned])
+
+    def _update(self, view):
+        if _fletcher:
+            buf = _Py_buffer()
+            _get_buffer(view, ctypes.byref(buf), 0)
+            try:
+                self._func(buf.buf, buf.len, self._state)
+            finally:
+                _release_buffer(ctypes.byref(buf))
+            return
+
+        mask = 2 ** 64 - 1
+        a, b, c, d = self._state
+        step = 16 * 1024
+        for start in xrange(0, len(view) // 4, step):
+            count = min(step, len(view) // 4 - start)
+            for word in struct.unpack_from('%s%dI' % (self.prefix, count), view, start * 4):
+                a += word
+                b += a
+                c += b
+                d += c
+            a, b, c, d = a & mask, b & mask, c & mask, d & mask
+        self._state[:] = [a, b, c, d]
+
+
+class StreamParser(object):
+    """ Walks a zfs send stream fed to it a piece at a time.
+
+    Raises StreamError from feed() or close() at the first thing wrong with
+    it, and keeps raising it after. Listeners added with listen() are called
+    with (record type, fields) for every record but BEGIN and END, fields
+    being the unpacked per type fields as laid out in _fields.
+
+    substreams has a dict for each substream's BEGIN, and compound one for
+    the header of a compound stream, None if it isn't one.
+
+    Stats are kept per record type (records and bytes, payloads included) and
+    per object for up to @max_objects objects: records, bytes, bytes written
+    and bytes freed. Records of objects past that are only counted, in
+    untracked_records.
+    """
+
+    def __init__(self, verify_checksums=True, max_objects=1024 * 1024):
+        self.verify_checksums = verify_checksums
+        self.max_objects = max_objects
+        self.offset = 0
+        self.error = None
+        self.substreams = []
+        self.compound = None
+        self.counts = [0] * len(record_names)
+        self.sizes = [0] * len(record_names)
+        self.objects = {}
+        self.untracked_records = 0
+        self._listeners = []
+
+        self._order = _little
+        self._cksum = None
+        # Stream header type of the BEGIN we're inside of, if any
+        self._inside = None
+        self._concluded = False
+        self._toguid = None
+        self._pending = bytearray()
+        self._payload_left = 0
+
+        if verify_checksums and not Fletcher4.accelerated:
+            log.warning('No libzfs fletcher4, verifying stream checksums will be slow')
+
+    def __repr__(self):
+        return '<%s at %d, %d substreams, %d records>' % (
+            self.__class__.__name__, self.offset, len(self.substreams),
+            sum(self.counts))
+
+    def listen(self, callback):
+        self._listeners.append(callback)
+
+    def type_stats(self):
+        """ Returns {record type name: (records, bytes)} of those seen. """
+        return dict((name, (self.counts[i], self.sizes[i]))
+                    for i, name in enumerate(record_names) if self.counts[i])
+
+    def summary(self):
+        return '%d bytes in %d substream(s): %s; %d objects' % (
+            self.offset, len(self.substreams),
+            ', '.join('%s=%d/%d' % (k, v[0], v[1])
+                      for k, v in sorted(self.type_stats().iteritems())),
+            len(self.objects))
+
+    def _fail(self, message, *args):
+        self.error = StreamError('At byte %d: %s' % (self.offset, message % args))
+        raise self.error
+
+    def feed(self, data):
+        """ Takes the next piece of the stream. """
+        if self.error:
+            raise self.error
+        view = memoryview(data)
+        pos, end = 0, len(view)
+        base = self.offset
+        fast = None
+        while pos < end:
+            left = self._payload_left
+            if left:
+                count = left if left < end - pos else end - pos
+                if self._cksum:
+                    self._cksum.update(view[pos:pos + count])
+                self._payload_left = left - count
+                pos += count
+                continue
+
+            if self._pending or end - pos < record_size:
+                # Header split across pieces, the one thing that's copied
+                self.offset = base + pos - len(self._pending)
+                count = min(record_size - len(self._pending), end - pos)
+                self._pending += view[pos:pos + count].tobytes()
+                pos += count
+                if len(self._pending) < record_size:
+                    break
+                pending, self._pending = self._pending, bytearray()
+                self._record(memoryview(pending), 0)
+                fast = None
+                continue
+
+            if fast is None:
+                fast = self._fast_path()
+            if fast:
+                # Plain WRITEs with nothing else to do for them; the bulk of
+                # any stream, so spelled out here
+                header, write, toguid, objects, counts, sizes = fast
+                if header.unpack_from(view, pos)[0] == WRITE:
+                    fields = write.unpack_from(view, pos + 8)
+                    written = fields[4]
+                    payload = fields[9] if fields[8] else written
+                    if fields[5] == toguid and written and payload <= max_payload:
+                        stats = objects.get(fields[0])
+                        if stats is not None:
+                            stats[0] += 1
+                            stats[1] += record_size + payload
+                            stats[2] += written
+                            counts[WRITE] += 1
+                            sizes[WRITE] += record_size + payload
+                            pos += record_size + payload
+                            if pos > end:
+                                self._payload_left = pos - end
+                            continue
+
+            # Anything else, and WRITEs that don't pass, the long way
+            self.offset = base + pos
+            self._record(view, pos)
+            pos += record_size
+            fast = None
+        self.offset = base + end
+
+    def _fast_path(self):
+        """ Returns what feed() wants for taking WRITEs in a hurry, False if
+        it can't now. """
+        if self._cksum or self._listeners or self._inside != DMU_SUBSTREAM:
+            return False
+        order = self._order
+        return (order.header, order.fields[WRITE], self._toguid, self.objects,
+                self.counts, self.sizes)
+
+    def close(self):
+        """ The stream is over; raises StreamError if it was cut short. """
+        if self.error:
+            raise self.error
+        if self._pending or self._payload_left:
+            self._fail('Truncated in the middle of a record')
+        if self._inside:
+            self._fail('Ended before its END record')
+        if self.compound and not self._concluded:
+            self._fail('Ended before its final END record')
+        if not self.substreams:
+            self._fail('Empty stream')
+
+    def _begin(self, record):
+        order = self._order
+        if order.fields[BEGIN].unpack_from(record, 8)[0] != DMU_BACKUP_MAGIC:
+            # Sent from a box of the other byte order
+            order = _big if order is _little else _little
+            if order.fields[BEGIN].unpack_from(record, 8)[0] != DMU_BACKUP_MAGIC:
+                self._fail('Bad magic in BEGIN record')
+            self._order = order
+
+        (magic, versioninfo, creation_time, objset_type, flags,
+         toguid, fromguid) = order.fields[BEGIN].unpack_from(record, 8)
+        hdrtype = versioninfo & 3
+        if hdrtype not in (DMU_SUBSTREAM, DMU_COMPOUNDSTREAM):
+            self._fail('Unknown stream header type %d', hdrtype)
+        if self._inside:
+            self._fail('BEGIN inside a substream')
+        if self._concluded:
+            self._fail('BEGIN after the final END')
+        if hdrtype == DMU_COMPOUNDSTREAM and (self.compound or self.substreams):
+            self._fail('Compound stream header past the start')
+        self._inside = hdrtype
+        self._toguid = toguid
+
+        name = record[_name_offset:].tobytes().split('\0', 1)[0]
+        begin = dict(name=name, toguid=toguid, fromguid=fromguid,
+                     creation_time=creation_time, objset_type=objset_type,
+                     features=versioninfo >> 2, offset=self.offset)
+        if hdrtype == DMU_COMPOUNDSTREAM:
+            self.compound = begin
+        else:
+            self.substreams.append(begin)
+
+        # Each substream is checksummed from its BEGIN on
+        if self.verify_checksums:
+            if self._cksum is None or self._cksum.prefix != order.prefix:
+                self._cksum = Fletcher4(order.prefix)
+            else:
+                self._cksum.reset()
+
+    def _record(self, buf, pos):
+        order = self._order
+        rtype, payload = order.header.unpack_from(buf, pos)
+
+        if rtype == BEGIN:
+            self._begin(buf[pos:pos + record_size])
+            order = self._order
+        elif rtype > REDACT:
+            self._fail('Unknown record type %d', rtype)
+        elif self._concluded:
+            self._fail('%s record after the final END', record_names[rtype])
+        elif not self._inside and (rtype != END or not self.compound):
+            self._fail('%s record outside of a substream', record_names[rtype])
+
+        fields = order.fields[rtype].unpack_from(buf, pos + 8)
+        cksum = self._cksum
+        if cksum:
+            before = cksum.digest() if rtype == END else None
+            cksum.update(buf[pos:pos + checksum_offset])
+            if rtype != BEGIN:
+                given = order.checksum.unpack_from(buf, pos + checksum_offset)
+                if any(given) and given != cksum.digest():
+                    self._fail('Checksum mismatch on %s record', record_names[rtype])
+            cksum.update(buf[pos + checksum_offset:pos + record_size])
+
+        if rtype == WRITE:
+            # The bulk of any stream, so spelled out here
+            if self._inside != DMU_SUBSTREAM:
+                self._fail('write record outside of a substream')
+            if fields[5] != self._toguid:
+                self._fail('write record of a different snapshot')
+            written = fields[4]
+            if not written:
+                self._fail('Empty WRITE')
+            payload = fields[9] if fields[8] else written
+            if payload > max_payload:
+                self._fail('write payload of %d bytes', payload)
+            stats = self.objects.get(fields[0])
+            if stats is None:
+                stats = self._new_object(fields[0])
+            if stats:
+                stats[0] += 1
+                stats[1] += record_size + payload
+                stats[2] += written
+        elif rtype == BEGIN:
+            if payload > max_begin_payload:
+                self._fail('BEGIN payload of %d bytes', payload)
+        elif rtype == END:
+            payload = 0
+            if not self._inside:
+                # Concluding a compound stream
+                if any(fields):
+                    self._fail('Final END with something in it')
+                self._concluded = True
+            else:
+                # A substream's END, or the compound header's, which has no
+                # toguid but is checksummed all the same
+                if fields[4] != (self._toguid if self._inside == DMU_SUBSTREAM else 0):
+                    self._fail('END of a different snapshot')
+                if cksum and any(fields[:4]) and fields[:4] != before:
+                    self._fail('Checksum mismatch at END')
+                self._inside = None
+        else:
+            if self._inside != DMU_SUBSTREAM:
+                self._fail('%s record outside of a substream', record_names[rtype])
+            toguid = _toguid_field.get(rtype)
+            if toguid is not None and fields[toguid] != self._toguid:
+                self._fail('%s record of a different snapshot', record_names[rtype])
+            payload = self._object_record(rtype, fields)
+            if payload > max_payload:
+                self._fail('%s payload of %d bytes', record_names[rtype], payload)
+
+        if self._listeners and rtype != BEGIN and rtype != END:
+            for callback in self._listeners:
+                callback(rtype, fields)
+
+        self.counts[rtype] += 1
+        self.sizes[rtype] += record_size + payload
+        self._payload_left = payload
+
+    def _new_object(self, obj):
+        """ Returns a new stats list for object @obj, None if there are too
+        many already. """
+        if len(self.objects) >= self.max_objects:
+            self.untracked_records += 1
+            return None
+        stats = self.objects[obj] = [0, 0, 0, 0]
+        return stats
+
+    def _object_record(self, rtype, fields):
+        """ Checks and accounts a record other than BEGIN, END or WRITE,
+        returns its payload size. """
+        payload = written = freed = 0
+        if rtype == OBJECT:
+            payload = fields[9] or (fields[4] + 7) & ~7
+            if not fields[3] or fields[3] % 512:
+                self._fail('OBJECT %d with block size %d', fields[0], fields[3])
+        elif rtype == FREE:
+            if fields[2] != FREE_TO_END:
+                freed = fields[2]
+        elif rtype == WRITE_EMBEDDED:
+            written = fields[2]
+            payload = (fields[7] + 7) & ~7
+        elif rtype == WRITE_BYREF:
+            written = fields[2]
+        elif rtype == SPILL:
+            written = fields[1]
+            payload = fields[5] or written
+        else:
+            # FREEOBJECTS, OBJECT_RANGE and REDACT: nothing to account per
+            # object, or no one object
+            return payload
+
+        stats = self.objects.get(fields[0])
+        if stats is None:
+            stats = self._new_object(fields[0])
+        if stats:
+            stats[0] += 1
+            stats[1] += record_size + payload
+            stats[2] += written
+            stats[3] += freed
+        return payload
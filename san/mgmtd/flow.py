@@ -0,0 +1,163 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import zmq
+
+
+"""
+Credit based flow control for the replication stream.
+
+The receiver grants the sender a window of chunks when a session opens, and
+grants more as it hands chunks off to zfs receive. The sender never has more
+than the window outstanding, so memory on both ends is bounded by
+window * chunk_size no matter how far the receiver falls behind.
+
+Credit messages also acknowledge the highest chunk handed off, and the
+receiver may NACK ranges of chunks it needs again (see framing); both are
+control messages the sender handles wherever it happens to be waiting.
+"""
+
+control_messages = ('credit', 'nack')
+
+
+class FlowError(Exception):
+    """ Stream can not continue. """
+
+
+class CreditTimeout(FlowError):
+    """ Receiver stopped granting credit. """
+
+
+class ReceiverError(FlowError):
+    """ Receiver gave up on the session. """
+
+
+class CreditWindow(object):
+    """ Sender side credit accounting. """
+
+    def __init__(self, credits=0, on_nack=None):
+        self.credits = credits
+        self.exhausted = 0
+        self.acked = -1
+        self.on_nack = on_nack
+
+    def __repr__(self):
+        return '<%s credits=%d acked=%d>' % (self.__class__.__name__,
+                                            self.credits, self.acked)
+
+    def grant(self, count, ack=None):
+        self.credits += count
+        if ack is not None:
+            self.acked = max(self.acked, ack)
+
+    def control(self, buf):
+        """ Applies control message @buf. """
+        if buf[1] == 'credit':
+            self.grant(int(buf[3]), int(buf[4]) if len(buf) > 4 else None)
+        elif buf[1] == 'nack':
+            if not self.on_nack:
+                raise FlowError('Receiver wants chunks %s-%s again but we '
+                                'can not replay' % (buf[3], buf[4]))
+            self.on_nack(int(buf[3]), int(buf[4]))
+
+    def take(self):
+        """ Uses up a credit, returns False if none are left. """
+        if self.credits <= 0:
+            return False
+        self.credits -= 1
+        return True
+
+
+class CreditGranter(object):
+    """ Receiver side credit accounting. Re-grants in batches so there isn't
+    a credit message for every chunk. """
+
+    def __init__(self, window, batch=None):
+        self.window = window
+        self._batch = batch
+        self._consumed = 0
+        self._withheld = 0
+
+    @property
+    def batch(self):
+        # Never more than the window, or the sender runs dry waiting on it
+        default = max(1, self.window // 4)
+        return min(self._batch, default) if self._batch else default
+
+    def initial(self):
+        return self.window
+
+    def resize(self, window):
+        """ Changes the window to @window chunks. Returns credit to grant now
+        if it grew; if it shrank, the difference is kept from the next
+        grants instead, as the sender already has it. """
+        delta = window - self.window
+        self.window = window
+        if delta < 0:
+            self._withheld -= delta
+            return 0
+        paid = min(delta, self._withheld)
+        self._withheld -= paid
+        return delta - paid
+
+    def consumed(self, count=1):
+        """ Marks @count chunks as handed off. Returns credit to grant now,
+        or 0 if it's not worth a message yet. """
+        self._consumed += count
+        if self._withheld:
+            paid = min(self._withheld, self._consumed)
+            self._withheld -= paid
+            self._consumed -= paid
+        if self._consumed < self.batch:
+            return 0
+        ret, self._consumed = self._consumed, 0
+        return ret
+
+
+def recv_reply(sock, expect, window=None, timeout=None):
+    """ Receives from @sock until a message with command @expect shows up (or
+    any non-control message if @expect is None), applying any control
+    messages seen along the way to @window. Returns the message, raises
+    ReceiverError if the receiver replies with an error instead. """
+    poller = zmq.Poller()
+    poller.register(sock, zmq.POLLIN)
+
+    while True:
+        if timeout is not None and not poller.poll(timeout * 1000):
+            raise CreditTimeout('Timed out waiting for %s' % expect)
+        buf = sock.recv_multipart()
+        if buf[1] in control_messages and window is not None:
+            window.control(buf)
+        if buf[1] == 'error' and expect != 'error':
+            raise ReceiverError(' '.join(buf[3:]))
+        if buf[1] == expect or (expect is None and buf[1] not in control_messages):
+            return buf
+        if buf[1] not in control_messages:
+            log.warning('Unexpected message while waiting for %s: %s',
+                        expect, repr(buf[1]))
+
+
+def pump(sock, window, timeout=0):
+    """ Applies whatever control messages are waiting on @sock, waiting up to
+    @timeout seconds for the first. """
+    while sock.poll(timeout * 1000):
+        buf = sock.recv_multipart()
+        if buf[1] in control_messages:
+            window.control(buf)
+        elif buf[1] == 'error':
+            raise ReceiverError(' '.join(buf[3:]))
+        else:
+            log.warning('Unexpected message: %s', repr(buf[1]))
+        timeout = 0
+
+
+def wait_for_credit(sock, window, timeout=None):
+    """ Blocks until @window has credit, applying grants received on @sock.
+    Grants usually arrive well before the window runs dry, in which case they
+    are already queued on the socket and this doesn't block. """
+    if window.credits > 0:
+        return
+    window.exhausted += 1
+    while window.credits <= 0:
+        recv_reply(sock, 'credit', window, timeout=timeout)
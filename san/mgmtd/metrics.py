@@ -0,0 +1,53 @@
+
+import threading
+
+
+class Metrics(object):
+    """ Process wide registry of counters and gauges for replication.
+
+    Gauges may be registered as callables so hot paths don't pay for updates,
+    they are only evaluated when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._gauges = {}
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def get(self, name, default=None):
+        with self._lock:
+            if name in self._gauges:
+                return self._gauges[name]()
+            return self._values.get(name, default)
+
+    def gauge(self, name, func):
+        with self._lock:
+            self._gauges[name] = func
+
+    def remove(self, prefix):
+        """ Drops everything under @prefix, ie when a session goes away. """
+        with self._lock:
+            for d in (self._values, self._gauges):
+                for k in [k for k in d if k.startswith(prefix)]:
+                    del d[k]
+
+    def snapshot(self, prefix=''):
+        with self._lock:
+            ret = dict((k, v) for k, v in self._values.iteritems()
+                       if k.startswith(prefix))
+            gauges = [(k, f) for k, f in self._gauges.iteritems()
+                      if k.startswith(prefix)]
+        for k, f in gauges:
+            ret[k] = f()
+        return ret
+
+
+metrics = Metrics()
@@ -0,0 +1,121 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import threading
+import collections
+import multiprocessing
+import multiprocessing.pool
+
+from .compress import codecs, to_bytes
+from .framing import checksums
+
+
+"""
+Offloads per chunk CPU work (compression, checksums) to a pool, so the sender
+isn't capped at one core. Results come back in chunk order.
+"""
+
+
+_local = threading.local()
+
+
+def _get_codec(name):
+    # Codecs may carry (de)compression contexts that can't be shared, so
+    # every worker thread/process gets its own.
+    cache = getattr(_local, 'codecs', None)
+    if cache is None:
+        cache = _local.codecs = {}
+    codec = cache.get(name)
+    if codec is None:
+        codec = cache[name] = codecs[name]()
+    return codec
+
+
+def process_chunk(data, codec_name=None, checksum_name=None):
+    """ Worker side: returns (compressed or None, seconds spent, checksum or None). """
+    start = time.time()
+    data = to_bytes(data)
+    packed = None
+    if codec_name:
+        packed = _get_codec(codec_name).compress(data)
+    checksum = None
+    if checksum_name:
+        checksum = checksums[checksum_name](data)
+    return packed, time.time() - start, checksum
+
+
+class _Done(object):
+    """ Stands in for an AsyncResult when running inline. """
+
+    def __init__(self, value):
+        self._value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self._value
+
+
+class OrderedStage(object):
+    """ Runs process_chunk() over a pool of @workers threads or processes
+    (@kind), at most @max_pending chunks at a time, handing results back in
+    submission order. With no workers everything runs inline.
+
+    Threads are enough when the codec releases the GIL (zlib, lz4 and zstd
+    all do), processes cost a copy of each chunk but always scale.
+    """
+
+    def __init__(self, workers=0, kind='thread', max_pending=None):
+        self.workers = workers
+        self.kind = kind
+        self.max_pending = max_pending or max(1, workers * 2)
+        self._pending = collections.deque()
+        self._pool = None
+        if workers:
+            if kind == 'process':
+                self._pool = multiprocessing.Pool(workers)
+            else:
+                self._pool = multiprocessing.pool.ThreadPool(workers)
+
+    def __repr__(self):
+        return '<%s %s workers=%d pending=%d>' % (
+            self.__class__.__name__, self.kind, self.workers, len(self._pending))
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def full(self):
+        return len(self._pending) >= self.max_pending
+
+    def submit(self, data, context=None, codec_name=None, checksum_name=None):
+        """ Queues @data; @context comes back alongside its result. """
+        args = (data, codec_name, checksum_name)
+        if not (codec_name or checksum_name):
+            result = _Done((None, 0, None))
+        elif not self._pool:
+            result = _Done(process_chunk(*args))
+        else:
+            if self.kind == 'process':
+                # Has to be pickled anyway
+                args = (to_bytes(data), codec_name, checksum_name)
+            result = self._pool.apply_async(process_chunk, args)
+        self._pending.append((result, context))
+
+    def ready(self):
+        """ Whether the oldest chunk's result is in. """
+        return bool(self._pending) and self._pending[0][0].ready()
+
+    def get(self):
+        """ Returns ((compressed, seconds, checksum), context) for the oldest
+        chunk, blocking until it's done. """
+        result, context = self._pending.popleft()
+        return result.get(), context
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
@@ -0,0 +1,133 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import io
+import errno
+
+from . import syscalls
+from .ringbuffer import RingBuffer, RingBufferReader, RingBufferAborted
+
+
+"""
+Pipe to pipe transfers
+"""
+
+# Don't bother splicing less than this per call, it's all syscall overhead.
+SPLICE_CHUNK = 1024 * 1024
+
+
+def _fileno(f):
+    if hasattr(f, 'fileno'):
+        return f.fileno()
+    return f
+
+
+def splice_pipe(src, dst, chunk_size=SPLICE_CHUNK, throttle=None):
+    """ Moves everything from @src to @dst via splice(2) until EOF. Payload
+    never enters userspace. @throttle, if given, is called with each count
+    of bytes moved (see shaping). Returns bytes moved. """
+    src_fd = _fileno(src)
+    dst_fd = _fileno(dst)
+
+    for fd in (src_fd, dst_fd):
+        syscalls.set_pipe_size(fd, chunk_size)
+
+    total = 0
+    while True:
+        try:
+            moved = syscalls.splice(src_fd, dst_fd, chunk_size)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.EPIPE:
+                log.error('Broken pipe on recv')
+                break
+            raise
+        if not moved:
+            break
+        total += moved
+        if throttle:
+            throttle(moved)
+    return total
+
+
+def copy_pipe(src, dst, bufsize=SPLICE_CHUNK, throttle=None):
+    """ Copies everything from @src to @dst through a single reused buffer
+    until EOF, calling @throttle like splice_pipe does. Returns bytes moved. """
+    reader = io.FileIO(_fileno(src), 'rb', closefd=False)
+    writer = io.FileIO(_fileno(dst), 'wb', closefd=False)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+
+    total = 0
+    while True:
+        try:
+            got = reader.readinto(buf)
+        except IOError:
+            log.error('Broken pipe on send')
+            break
+        if not got:
+            break
+
+        try:
+            written = 0
+            while written < got:
+                written += writer.write(view[written:got])
+        except IOError:
+            log.error('Broken pipe on recv')
+            break
+        total += got
+        if throttle:
+            throttle(got)
+    return total
+
+
+def buffered_pipe(src, dst, bufsize=SPLICE_CHUNK, ring=None, throttle=None, **ring_kwargs):
+    """ Moves @src to @dst through a RingBuffer with the reading side in its
+    own thread, so a stall on either end is soaked up by the ring instead of
+    stalling the other. Calls @throttle like splice_pipe does. Returns bytes
+    moved. """
+    if ring is None:
+        ring = RingBuffer(**ring_kwargs)
+    reader = RingBufferReader(src, ring)
+    reader.start()
+
+    writer = io.FileIO(_fileno(dst), 'wb', closefd=False)
+    try:
+        total = ring.drain_to(writer, max_size=bufsize, throttle=throttle)
+    except IOError:
+        log.error('Broken pipe on recv')
+        ring.abort()
+        total = ring.bytes_out
+    except RingBufferAborted:
+        total = ring.bytes_out
+    reader.join()
+
+    log.debug('%s: producer_stalls=%d consumer_stalls=%d', ring,
+              ring.producer_stalls, ring.consumer_stalls)
+    return total
+
+
+def transfer(src, dst, mode='splice', bufsize=SPLICE_CHUNK, throttle=None, **ring_kwargs):
+    """ Moves @src to @dst using @mode ('splice', 'buffer' or 'copy'), falling
+    back to copy if splice is not available here. @throttle is called with
+    byte counts as they're moved, see splice_pipe. Returns (bytes moved, mode
+    used). """
+    if mode == 'buffer':
+        return buffered_pipe(src, dst, bufsize=bufsize, throttle=throttle,
+                             **ring_kwargs), 'buffer'
+    if mode == 'splice':
+        if syscalls.splice_available():
+            try:
+                return splice_pipe(src, dst, chunk_size=bufsize,
+                                   throttle=throttle), 'splice'
+            except OSError as e:
+                # Only safe to fall back if nothing has moved yet, splice
+                # raises these on the very first call for unsupported fds.
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                log.warning('Splice not usable (%s), falling back to copy', e)
+        else:
+            log.warning('Splice not available, falling back to copy')
+    return copy_pipe(src, dst, bufsize=bufsize, throttle=throttle), 'copy'
@@ -0,0 +1,243 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import sys
+import errno
+import subprocess
+
+from . import syscalls
+
+
+"""
+CPU and I/O priority for replication and snapshot deletion.
+
+Large sends compete with the zvols exported over SCST for disk and CPU, so
+the zfs send/receive processes we spawn can be run with an ionice class and
+level, a nice value, and in a cgroup v2 group with io.weight and io.max set.
+Snapshot deletion happens in a thread of our own process (DeletionHandler),
+which gets ionice and nice for just that thread; cgroup v2 can't put a
+single thread under the io controller, so no cgroup for it.
+
+Bear in mind ZFS issues much of its disk I/O from its own kernel threads,
+which ionice and io.max don't follow; nice and send shaping (see shaping)
+are the more dependable levers. verify() reads back what a process actually
+got, for checking a setup does what it's meant to.
+
+    python -m san.mgmtd.priority [command ...]
+
+runs a command with the configured replication priority and reports.
+"""
+
+
+ioprio_classes = dict(
+    realtime=syscalls.IOPRIO_CLASS_RT,
+    best_effort=syscalls.IOPRIO_CLASS_BE,
+    idle=syscalls.IOPRIO_CLASS_IDLE,
+)
+
+
+class Priority(object):
+    """ How to schedule a process or thread.
+
+    @ionice is a class name ('realtime', 'best_effort' or 'idle') with
+    @ionice_level 0-7 (lower goes first, not used for idle). @nice is the
+    absolute nice value. @cgroup is a cgroup v2 group under @cgroup_root,
+    created as needed, with @io_weight (1-10000, default 100) and @io_max,
+    a dict of block device (path or 'major:minor') to limits as io.max
+    takes them, ie 'rbps=104857600 wiops=1000'. Anything None is left be.
+    """
+
+    def __init__(self, ionice=None, ionice_level=None, nice=None, cgroup=None,
+                 io_weight=None, io_max=None, cgroup_root='/sys/fs/cgroup'):
+        if ionice is not None and ionice not in ioprio_classes:
+            raise ValueError('Unknown ionice class %s' % repr(ionice))
+        self.ionice = ionice
+        self.ionice_level = ionice_level
+        self.nice = nice
+        self.cgroup = cgroup
+        self.io_weight = io_weight
+        self.io_max = io_max or {}
+        self.cgroup_root = cgroup_root
+        self._cgroup_ready = False
+
+    def __repr__(self):
+        return '<%s ionice=%s/%s nice=%s cgroup=%s>' % (
+            self.__class__.__name__, self.ionice, self.ionice_level,
+            self.nice, self.cgroup)
+
+    @classmethod
+    def from_conf(cls, conf, **kwargs):
+        """ Returns a Priority from dict @conf, None if it's empty. """
+        if not conf:
+            return None
+        kwargs.update(conf)
+        return cls(**kwargs)
+
+    @property
+    def cgroup_path(self):
+        if self.cgroup:
+            return os.path.join(self.cgroup_root, self.cgroup)
+
+    def _ioprio(self):
+        ioclass = ioprio_classes[self.ionice]
+        level = 0
+        if ioclass != syscalls.IOPRIO_CLASS_IDLE:
+            level = self.ionice_level if self.ionice_level is not None else 4
+        return ioclass, level
+
+    def apply(self, who=0):
+        """ Sets nice and ionice of process or thread @who (the caller).
+        Raises OSError if it's not allowed. """
+        if self.nice is not None:
+            syscalls.setpriority(who, self.nice)
+        if self.ionice is not None:
+            syscalls.ioprio_set(who, *self._ioprio())
+
+    def apply_to_thread(self):
+        """ Sets nice and ionice of the calling thread only. """
+        try:
+            self.apply(syscalls.gettid())
+        except OSError as e:
+            log.warning('Could not set %s on thread: %s', self, e)
+
+    def setup_cgroup(self):
+        """ Creates the cgroup and sets its io limits. Returns whether
+        processes can be put in it. """
+        if not self.cgroup or self._cgroup_ready:
+            return self._cgroup_ready
+        path = self.cgroup_path
+        try:
+            # io has to be enabled for children of the parent first
+            parent = os.path.dirname(path)
+            with open(os.path.join(parent, 'cgroup.subtree_control'), 'w') as f:
+                f.write('+io')
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            if self.io_weight is not None:
+                with open(os.path.join(path, 'io.weight'), 'w') as f:
+                    f.write('default %d' % self.io_weight)
+            for device, limits in self.io_max.iteritems():
+                with open(os.path.join(path, 'io.max'), 'w') as f:
+                    f.write('%s %s' % (_device_number(device), limits))
+        except (IOError, OSError) as e:
+            log.warning('Could not set up cgroup %s: %s', path, e)
+            return False
+        self._cgroup_ready = True
+        return True
+
+    def preexec(self):
+        """ Returns a Popen preexec_fn running the child with this priority.
+        The child can't log, so anything not allowed is skipped silently;
+        verify() afterwards. """
+        use_cgroup = self.setup_cgroup()
+        procs = use_cgroup and os.path.join(self.cgroup_path, 'cgroup.procs')
+
+        def preexec():
+            try:
+                self.apply()
+            except OSError:
+                pass
+            if procs:
+                try:
+                    with open(procs, 'w') as f:
+                        f.write(str(os.getpid()))
+                except (IOError, OSError):
+                    pass
+        return preexec
+
+    def spawn(self, cmd, **kwargs):
+        """ Popen()s @cmd with this priority, warning about whatever didn't
+        take. """
+        proc = subprocess.Popen(cmd, preexec_fn=self.preexec(), **kwargs)
+        for problem in verify(proc.pid, self):
+            log.warning('%s: %s', cmd[0], problem)
+        return proc
+
+
+def spawn(cmd, priority=None, **kwargs):
+    """ Popen()s @cmd with @priority, if any. """
+    if priority is None:
+        return subprocess.Popen(cmd, **kwargs)
+    return priority.spawn(cmd, **kwargs)
+
+
+def _device_number(device):
+    """ Returns 'major:minor' of block device @device. """
+    if ':' in device:
+        return device
+    rdev = os.stat(device).st_rdev
+    return '%d:%d' % (os.major(rdev), os.minor(rdev))
+
+
+def describe(pid):
+    """ Returns nice, ionice (class name, level) and cgroup of process (or
+    thread) @pid as the kernel has them. """
+    with open('/proc/%d/stat' % pid) as f:
+        # comm may contain spaces, fields after it don't
+        fields = f.read().rsplit(')', 1)[1].split()
+    ret = dict(nice=int(fields[16]))
+
+    ioclass, level = syscalls.ioprio_get(pid)
+    names = dict((v, k) for k, v in ioprio_classes.iteritems())
+    ret['ionice'] = (names.get(ioclass), level)
+
+    ret['cgroup'] = None
+    try:
+        with open('/proc/%d/cgroup' % pid) as f:
+            for line in f:
+                # v2 is the one with an empty hierarchy id and controllers
+                if line.startswith('0::'):
+                    ret['cgroup'] = line[3:].strip()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return ret
+
+
+def verify(pid, priority):
+    """ Returns how process (or thread) @pid isn't running with @priority,
+    as a list of strings; empty if it is. Popen only returns once the child
+    has exec'd, so preexec is done by then, but a short lived one may
+    already be gone. """
+    try:
+        actual = describe(pid)
+    except (IOError, OSError) as e:
+        return ['Could not check priority of %d: %s' % (pid, e)]
+
+    problems = []
+    if priority.nice is not None and actual['nice'] != priority.nice:
+        problems.append('nice is %d, not %d' % (actual['nice'], priority.nice))
+    if priority.ionice is not None:
+        want = (priority.ionice, priority._ioprio()[1])
+        if actual['ionice'] != want:
+            problems.append('ionice is %s/%s, not %s/%s' % (actual['ionice'] + want))
+    if priority.cgroup and actual['cgroup'] != '/' + priority.cgroup.strip('/'):
+        problems.append('in cgroup %s, not %s' % (actual['cgroup'], priority.cgroup))
+    return problems
+
+
+def main():
+    # Late, backup pulls in a lot
+    from .backup import replication_priority
+
+    priority = replication_priority()
+    if not priority:
+        log.error('No replication_priority configured')
+        return 1
+    cmd = sys.argv[1:] or ['sleep', '1']
+    proc = subprocess.Popen(cmd, preexec_fn=priority.preexec())
+    log.info('%s: %s', cmd, describe(proc.pid))
+    problems = verify(proc.pid, priority)
+    for problem in problems:
+        log.error('%s: %s', cmd, problem)
+    if not problems:
+        log.info('%s: Running with %s', cmd, priority)
+    proc.wait()
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,216 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import re
+import json
+import time
+import threading
+import zmq
+
+from .metrics import metrics
+
+
+"""
+Structured progress of zfs sends.
+
+zfs send -P prints what it's about to send and, with -v, how far along it is
+every second, on stderr:
+
+    full	pool/fs@snap	123456
+    incremental	snap1	pool/fs@snap2	123456
+    size	246912
+    12:00:01	65536	pool/fs@snap
+
+SendProgress turns those lines into events, dicts with the stream's name,
+the event type ('estimate', 'progress' or 'done') and: bytes sent, total
+estimated bytes, rate in bytes a second, ETA in seconds, the snapshot being
+sent and whether it's incremental. Events go to whoever subscribed to bus,
+and are kept as progress.<name>.* gauges in metrics while the send runs.
+
+Byte counts on the per-second lines start over for every snapshot of a -I
+stream, so they're added up here.
+"""
+
+
+class ProgressBus(object):
+    """ Hands progress events to subscribers, ie the CLI and exporters. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """ Calls @callback with every event from now on, from whichever
+        thread publishes it. """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                log.exception('Progress subscriber %s failed', callback)
+
+
+bus = ProgressBus()
+
+
+_progress_line = re.compile(r'^\d\d:\d\d:\d\d\t(\d+)\t(\S+)$')
+
+
+class SendProgress(object):
+    """ Follows the stderr of one zfs send -Pv known as @name, publishing to
+    @bus. Feed it lines with feed(), say how it ended with finish(). """
+
+    def __init__(self, name, bus=bus, smoothing=0.3):
+        self.name = name
+        self.bus = bus
+        self.smoothing = smoothing
+        self.snapshots = []         # (from, to, estimated bytes)
+        self.total = None
+        self.bytes = 0
+        self.rate = None
+        self.snapshot = None
+        self.started = time.time()
+
+        self._base = 0              # bytes of snapshots done with
+        self._last_bytes = 0        # of the one in progress
+        self._last_time = self.started
+
+        prefix = 'progress.%s.' % name
+        metrics.gauge(prefix + 'bytes', lambda: self.bytes)
+        metrics.gauge(prefix + 'total', lambda: self.total)
+        metrics.gauge(prefix + 'rate', lambda: self.rate)
+        metrics.gauge(prefix + 'eta', self.eta)
+
+    def __repr__(self):
+        return '<%s %s %s/%s>' % (self.__class__.__name__, self.name,
+                                  self.bytes, self.total)
+
+    @property
+    def incremental(self):
+        return bool(self.snapshots) and self.snapshots[0][0] is not None
+
+    def eta(self):
+        """ Seconds left at the current rate, None if there's no telling. """
+        if not self.total or not self.rate:
+            return None
+        return max(0, self.total - self.bytes) / self.rate
+
+    def event(self, type, **kwargs):
+        ret = dict(name=self.name, type=type, time=time.time(),
+                   bytes=self.bytes, total=self.total, rate=self.rate,
+                   eta=self.eta(), snapshot=self.snapshot,
+                   incremental=self.incremental)
+        ret.update(kwargs)
+        return ret
+
+    def feed(self, line):
+        """ Takes a line of zfs send's stderr. Returns the event it made, if
+        any. """
+        line = line.rstrip('\n')
+        fields = line.split('\t')
+
+        match = _progress_line.match(line)
+        if match:
+            return self._progress(int(match.group(1)), match.group(2))
+
+        if fields[0] == 'full' and len(fields) == 3:
+            self.snapshots.append((None, fields[1], int(fields[2])))
+        elif fields[0] == 'incremental' and len(fields) == 4:
+            self.snapshots.append((fields[1], fields[2], int(fields[3])))
+        elif fields[0] == 'size' and len(fields) == 2:
+            self.total = int(fields[1])
+        else:
+            # Resume token contents and such
+            return None
+
+        if fields[0] != 'size':
+            # Only multi snapshot streams get a size line, single ones make do
+            # with their one estimate
+            self.total = sum(x[2] for x in self.snapshots)
+        event = self.event('estimate', snapshots=list(self.snapshots))
+        self.bus.publish(event)
+        return event
+
+    def _progress(self, count, snapshot):
+        if snapshot != self.snapshot:
+            # Next snapshot of a -I stream, count starts over
+            self._base += self._last_bytes
+            self.snapshot = snapshot
+        self._last_bytes = count
+        done = self._base + count
+
+        now = time.time()
+        if now > self._last_time:
+            rate = (done - self.bytes) / (now - self._last_time)
+            self.rate = rate if self.rate is None else \
+                self.smoothing * rate + (1 - self.smoothing) * self.rate
+        self._last_time = now
+        self.bytes = done
+
+        event = self.event('progress')
+        self.bus.publish(event)
+        return event
+
+    def finish(self, ok, bytes=None):
+        """ The send is over; @ok says whether it went through. @bytes is
+        what actually went out, if known, as the last progress line can be
+        up to a second stale. """
+        if bytes is not None:
+            self.bytes = bytes
+        elapsed = max(time.time() - self.started, 1e-9)
+        event = self.event('done', ok=ok, elapsed=elapsed, rate=self.bytes / elapsed,
+                           eta=0)
+        metrics.remove('progress.%s.' % self.name)
+        self.bus.publish(event)
+        return event
+
+
+class ProgressPublisher(object):
+    """ Bus subscriber passing events on over a zmq PUB socket bound to
+    @bind, as [name, json] messages, for other processes to follow. """
+
+    def __init__(self, bind):
+        ctx = zmq.Context.instance()
+        self.sock = ctx.socket(zmq.PUB)
+        self.sock.bind(bind)
+        # Events come from reader threads, zmq sockets aren't thread safe
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.sock.send_multipart([event['name'], json.dumps(event)])
+
+    def close(self):
+        with self._lock:
+            self.sock.close()
+
+
+def format_event(event):
+    """ One line summary of @event for humans. """
+    mb = 1024.0 * 1024
+    parts = ['%s: %s' % (event['name'], event['type'])]
+    if event['type'] == 'estimate':
+        parts.append('%s, %s snapshot(s), %.1fMB' % (
+            'incremental' if event['incremental'] else 'full',
+            len(event['snapshots']), (event['total'] or 0) / mb))
+        return ' '.join(parts)
+    if event['total']:
+        parts.append('%.1f%%' % (100.0 * event['bytes'] / max(event['total'], 1)))
+    parts.append('%.1fMB' % (event['bytes'] / mb))
+    if event['rate']:
+        parts.append('at %.1fMB/s' % (event['rate'] / mb))
+    if event['type'] == 'progress' and event['eta'] is not None:
+        parts.append('ETA %ds' % event['eta'])
+    if event['type'] == 'done':
+        parts.append('ok' if event['ok'] else 'failed')
+    return ' '.join(parts)
@@ -0,0 +1,243 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import socket
+import time
+import uuid
+import collections
+import itertools
+import zmq
+
+from .flow import CreditWindow, FlowError, ReceiverError, control_messages
+from .framing import pack_header, checksums, checksum_preference
+from .metrics import metrics
+from .autotune import configure_socket
+from .backup import backup_conf
+
+
+"""
+Cascading replication (A -> B -> C).
+
+A receive session on B can pass the stream it gets from A on to another
+receive server C as it comes in, instead of C waiting on B's receive to finish
+and a second send. Each hop has its own credit window; B only grants A more
+credit while C keeps up, so a slow C holds back A instead of piling up in B.
+
+Every chunk carries the time A sent it, which each hop compares against its
+own clock to report end-to-end lag (so it's only as good as NTP on the boxes).
+"""
+
+
+class RelayChunk(object):
+    __slots__ = ('seq', 'data', 'origin', 'arrived', 'frames')
+
+
+class Relay(object):
+    """ Sender side of a relayed session, driven from the receive server's
+    poll loop so it never blocks it.
+
+    Chunks handed to forward() wait for credit from the receive server at
+    @address, and are kept until it acknowledges them so NACKs can be
+    replayed. @server is the ReceiveServer, whose poller we get added to.
+    Gives up if the next hop says nothing for @timeout seconds while we're
+    waiting on it.
+    """
+
+    def __init__(self, server, address, name, timeout=300):
+        self.server = server
+        self.address = address
+        self.name = name
+        self.timeout = timeout
+        self.last_activity = time.time()
+        self.session_id = uuid.uuid4().hex
+
+        ctx = zmq.Context.instance()
+        self.sock = ctx.socket(zmq.ROUTER)
+        # One socket per relayed session, so the identity has to be unique
+        self.sock.setsockopt(zmq.IDENTITY, '%s-%d-%s' % (
+            socket.gethostname(), os.getpid(), self.session_id[:8]))
+        self.sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        configure_socket(self.sock, backup_conf['socket_buffer'], backup_conf['socket_hwm'])
+        self.sock.connect(address)
+        server.watch(self.sock)
+
+        self.state = 'connecting'
+        self.error = None
+        self.window = None
+        self.checksum_name = None
+        self.closing = False
+        self.queue = collections.deque()
+        self.inflight = collections.deque()
+        self.seqs = itertools.count()
+        self.bytes_out = 0
+        self.max_lag = 0.0
+
+        prefix = 'relay.%s.' % self.session_id
+        metrics.gauge(prefix + 'backlog', lambda: self.backlog)
+        metrics.gauge(prefix + 'lag', self.lag)
+
+    def __repr__(self):
+        return '<%s %s/%s %s backlog=%d>' % (self.__class__.__name__, self.address,
+                                            self.session_id, self.state, self.backlog)
+
+    @property
+    def done(self):
+        return self.state in ('done', 'failed')
+
+    @property
+    def backlog(self):
+        """ Chunks not yet acknowledged downstream. """
+        return len(self.queue) + len(self.inflight)
+
+    def lag(self):
+        """ Seconds the oldest chunk not yet acknowledged downstream has been
+        waiting here. """
+        oldest = self.inflight or self.queue
+        if not oldest:
+            return 0.0
+        return time.time() - oldest[0].arrived
+
+    def time_left(self):
+        """ Seconds until we need ticking without anything showing up on our
+        socket, None if we don't. """
+        if self.state == 'connecting':
+            return 0.1
+        if not self._waiting():
+            return None
+        return max(0, self.last_activity + self.timeout - time.time())
+
+    def _waiting(self):
+        """ Whether we're waiting to hear back from the next hop. """
+        return bool(self.backlog) or self.state != 'open'
+
+    def forward(self, data, origin=None):
+        """ Queues chunk @data, first sent at @origin (time.time() on the
+        first hop, as a str). """
+        if self.done:
+            return
+        if not self._waiting():
+            # Start the clock on the next hop from now
+            self.last_activity = time.time()
+        chunk = RelayChunk()
+        chunk.data = data
+        chunk.arrived = time.time()
+        chunk.origin = origin or repr(chunk.arrived)
+        self.queue.append(chunk)
+        if self.state == 'open':
+            self._send_queued()
+
+    def close(self):
+        """ Says goodbye downstream once everything queued is out. """
+        self.closing = True
+        self.tick()
+
+    def abort(self, reason):
+        if self.done:
+            return
+        if self.state != 'connecting':
+            try:
+                self.sock.send_multipart(['srv', 'receive_abort', self.session_id, reason])
+            except zmq.ZMQError:
+                pass
+        self._fail(reason)
+
+    def tick(self):
+        if self.done:
+            return
+        try:
+            if self.state == 'connecting':
+                self._hello()
+            while self.sock.poll(0):
+                self.last_activity = time.time()
+                self._handle(self.sock.recv_multipart())
+                if self.done:
+                    return
+            if self._waiting() and time.time() - self.last_activity > self.timeout:
+                raise FlowError('No word from %s in %ss' % (self.address, self.timeout))
+            if self.state == 'open':
+                self._recycle()
+                self._send_queued()
+                if self.closing and not self.queue:
+                    self._goodbye()
+        except FlowError as e:
+            self._fail(str(e))
+        except zmq.ZMQError as e:
+            self._fail('broken pipe: %s' % e)
+
+    def _hello(self):
+        try:
+            self.sock.send_multipart(['srv', 'receive_open', self.session_id, self.name,
+                                      ','.join(checksum_preference)])
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EHOSTUNREACH:
+                raise
+            # Not connected yet, try again next tick
+            return
+        log.info('%s: Relaying %s', self, self.name)
+        self.state = 'opening'
+
+    def _handle(self, buf):
+        cmd = buf[1]
+        if cmd in control_messages and self.window:
+            self.window.control(buf)
+        elif cmd == 'error':
+            raise ReceiverError(' '.join(buf[3:]))
+        elif cmd == 'ok' and self.state == 'opening':
+            self.window = CreditWindow(int(buf[3]), on_nack=self._replay)
+            self.checksum_name = buf[5] if len(buf) > 5 and buf[5] else None
+            self.state = 'open'
+        elif cmd == 'ok' and self.state == 'closing':
+            log.info('%s: Relayed %d bytes, max lag %.2fs', self, self.bytes_out, self.max_lag)
+            self.state = 'done'
+            self._cleanup()
+        else:
+            log.warning('%s: Unexpected message: %s', self, repr(cmd))
+
+    def _send_queued(self):
+        while self.queue and self.window.take():
+            chunk = self.queue.popleft()
+            chunk.seq = next(self.seqs)
+            checksum = None
+            if self.checksum_name:
+                checksum = checksums[self.checksum_name](chunk.data)
+            chunk.frames = ['srv', 'receive_data', self.session_id,
+                            pack_header(chunk.seq, None, checksum),
+                            chunk.data, chunk.origin]
+            self.sock.send_multipart(chunk.frames, copy=False)
+            self.inflight.append(chunk)
+            self.bytes_out += len(chunk.data)
+
+    def _recycle(self):
+        now = time.time()
+        while self.inflight and self.inflight[0].seq <= self.window.acked:
+            chunk = self.inflight.popleft()
+            self.max_lag = max(self.max_lag, now - chunk.arrived)
+
+    def _replay(self, first, last):
+        log.warning('%s: Downstream wants chunks %d-%d again', self, first, last)
+        for seq in xrange(first, last + 1):
+            idx = seq - self.inflight[0].seq if self.inflight else -1
+            if not 0 <= idx < len(self.inflight):
+                raise FlowError('Chunk %d is no longer in the replay window' % seq)
+            self.sock.send_multipart(self.inflight[idx].frames, copy=False)
+            metrics.incr('relay.%s.retransmits' % self.session_id)
+
+    def _goodbye(self):
+        last_seq = self.inflight[-1].seq if self.inflight else self.window.acked
+        self.sock.send_multipart(['srv', 'receive_close', self.session_id, str(last_seq)])
+        self.state = 'closing'
+
+    def _fail(self, reason):
+        log.error('%s: Relay failed: %s', self, reason)
+        self.error = reason
+        self.state = 'failed'
+        self.queue.clear()
+        self.inflight.clear()
+        self._cleanup()
+
+    def _cleanup(self):
+        self.server.unwatch(self.sock)
+        self.sock.close(linger=1000)
+        metrics.remove('relay.%s.' % self.session_id)
@@ -0,0 +1,343 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import io
+import time
+import threading
+
+from .metrics import metrics
+
+
+class RingBufferAborted(Exception):
+    """ The other side of the ring buffer gave up. """
+
+
+class RingBuffer(object):
+    """ Preallocated byte ring between a producer and a consumer thread,
+    ala mbuffer.
+
+    Watermarks are fractions of @size and give both sides hysteresis so they
+    stream in bursts instead of ping-ponging on every chunk:
+
+        high_watermark: once the ring fills up, the producer sleeps until the
+                        fill level drops back below this.
+        low_watermark:  once the ring runs dry, the consumer sleeps until the
+                        fill level climbs back to this (or the producer closes).
+    """
+
+    def __init__(self, size, high_watermark=0.9, low_watermark=0.1, name=None):
+        assert 0 <= low_watermark <= high_watermark <= 1
+        self.size = size
+        self.name = name
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._high = int(size * high_watermark)
+        self._low = max(1, int(size * low_watermark))
+
+        self._cond = threading.Condition()
+        self._head = 0      # Next write offset
+        self._tail = 0      # Next read offset
+        self._fill = 0      # Includes acquired but unreleased bytes
+        self._acquired = 0
+        self._closed = False
+        self._aborted = False
+        self._producer_waiting = False
+        self._consumer_waiting = False
+        # Ran dry and not had anything since, so polls aren't each a stall
+        self._consumer_stalled = False
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.producer_stalls = 0
+        self.consumer_stalls = 0
+
+        if name:
+            metrics.gauge('%s.buffer_fill' % name, lambda: self.fill_level)
+
+    def __repr__(self):
+        return '<%s %s fill=%.1f%% of %d>' % (
+            self.__class__.__name__, self.name,
+            self.fill_level * 100, self.size)
+
+    @property
+    def fill_level(self):
+        return float(self._fill) / self.size
+
+    def _remove_gauge(self):
+        # The gauge holds on to us, and with us the whole buffer
+        if self.name:
+            metrics.remove('%s.buffer_fill' % self.name)
+
+    """ Producer side """
+
+    def _wait_for_space(self, timeout=None):
+        """ Returns a writable memoryview of contiguous free space, None if
+        none freed up within @timeout seconds. """
+        with self._cond:
+            if self._fill == self.size:
+                self.producer_stalls += 1
+                self._producer_waiting = True
+                deadline = timeout and time.time() + timeout
+                while (self._fill == self.size or self._fill > self._high) \
+                        and not self._aborted:
+                    if deadline:
+                        left = deadline - time.time()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                    else:
+                        self._cond.wait()
+                self._producer_waiting = False
+            if self._aborted:
+                raise RingBufferAborted()
+            if self._fill == self.size:
+                return None
+            # Not full, so head == tail means empty here
+            end = self.size if self._head >= self._tail else self._tail
+            return self._view[self._head:end]
+
+    def _commit(self, count):
+        with self._cond:
+            self._head = (self._head + count) % self.size
+            self._fill += count
+            self.bytes_in += count
+            if self._consumer_waiting and self.available >= self._low:
+                self._cond.notify_all()
+
+    def fill_from(self, reader, inspect=None):
+        """ Reads once from @reader straight into free space of the ring.
+        @inspect, if given, is called with a view of what was read before the
+        consumer can see it. Returns bytes read, 0 on EOF. """
+        space = self._wait_for_space()
+        got = reader.readinto(space)
+        if got:
+            if inspect:
+                inspect(space[:got])
+            self._commit(got)
+        return got or 0
+
+    def write(self, data, timeout=None):
+        """ Copies @data into the ring, blocking while it is full. Returns
+        False if it stayed full for @timeout seconds, in which case only some
+        of @data may have made it in. """
+        data = memoryview(data)
+        while len(data):
+            space = self._wait_for_space(timeout)
+            if space is None:
+                return False
+            count = min(len(space), len(data))
+            space[:count] = data[:count]
+            self._commit(count)
+            data = data[count:]
+        return True
+
+    def close(self):
+        """ Producer is done; consumer drains what's left then sees EOF. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    """ Consumer side """
+
+    @property
+    def available(self):
+        """ Bytes ready to be acquired. """
+        return self._fill - self._acquired
+
+    def acquire(self, max_size=None, timeout=None):
+        """ Returns a memoryview of contiguous readable data, at most
+        @max_size bytes. Empty once closed and drained, None if nothing showed
+        up within @timeout seconds. The space stays reserved until release()
+        is called for it, so the view can be handed to something that
+        finishes with it later (ie a zero-copy zmq send). Releases must happen
+        in acquisition order. """
+        with self._cond:
+            if not self.available and not self._closed:
+                if not self._consumer_stalled:
+                    self.consumer_stalls += 1
+                    self._consumer_stalled = True
+                self._consumer_waiting = True
+                deadline = timeout and time.time() + timeout
+                while self.available < self._low and not self._closed \
+                        and not self._aborted:
+                    if deadline:
+                        left = deadline - time.time()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                    else:
+                        self._cond.wait()
+                self._consumer_waiting = False
+                if not self.available and not self._closed and not self._aborted:
+                    return None
+            if self._aborted:
+                raise RingBufferAborted()
+            self._consumer_stalled = False
+            start = (self._tail + self._acquired) % self.size
+            count = min(self.available, self.size - start)
+            if max_size:
+                count = min(count, max_size)
+            if not count:
+                # Closed and drained
+                self._remove_gauge()
+            self._acquired += count
+            return self._view[start:start + count]
+
+    def release(self, count):
+        """ Frees the oldest @count acquired bytes for the producer. """
+        with self._cond:
+            self._tail = (self._tail + count) % self.size
+            self._fill -= count
+            self._acquired -= count
+            self.bytes_out += count
+            if self._producer_waiting and self._fill <= self._high:
+                self._cond.notify_all()
+
+    def read(self, max_size=None):
+        """ Returns a copy of up to @max_size bytes, '' on EOF. """
+        view = self.acquire(max_size)
+        ret = view.tobytes()
+        self.release(len(ret))
+        return ret
+
+    def drain_to(self, writer, max_size=None, throttle=None):
+        """ Writes everything to @writer until the producer closes, calling
+        @throttle with each count of bytes written if given. Returns bytes
+        written. """
+        total = 0
+        while True:
+            view = self.acquire(max_size)
+            if not len(view):
+                break
+            count = len(view)
+            written = 0
+            while written < count:
+                written += writer.write(view[written:]) or 0
+            self.release(count)
+            total += count
+            if throttle:
+                throttle(count)
+        return total
+
+    def abort(self):
+        """ Either side gave up; wakes and fails the other side. """
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+        self._remove_gauge()
+
+
+class RingBufferReader(threading.Thread):
+    """ Producer thread that keeps a RingBuffer topped up from @fd.
+
+    @inspector, if given, is shown everything read before it goes in the
+    ring: its feed() gets each piece, its close() is called at EOF. Either
+    raising ValueError rejects the stream; the ring is then aborted rather
+    than closed, so the consumer never takes what it got for all of it.
+    """
+
+    def __init__(self, fd, ring, inspector=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._reader = io.FileIO(fd.fileno(), 'rb', closefd=False)
+        self._ring = ring
+        self._inspector = inspector
+        self.error = None
+
+    def run(self):
+        inspect = self._inspector and self._inspector.feed
+        try:
+            while self._ring.fill_from(self._reader, inspect):
+                pass
+            if self._inspector:
+                self._inspector.close()
+        except RingBufferAborted:
+            pass
+        except IOError as e:
+            log.error('Broken pipe on send: %s', e)
+            self.error = e
+        except ValueError as e:
+            log.error('Rejected stream: %s', e)
+            self.error = e
+            self._ring.abort()
+        finally:
+            self._ring.close()
+
+
+class RingBufferTee(threading.Thread):
+    """ Producer thread that copies everything read from @fd into each of
+    @rings, for when one stream feeds several consumers.
+
+    Every ring gets the same bytes, so how much fuller one is than the
+    emptiest is how far its consumer is behind the fastest. One that's been
+    more than @max_lag of its ring behind for @stall_timeout seconds is
+    holding all the others up, even if it's still trickling along; it gets
+    aborted and dropped, and the rest carry on. So does one that stays full
+    that long, ie the last one left.
+    @inspector is as for RingBufferReader, a rejected stream aborts them all.
+    """
+
+    def __init__(self, fd, rings, stall_timeout=None, bufsize=1024 * 1024,
+                 inspector=None, max_lag=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._reader = io.FileIO(fd.fileno(), 'rb', closefd=False)
+        self._buf = bytearray(bufsize)
+        self._inspector = inspector
+        self.rings = list(rings)
+        self.dropped = []
+        self.stall_timeout = stall_timeout
+        self.max_lag = max_lag
+        self.error = None
+        # When each ring was last found keeping up
+        self._caught_up = dict((x, time.time()) for x in self.rings)
+
+    def _drop(self, ring):
+        self.rings.remove(ring)
+        self.dropped.append(ring)
+
+    def _write(self, ring, data, least):
+        """ Writes @data to @ring, @least being the fill level of the
+        emptiest ring. Returns False if the ring has been behind for too
+        long. """
+        if not self.stall_timeout:
+            return ring.write(data)
+        now = time.time()
+        if ring.fill_level - least <= self.max_lag:
+            self._caught_up[ring] = now
+        left = self._caught_up[ring] + self.stall_timeout - now
+        return left > 0 and ring.write(data, timeout=left)
+
+    def run(self):
+        view = memoryview(self._buf)
+        try:
+            while self.rings:
+                got = self._reader.readinto(self._buf)
+                if not got:
+                    if self._inspector:
+                        self._inspector.close()
+                    break
+                if self._inspector:
+                    self._inspector.feed(view[:got])
+                least = min(x.fill_level for x in self.rings)
+                for ring in list(self.rings):
+                    try:
+                        if not self._write(ring, view[:got], least):
+                            log.warning('%s: Behind for %ss, dropping it',
+                                        ring, self.stall_timeout)
+                            ring.abort()
+                            self._drop(ring)
+                    except RingBufferAborted:
+                        self._drop(ring)
+        except IOError as e:
+            log.error('Broken pipe on send: %s', e)
+            self.error = e
+        except ValueError as e:
+            log.error('Rejected stream: %s', e)
+            self.error = e
+            for ring in self.rings:
+                ring.abort()
+        finally:
+            for ring in self.rings:
+                ring.close()
@@ -0,0 +1,270 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import io
+import os
+import sys
+import json
+import time
+
+from .backup import Dataset, DatasetSet, backup_conf, send_cmd, send_flags, \
+    dest_name_for, create_bookmark
+from .archive import ArchiveWriter, ArchiveReader, ArchiveError, send_to, \
+    receive_archives
+
+
+"""
+Seeding destinations by disk.
+
+A full sync of a large dataset can take days over the wire, so it's done by
+hand-off instead: export writes a full zfs send of a snapshot to a
+removable disk, the disk goes to the destination box, and import there
+receives it. From then on the snapshot is common to both sides and
+DatasetSet carries on with incrementals as usual.
+
+A seed is a directory, dataset@snapshot with /s as _s, of archives (see
+archive) each holding seed_part_size bytes of the stream, and a manifest,
+seed.json, listing them in order. Every chunk of every part is hashed, so
+import checks the lot before zfs receive sees a byte of it.
+
+Export bookmarks the snapshot, so if it's destroyed on the source before
+the disk makes it there, incrementals can still be sent from the bookmark.
+
+    python -m san.mgmtd.seed export pool/fs path [snapshot]
+    python -m san.mgmtd.seed verify seed_dir
+    python -m san.mgmtd.seed import seed_dir [dest_root]
+"""
+
+
+MANIFEST = 'seed.json'
+
+
+class SeedWriter(object):
+    """ Takes a stream through write() like an ArchiveWriter, and splits it
+    into archives of @part_size stream bytes in directory @directory, with
+    @meta in each and in the manifest. """
+
+    def __init__(self, directory, part_size, meta=None):
+        self.directory = directory
+        self.part_size = part_size
+        self.meta = dict(meta or {})
+        self.parts = []
+        self._writer = None
+        self._offset = 0
+
+    def __repr__(self):
+        return '<%s %s parts=%d>' % (self.__class__.__name__, self.directory,
+                                     len(self.parts) + bool(self._writer))
+
+    @property
+    def bytes_in(self):
+        """ Stream bytes taken so far. """
+        return self._offset + (self._writer.bytes_in if self._writer else 0)
+
+    def _open_part(self):
+        i = len(self.parts)
+        path = os.path.join(self.directory, 'part-%04d.arc' % i)
+        self._writer = ArchiveWriter(path,
+                                     chunk_size=backup_conf['archive_chunk_size'],
+                                     codec_name=backup_conf['archive_compression'],
+                                     workers=backup_conf['pipeline_workers'],
+                                     meta=dict(self.meta, part=i),
+                                     stream_offset=self._offset)
+
+    def _close_part(self):
+        self._writer.close()
+        self._offset += self._writer.bytes_in
+        self.parts.append(self._writer)
+        self._writer = None
+
+    def write(self, data):
+        """ Takes the next @data of the stream. """
+        data = memoryview(data)
+        while len(data):
+            if self._writer is None:
+                self._open_part()
+            take = min(self.part_size - self._writer.bytes_in, len(data))
+            self._writer.write(data[:take])
+            data = data[take:]
+            if self._writer.bytes_in == self.part_size:
+                self._close_part()
+
+    def close(self):
+        """ Closes the last part and writes the manifest. Returns its path. """
+        if self._writer is None and not self.parts:
+            self._open_part()
+        if self._writer is not None:
+            self._close_part()
+
+        manifest = dict(self.meta, stream_size=self.bytes_in, part_size=self.part_size,
+                        closed=time.time(),
+                        parts=[dict(file=os.path.basename(x.path),
+                                    stream_offset=x.stream_offset,
+                                    stream_size=x.bytes_in,
+                                    size=x.size,
+                                    chunks=len(x.chunks))
+                               for x in self.parts])
+        path = os.path.join(self.directory, MANIFEST)
+        partial = path + '.partial'
+        with io.open(partial, 'wb') as f:
+            f.write(json.dumps(manifest, indent=2, sort_keys=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(partial, path)
+        return path
+
+    def abort(self):
+        """ Throws away the parts written. """
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+        for part in self.parts:
+            os.unlink(part.path)
+        self.parts = []
+
+
+def seed_dir_name(name, snapshot_name):
+    return '%s@%s' % (name.replace('/', '_'), snapshot_name)
+
+
+def pick_snapshot(source):
+    """ Returns the latest snapshot of Dataset @source worth seeding with;
+    one that's kept long enough for the destination to build on (see
+    DatasetSet.dest_snaps_needed_filter). """
+    snaps = [x for x in source.snaps if DatasetSet.dest_snaps_needed_filter.match(x)]
+    if not snaps:
+        raise ValueError('%s has no snapshots to seed with' % source.name)
+    return snaps[-1]
+
+
+def export(name, path, snapshot_name=None):
+    """ Writes a seed of local dataset @name at @snapshot_name (the latest
+    one worth it) under @path. Returns the seed's directory, or None if the
+    send failed. """
+    source = Dataset.from_local(name)
+    if not source.exists:
+        raise ValueError('No dataset %s' % name)
+    if snapshot_name is None:
+        snapshot_name = pick_snapshot(source)
+    elif snapshot_name not in source.snaps:
+        raise ValueError('No snapshot %s@%s' % (name, snapshot_name))
+
+    directory = os.path.join(path, seed_dir_name(name, snapshot_name))
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        raise ValueError('There is already a seed in %s' % directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Whatever it's imported into has to take the stream's features
+    flags = send_flags(name, backup_conf['archive_capabilities'])
+    cmd_send = send_cmd(name, flags, None, snapshot_name)
+    writer = SeedWriter(directory, backup_conf['seed_part_size'],
+                        meta=dict(dataset=name, snapshot=snapshot_name, cmd=cmd_send,
+                                  created=time.time()))
+    if send_to(cmd_send, writer, name) is None:
+        return None
+
+    create_bookmark('%s@%s' % (name, snapshot_name))
+    log.info('Seeded %s@%s to %s in %d parts', name, snapshot_name, directory,
+             len(writer.parts))
+    return directory
+
+
+def load(directory):
+    """ Returns the manifest and ArchiveReaders of the parts of the seed in
+    @directory, checking they're all there and belong to it. """
+    path = os.path.join(directory, MANIFEST)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError) as e:
+        raise ArchiveError('Could not read %s: %s' % (path, e))
+
+    archives = []
+    for part in manifest['parts']:
+        archive = ArchiveReader(os.path.join(directory, part['file']))
+        for key in ('dataset', 'snapshot'):
+            if archive.meta.get(key) != manifest[key]:
+                raise ArchiveError('%s is of %s %s, not %s' % (
+                    archive, key, archive.meta.get(key), manifest[key]))
+        if (archive.stream_offset, archive.stream_size) != \
+                (part['stream_offset'], part['stream_size']):
+            raise ArchiveError('%s holds bytes %d+%d of the stream, not %d+%d' % (
+                archive, archive.stream_offset, archive.stream_size,
+                part['stream_offset'], part['stream_size']))
+        archives.append(archive)
+    return manifest, archives
+
+
+def verify(directory, workers=4):
+    """ Checks every chunk of every part of the seed in @directory. Returns
+    {part file: [indexes of bad chunks]} of parts with any. """
+    manifest, archives = load(directory)
+    bad = {}
+    for part, archive in zip(manifest['parts'], archives):
+        chunks = archive.verify(workers)
+        if chunks:
+            bad[part['file']] = chunks
+    return bad
+
+
+def import_seed(directory, dest_root=None):
+    """ Receives the seed in @directory under @dest_root (dest_root), where
+    replication of its dataset goes; any missing parents are created, as
+    the receive server has them. Returns whether it took it. """
+    manifest, archives = load(directory)
+    dest_root = dest_root or backup_conf['dest_root']
+    dest_name = dest_name_for(manifest['dataset'], dest_root)
+
+    dest = Dataset.from_local(dest_name)
+    if manifest['snapshot'] in dest.snaps:
+        log.info('%s already has %s', dest_name, manifest['snapshot'])
+        return True
+    if dest.snaps:
+        # A full stream won't go on top of existing snapshots
+        log.error('%s already has snapshots, not importing %s', dest_name, directory)
+        return False
+
+    bad = verify(directory)
+    for part, chunks in sorted(bad.iteritems()):
+        log.error('%s: Bad chunks %s, export the seed again for it', part, chunks)
+    if bad:
+        return False
+
+    if not receive_archives(archives, dest_root, discard_pool=True):
+        return False
+    log.info('Imported %s@%s into %s, replication continues from there',
+             manifest['dataset'], manifest['snapshot'], dest_name)
+    return True
+
+
+def main():
+    usage = ('Usage: %s export dataset path [snapshot]\n'
+             '       %s verify seed_dir\n'
+             '       %s import seed_dir [dest_root]') % ((sys.argv[0],) * 3)
+    args = sys.argv[1:]
+    if not args or args[0] not in ('export', 'verify', 'import'):
+        print >> sys.stderr, usage
+        return 2
+
+    try:
+        if args[0] == 'export' and len(args) in (3, 4):
+            return 0 if export(*args[1:]) else 1
+        if args[0] == 'verify' and len(args) == 2:
+            bad = verify(args[1])
+            for part, chunks in sorted(bad.iteritems()):
+                print '%s\t%s' % (part, ','.join(str(x) for x in chunks))
+            return 1 if bad else 0
+        if args[0] == 'import' and len(args) in (2, 3):
+            return 0 if import_seed(*args[1:]) else 1
+    except (ValueError, ArchiveError, OSError) as e:
+        log.error('%s', e)
+        return 1
+    print >> sys.stderr, usage
+    return 2
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
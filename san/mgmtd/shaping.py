@@ -0,0 +1,233 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import datetime
+import threading
+
+from .metrics import metrics
+
+
+"""
+Bandwidth shaping for sends.
+
+Replication shares NICs with iSCSI, so what a box sends can be capped, per
+session and for all of them put together, with a token bucket each. Limits
+come from a time of day schedule, ie 200MB/s during business hours and
+unlimited at night, and can be overridden at runtime over RPC (see
+ShapingRPC); transfers pick up new limits within a second, no restart.
+
+Limits are in bytes a second, None for unlimited.
+"""
+
+
+class TokenBucket(object):
+    """ Lets @rate bytes a second through on average, in bursts of up to
+    @burst seconds worth. """
+
+    def __init__(self, rate=None, burst=0.25):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s rate=%s tokens=%d>' % (self.__class__.__name__,
+                                          self.rate, self.tokens)
+
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate,
+                              self.rate * self.burst)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            if rate != self.rate:
+                self.rate = rate
+                # Don't carry a debt run up at the old rate over
+                self.tokens = max(self.tokens, 0.0)
+
+    def consume(self, count):
+        """ Takes @count bytes worth, sleeping until the bucket is out of
+        debt again. Rate changes meanwhile apply right away. """
+        with self._lock:
+            self._refill()
+            if not self.rate:
+                return
+            self.tokens -= count
+        while True:
+            with self._lock:
+                self._refill()
+                if not self.rate or self.tokens >= 0:
+                    return
+                wait = -self.tokens / self.rate
+            time.sleep(min(wait, 0.5))
+
+
+days_of_week = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+
+def _parse_days(spec):
+    """ Returns weekday numbers in @spec, ie 'mon-fri' or 'sat,sun'; all of
+    them if it's empty. """
+    if not spec:
+        return set(xrange(7))
+    ret = set()
+    for part in spec.lower().split(','):
+        first, _, last = part.partition('-')
+        first = days_of_week.index(first.strip()[:3])
+        last = days_of_week.index(last.strip()[:3]) if last else first
+        if last < first:
+            last += 7
+        ret.update(x % 7 for x in xrange(first, last + 1))
+    return ret
+
+
+def _parse_time(spec):
+    """ Returns minutes past midnight of 'HH:MM' @spec. """
+    hours, minutes = spec.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class Schedule(object):
+    """ Limits by time of day.
+
+    @windows are (days, start, end, global limit, session limit), ie
+    ('mon-fri', '08:00', '18:00', 200 * 1024 * 1024, None); days may be None
+    for every day, and a window ending before it starts runs past midnight.
+    The first window in force wins.
+    """
+
+    def __init__(self, windows=()):
+        self.windows = []
+        for days, start, end, total, session in windows:
+            self.windows.append((_parse_days(days), _parse_time(start), _parse_time(end),
+                                 total, session))
+
+    def limits_at(self, when=None):
+        """ Returns (global limit, session limit) of the window in force at
+        datetime @when (now), or None if there isn't one. """
+        when = when or datetime.datetime.now()
+        weekday = when.weekday()
+        minute = when.hour * 60 + when.minute
+        for days, start, end, total, session in self.windows:
+            if start <= end:
+                match = weekday in days and start <= minute < end
+            else:
+                match = (weekday in days and minute >= start) or \
+                    ((weekday - 1) % 7 in days and minute < end)
+            if match:
+                return total, session
+
+
+class Shaper(object):
+    """ Token buckets for all of a process' sends, and for each on its own.
+
+    Limits are read from @conf's shaping_* keys (see backup_conf) unless
+    overridden; they're re-checked every @refresh_every seconds while
+    anything is being throttled.
+    """
+
+    def __init__(self, conf, refresh_every=1):
+        self.conf = conf
+        self.refresh_every = refresh_every
+        self.total = TokenBucket()
+        self.sessions = {}
+        self.schedule = None
+        self.overrides = {}
+        self.session_overrides = {}
+        self._refreshed = 0
+        self._lock = threading.Lock()
+        metrics.gauge('shaping.global_limit', lambda: self.total.rate)
+
+    def limits(self, when=None):
+        """ Returns (global limit, session limit) in force at @when (now). """
+        schedule = self.schedule or Schedule(self.conf['shaping_schedule'])
+        limits = schedule.limits_at(when) or \
+            (self.conf['shaping_global'], self.conf['shaping_session'])
+        return (self.overrides.get('global', limits[0]),
+                self.overrides.get('session', limits[1]))
+
+    def refresh(self):
+        total, session = self.limits()
+        with self._lock:
+            self._refreshed = time.time()
+            if total != self.total.rate:
+                log.info('Global send limit now %s', total)
+            self.total.set_rate(total)
+            for name, bucket in self.sessions.items():
+                bucket.set_rate(self.session_overrides.get(name, session))
+
+    def open(self, name):
+        """ Adds session @name, returns the function to call with byte counts
+        as it sends them. """
+        with self._lock:
+            self.sessions[name] = TokenBucket()
+        metrics.gauge('shaping.%s.limit' % name, lambda: self.sessions[name].rate)
+        self.refresh()
+        return lambda count: self.throttle(name, count)
+
+    def close(self, name):
+        with self._lock:
+            self.sessions.pop(name, None)
+            self.session_overrides.pop(name, None)
+        metrics.remove('shaping.%s.' % name)
+
+    def throttle(self, name, count):
+        """ Sleeps as long as session @name has to for sending @count bytes. """
+        if time.time() - self._refreshed >= self.refresh_every:
+            self.refresh()
+        bucket = self.sessions.get(name)
+        if bucket:
+            bucket.consume(count)
+        self.total.consume(count)
+
+
+class ShapingRPC(object):
+    """ Runtime control of a Shaper, served by backup_cli on shaping_bind.
+    Limits are bytes a second, None for unlimited. """
+
+    def __init__(self, shaper):
+        self.shaper = shaper
+
+    def limits(self):
+        """ Returns the limits in force and where they come from. """
+        total, session = self.shaper.limits()
+        return dict(global_limit=total,
+                    session_limit=session,
+                    overrides=dict(self.shaper.overrides),
+                    sessions=dict((name, bucket.rate)
+                                  for name, bucket in self.shaper.sessions.items()))
+
+    def set_global_limit(self, limit):
+        """ Overrides the schedule's global limit until cleared. """
+        self.shaper.overrides['global'] = limit
+        self.shaper.refresh()
+
+    def set_session_limit(self, limit, name=None):
+        """ Overrides the schedule's per session limit until cleared, or
+        only that of session @name for as long as it runs. """
+        if name:
+            if name not in self.shaper.sessions:
+                raise KeyError('No session %s' % name)
+            self.shaper.session_overrides[name] = limit
+        else:
+            self.shaper.overrides['session'] = limit
+        self.shaper.refresh()
+
+    def set_schedule(self, windows):
+        """ Replaces the schedule, see Schedule for @windows. """
+        self.shaper.schedule = Schedule(windows)
+        self.shaper.refresh()
+
+    def clear_overrides(self):
+        """ Goes back to the configured schedule and limits. """
+        self.shaper.overrides.clear()
+        self.shaper.session_overrides.clear()
+        self.shaper.schedule = None
+        self.shaper.refresh()
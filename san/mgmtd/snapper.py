@@ -12,6 +12,7 @@ import time
 import threading
 
 from .ordered_set_queue import OrderedSetQueue
+from .priority import Priority
 
 
 # Periodic snapshot of datasets
@@ -46,12 +47,19 @@ snapshot_conf = dict(
     #),
 )
 
+# How the deletion thread is scheduled, so destroys don't compete with the
+# LUNs we export; keys as for replication_priority in backup_conf (bar
+# cgroup, which a thread can't be put in), None to leave it be.
+deletion_priority = dict(ionice='idle', nice=19)
+
 
 class DeletionHandler(threading.Thread):
     delay = 1
 
     def __init__(self):
         threading.Thread.__init__(self)
+        # Destroys run in this thread, so it's the thread that gets demoted
+        self.priority = Priority.from_conf(deletion_priority)
         #self._q = Queue()
         self._q = OrderedSetQueue()
 
@@ -65,6 +73,8 @@ class DeletionHandler(threading.Thread):
 
     def run(self):
         log.debug('Deletion queue running delay=%s.', self.delay)
+        if self.priority:
+            self.priority.apply_to_thread()
         while True:
             dataset_name, snapshot_name, recursive = self._q.get()
             name = '%s@%s' % (dataset_name, snapshot_name)
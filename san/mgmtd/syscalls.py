@@ -0,0 +1,167 @@
+
+"""
+Thin ctypes bindings for the Linux syscalls the replication data path wants
+that Python 2 does not expose.
+"""
+
+import os
+import ctypes
+import ctypes.util
+import fcntl
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+"""
+Pipes
+"""
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+_splice = getattr(_libc, 'splice', None)
+if _splice:
+    _splice.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                        ctypes.c_int, ctypes.c_void_p,
+                        ctypes.c_size_t, ctypes.c_uint]
+    _splice.restype = ctypes.c_ssize_t
+
+
+def splice_available():
+    return bool(_splice or hasattr(os, 'splice'))
+
+
+def splice(fd_in, fd_out, count, flags=SPLICE_F_MOVE | SPLICE_F_MORE):
+    """ Moves up to @count bytes from @fd_in to @fd_out without copying them
+    into userspace. One of the two must be a pipe. Returns bytes moved, 0 on EOF. """
+    if hasattr(os, 'splice'):
+        return os.splice(fd_in, fd_out, count, flags=flags)
+    if not _splice:
+        raise OSError(38, os.strerror(38))  # ENOSYS
+    ret = _splice(fd_in, None, fd_out, None, count, flags)
+    if ret < 0:
+        _raise_errno()
+    return ret
+
+
+def set_pipe_size(fd, size):
+    """ Attempts to grow the kernel buffer of pipe @fd to @size bytes.
+    Returns the resulting size, or None if it could not be changed. """
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except IOError:
+        try:
+            return fcntl.fcntl(fd, F_GETPIPE_SZ)
+        except IOError:
+            return None
+
+
+"""
+Vectored IO
+"""
+
+IOV_MAX = 1024
+
+
+class iovec(ctypes.Structure):
+    # c_char_p so str buffers can be pointed at directly, without a cast
+    _fields_ = [('iov_base', ctypes.c_char_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+_writev = getattr(_libc, 'writev', None)
+if _writev:
+    _writev.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int]
+    _writev.restype = ctypes.c_ssize_t
+
+
+def _buffer_address(buf):
+    if isinstance(buf, bytes):
+        return buf
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+
+def writev(fd, buffers):
+    """ Writes @buffers to @fd in a single syscall. At most IOV_MAX buffers.
+    Returns bytes written, which may be short. """
+    if hasattr(os, 'writev'):
+        return os.writev(fd, buffers)
+    if not _writev:
+        raise OSError(38, os.strerror(38))  # ENOSYS
+    iov = (iovec * len(buffers))()
+    for i, buf in enumerate(buffers):
+        iov[i].iov_base = _buffer_address(buf)
+        iov[i].iov_len = len(buf)
+    ret = _writev(fd, iov, len(buffers))
+    if ret < 0:
+        _raise_errno()
+    return ret
+
+
+"""
+Scheduling priority
+"""
+
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_WHO_PROCESS = 1
+
+PRIO_PROCESS = 0
+
+# No libc wrappers for these, so by syscall number
+_syscall_numbers = {
+    'x86_64': dict(ioprio_set=251, ioprio_get=252, gettid=186),
+    'i686': dict(ioprio_set=289, ioprio_get=290, gettid=224),
+    'aarch64': dict(ioprio_set=30, ioprio_get=31, gettid=178),
+}.get(os.uname()[4], {})
+
+_libc.syscall.restype = ctypes.c_long
+_libc.setpriority.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_int]
+
+
+def _syscall(name, *args):
+    number = _syscall_numbers.get(name)
+    if number is None:
+        raise OSError(38, os.strerror(38))  # ENOSYS
+    ret = _libc.syscall(number, *[ctypes.c_int(x) for x in args])
+    if ret < 0:
+        _raise_errno()
+    return ret
+
+
+def gettid():
+    """ Kernel id of the calling thread; the pid for its main thread. """
+    return _syscall('gettid')
+
+
+def ioprio_set(who, ioclass, level=0):
+    """ Sets the I/O class and level of process (or thread) @who, 0 for the
+    caller. """
+    return _syscall('ioprio_set', IOPRIO_WHO_PROCESS, who,
+                    (ioclass << IOPRIO_CLASS_SHIFT) | level)
+
+
+def ioprio_get(who):
+    """ Returns (I/O class, level) of process (or thread) @who. """
+    value = _syscall('ioprio_get', IOPRIO_WHO_PROCESS, who)
+    return value >> IOPRIO_CLASS_SHIFT, value & ((1 << IOPRIO_CLASS_SHIFT) - 1)
+
+
+def setpriority(who, nice):
+    """ Sets the nice value of process (or, on Linux, thread) @who, 0 for the
+    caller. """
+    if _libc.setpriority(PRIO_PROCESS, who, nice) < 0:
+        _raise_errno()
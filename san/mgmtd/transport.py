@@ -0,0 +1,158 @@
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import errno
+import socket
+
+
+"""
+Plain byte stream transports for the replication stream.
+
+The default transport is zmq (see backup_cli and backup_srv_receive): chunked,
+checksummed and credit flow controlled, and able to fan out and relay. Within
+a LAN or on the same box that's mostly overhead; these instead hand zfs send's
+output to zfs receive over a single TCP or Unix domain socket, spliced through
+the kernel on both ends. TCP does the flow control and the zfs stream's own
+checksums the verifying. Resume tokens work the same as over zmq.
+
+The address picks the transport: raw+tcp://host:port or unix:///path.
+"""
+
+
+class TransportError(Exception):
+    """ Other end hung up or said something we don't understand. """
+
+
+def set_socket_buffers(sock, size):
+    """ Asks for @size byte kernel send and receive buffers on @sock. The
+    kernel caps these at net.core.[rw]mem_max. """
+    if not size:
+        return
+    for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, opt, size)
+        except socket.error as e:
+            log.warning('Could not set socket buffer to %d: %s', size, e)
+
+
+class Transport(object):
+    scheme = None
+    family = None
+
+    def __init__(self, address, buffer_size=None):
+        self.address = address
+        self.buffer_size = buffer_size
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.address)
+
+    @property
+    def path(self):
+        return self.address.split('://', 1)[1]
+
+    def sockaddr(self):
+        raise NotImplementedError()
+
+    def socket(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        # Has to happen before connect/listen for TCP window scaling to use it
+        set_socket_buffers(sock, self.buffer_size)
+        return sock
+
+    def connect(self, timeout=None):
+        sock = self.socket()
+        sock.settimeout(timeout)
+        sock.connect(self.sockaddr())
+        sock.settimeout(None)
+        return sock
+
+    def listen(self, backlog=16):
+        sock = self.socket()
+        sock.bind(self.sockaddr())
+        sock.listen(backlog)
+        return sock
+
+
+class TcpTransport(Transport):
+    scheme = 'raw+tcp'
+    family = socket.AF_INET
+
+    def sockaddr(self):
+        host, port = self.path.rsplit(':', 1)
+        return host, int(port)
+
+    def listen(self, backlog=16):
+        sock = self.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.sockaddr())
+        sock.listen(backlog)
+        return sock
+
+
+class UnixTransport(Transport):
+    scheme = 'unix'
+    family = socket.AF_UNIX
+
+    def sockaddr(self):
+        return self.path
+
+    def listen(self, backlog=16):
+        # Left behind by a previous run
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return Transport.listen(self, backlog)
+
+
+transports = dict((cls.scheme, cls) for cls in (TcpTransport, UnixTransport))
+
+
+def get_transport(address, buffer_size=None):
+    """ Returns the Transport for @address, or None if it's a zmq one. """
+    cls = transports.get(address.split('://', 1)[0])
+    if cls:
+        return cls(address, buffer_size=buffer_size)
+
+
+"""
+Handshake. Both ends speak a line each way ahead of the stream, and one more
+each way after it:
+
+    -> receive_open <session id> <dataset name>
+    <- ok | error <reason>
+    -> zfs send stream, then shutdown(SHUT_WR)
+    <- ok | error <reason>
+"""
+
+
+def send_line(sock, *words):
+    sock.sendall(' '.join(words) + '\n')
+
+
+def recv_line(sock, limit=4096):
+    """ Returns the words of one line read off @sock. Reads a byte at a time
+    so none of the stream following it is read along. """
+    buf = []
+    while True:
+        c = sock.recv(1)
+        if not c:
+            raise TransportError('Connection closed')
+        if c == '\n':
+            return ''.join(buf).split(' ')
+        buf.append(c)
+        if len(buf) > limit:
+            raise TransportError('Line too long')
+
+
+class SocketWriter(object):
+    """ Gives a socket the write() RingBuffer.drain_to wants. """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, buf):
+        return self.sock.send(buf)